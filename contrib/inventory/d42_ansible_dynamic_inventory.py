@@ -1,6 +1,8 @@
 from __future__ import (absolute_import, division, print_function)
 import argparse
-from contrib.inventory.lib import get_conf, Ansible, Device42
+import os
+import sys
+from contrib.inventory.lib import get_conf, load_inventory_cache, save_inventory_cache, Ansible, Device42
 
 try:
     import json
@@ -21,7 +23,9 @@ class Inventory(object):
         # Called with `--list`.
         if self.args.list:
             self.inventory = self.inventory()
-        # Called with `--host [hostname]`.
+        # Called with `--host [hostname]`, ansible only does when --list returns no _meta.
+        elif self.args.host:
+            self.inventory = self.host_inventory(self.args.host)
         # If no groups or vars are present, return an empty inventory.
         else:
             self.inventory = self.empty_inventory()
@@ -31,10 +35,39 @@ class Inventory(object):
     def inventory(self):
         conf = get_conf()
         ansible = Ansible(conf)
-        groups = ansible.get_grouping(Device42(conf).doql())
-        groups['_meta'] = {'hostvars': {}}
+        device42 = Device42(conf)
+        fields, rows = device42.doql()
+        hostvars = {}
+        hosts, children = ansible.get_grouping(fields, rows, hostvars)
+        groups = dict((group, {'hosts': hosts_}) for group, hosts_ in hosts.items())
+        for parent, child_groups in children.items():
+            groups.setdefault(parent, {'hosts': []})['children'] = child_groups
+        groups['_meta'] = {'hostvars': hostvars}
+
+        cache_path = conf.get('INVENTORY_CACHE_PATH')
+        if cache_path:
+            try:
+                save_inventory_cache(os.path.expanduser(cache_path), groups, device42.get_cache_key())
+            except (IOError, OSError) as e:
+                sys.stderr.write('Failed to write the inventory cache %s: %s\n' % (cache_path, e))
+
         return groups
 
+    def host_inventory(self, host):
+        # served from the last --list instead of querying Device42 once per host
+        conf = get_conf()
+        cache_path = conf.get('INVENTORY_CACHE_PATH')
+        max_age = int(conf.get('INVENTORY_CACHE_MAX_AGE') or 0)
+
+        inventory = None
+        if cache_path:
+            inventory = load_inventory_cache(os.path.expanduser(cache_path), max_age or None,
+                                             Device42(conf).get_cache_key())
+        if inventory is None:
+            inventory = self.inventory()
+
+        return inventory['_meta']['hostvars'].get(host, {})
+
     def empty_inventory(self):
         return {'_meta': {'hostvars': {}}}
 
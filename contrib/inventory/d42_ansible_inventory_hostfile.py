@@ -7,9 +7,13 @@ __metaclass__ = type
 if __name__ == '__main__':
     conf = get_conf()
     ansible = Ansible(conf)
-    groups = ansible.get_grouping(Device42(conf).doql())
+    hostvars = {} if conf['HOSTFILE_HOST_VARS'] == 'True' else None
+    group_vars = {} if conf['HOSTFILE_GROUP_VARS'] == 'True' else None
+    fields, rows = Device42(conf).doql()
+    groups, children = ansible.get_grouping(fields, rows, hostvars, group_vars)
 
-    if ansible.write_inventory_file(groups) is True:
+    if ansible.write_inventory_file(groups, children, conf['HOSTFILE_PATH'], hostvars, group_vars,
+                                    conf['HOSTFILE_FORMAT']) is True:
         print('[!] Done!')
     else:
         print('[!] Can\'t write to file')
@@ -0,0 +1,363 @@
+"""
+Keep the Device42 inventory of a device42.d42.d42 inventory source in memory and serve it locally, so that Ansible
+runs read it from here instead of each syncing from Device42.
+
+The inventory is fetched with the settings of the given .d42.yml file by the inventory plugin itself, every
+--refresh-interval seconds (incrementally with its incremental option) or on SIGHUP, and served over HTTP on a Unix
+socket or a local TCP port:
+
+    GET  /devices                       device records for the inventory plugin with source: daemon
+    GET  /list                          --list of a dynamic inventory script, every device in all with its d42_
+                                        hostvars, without the compose, groups and keyed_groups of the config
+    GET  /host/<name>                   --host of a dynamic inventory script
+    GET  /status                        time, source and metrics of the last refresh
+    POST /services/data/v1.0/query/     DOQL proxy for the lookups and contrib scripts, cached for --doql-cache-ttl
+
+Anyone able to connect can read the inventory and run DOQL queries with the credentials of the daemon, the socket is
+only accessible by its owner unless --socket-mode says otherwise. The collection has to be importable, e.g. installed
+with ansible-galaxy:
+
+    python -m contrib.inventory.d42_inventory_daemon --config /etc/ansible/d42.yml --socket /run/d42/inventory.sock
+"""
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+from ansible.parsing.dataloader import DataLoader
+from ansible.plugins import loader
+from ansible.plugins.inventory import to_safe_group_name
+
+__metaclass__ = type
+
+
+def log(message):
+    sys.stderr.write('%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), message))
+    sys.stderr.flush()
+
+
+def load_plugin(config_path):
+    """The device42.d42.d42 inventory plugin with the options of config_path, as an inventory source would have."""
+    if hasattr(loader, 'init_plugin_loader'):
+        loader.init_plugin_loader()
+    else:
+        # ansible-core < 2.15
+        loader._configure_collection_loader()
+
+    plugin = loader.inventory_loader.get('device42.d42.d42')
+    plugin.loader = DataLoader()
+    plugin._read_config_data(config_path)
+
+    return plugin
+
+
+class InventoryDaemon:
+
+    def __init__(self, plugin, refresh_interval=300, retry_interval=30, doql_cache_ttl=60):
+        self.plugin = plugin
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.doql_cache_ttl = doql_cache_ttl
+
+        self.inventory = None
+        self.status = {'refreshed_at': None, 'source': None, 'hosts': 0}
+        self.loaded = threading.Event()
+        self.wakeup = threading.Event()
+
+        # responses are rendered once per refresh, on first request
+        self.responses = {}
+        self.responses_lock = threading.Lock()
+
+        self.doql_cache = {}
+        self.doql_lock = threading.Lock()
+
+    def refresh(self):
+        """Fetch the inventory with the plugin and publish it, return False unless it was fetched completely."""
+        # importable once load_plugin set up the collection loader
+        from ansible_collections.device42.d42.plugins.plugin_utils.d42_metrics import format_report, write_metrics
+
+        plugin = self.plugin
+        plugin.reset_metrics()
+        plugin.failed_queries = []
+        plugin.inventory_source = None
+        start = time.perf_counter()
+
+        try:
+            if plugin.get_option('incremental'):
+                # merged into the inventory held here, which stands in for the plugin cache
+                inventory = plugin.get_incremental_d42_inventory(self.inventory)
+            elif plugin.get_option('snapshot_path'):
+                # a fresh snapshot is served on start, later refreshes fetch and rewrite it
+                inventory = plugin.get_snapshot_d42_inventory(self.inventory is None)
+            else:
+                inventory = plugin.get_live_d42_inventory(self.inventory, 'cache')
+        except Exception as e:
+            # a failed device query raises AnsibleParserError, anything else must not stop the refreshes either
+            log('Refreshing the Device42 inventory failed: %s' % e)
+            return False
+        plugin.add_stage_time('total', start)
+
+        if inventory is not self.inventory:
+            with self.responses_lock:
+                self.inventory = inventory
+                self.responses = {}
+
+        report = {
+            'timestamp': time.time(),
+            'source': plugin.inventory_source,
+            'hosts': len(inventory['Devices']),
+            'groups': 0,
+            'stages': plugin.stage_timings,
+            'queries': plugin.query_metrics,
+        }
+        self.status = {'refreshed_at': report['timestamp'], 'source': report['source'], 'hosts': report['hosts'],
+                       'report': report}
+        self.loaded.set()
+        log(format_report(report))
+
+        metrics_path = plugin.get_option('metrics_path')
+        if metrics_path:
+            try:
+                write_metrics(metrics_path, report, plugin.get_option('metrics_format'))
+            except (IOError, OSError) as e:
+                log('Failed to write the metrics %s: %s' % (metrics_path, e))
+
+        return plugin.inventory_source == 'live'
+
+    def run_refreshes(self):
+        while True:
+            interval = self.refresh_interval if self.refresh() else self.retry_interval
+            self.wakeup.wait(interval)
+            self.wakeup.clear()
+
+    def get_response(self, name, render):
+        with self.responses_lock:
+            response = self.responses.get(name)
+            if response is None:
+                response = self.responses[name] = render(self.inventory)
+
+        return response
+
+    def get_host_names(self, inventory):
+        position = inventory['fields'].index('name')
+        clean_device_name = self.plugin.get_option('clean_device_name')
+
+        return [to_safe_group_name(device[position]) if clean_device_name else device[position]
+                for device in inventory['Devices']]
+
+    def render_devices(self, inventory):
+        return json.dumps({
+            'total_count': len(inventory['Devices']),
+            'fields': inventory['fields'],
+            'Devices': inventory['Devices'],
+        }).encode('utf-8')
+
+    def render_list(self, inventory):
+        fields = inventory['fields']
+        names = self.get_host_names(inventory)
+        hostvars = dict((name, self.plugin.get_host_variables(fields, device))
+                        for name, device in zip(names, inventory['Devices']))
+
+        return json.dumps({'all': {'hosts': names}, '_meta': {'hostvars': hostvars}}).encode('utf-8')
+
+    def get_host(self, host_name):
+        with self.responses_lock:
+            inventory = self.inventory
+            positions = self.responses.get('host_positions')
+            if positions is None:
+                positions = self.responses['host_positions'] = dict(
+                    (name, position) for position, name in enumerate(self.get_host_names(inventory)))
+
+        position = positions.get(host_name)
+        if position is None:
+            return None
+
+        return json.dumps(self.plugin.get_host_variables(inventory['fields'],
+                                                         inventory['Devices'][position])).encode('utf-8')
+
+    def run_doql(self, form):
+        """The status, content type and body of the DOQL query in form, shared by identical queries for doql_cache_ttl."""
+        from ansible_collections.device42.d42.plugins.plugin_utils.d42_client import single_flight
+        from ansible_collections.device42.d42.plugins.plugin_utils.d42_daemon import DOQL_PATH
+
+        key = tuple(sorted(form.items()))
+        now = time.time()
+        with self.doql_lock:
+            cached = self.doql_cache.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        def fetch():
+            plugin = self.plugin
+            with plugin.get_rate_limiter().request():
+                response = plugin.get_http_session().post(plugin.get_option('url') + DOQL_PATH, data=form,
+                                                          auth=(plugin.get_option('username'),
+                                                                plugin.get_option('password')),
+                                                          verify=plugin.get_option('ssl_check'),
+                                                          timeout=plugin.get_option('timeout'))
+            result = (response.status_code, response.headers.get('Content-Type', 'text/plain'), response.content)
+
+            if response.status_code == 200 and self.doql_cache_ttl > 0:
+                expires = time.time() + self.doql_cache_ttl
+                with self.doql_lock:
+                    for cached_key in [k for k, (expiry, value) in self.doql_cache.items() if expiry <= now]:
+                        del self.doql_cache[cached_key]
+                    self.doql_cache[key] = (expires, result)
+
+            return result
+
+        return single_flight(('doql',) + key, fetch)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # seconds a request waits for the first refresh when the daemon just started
+    load_timeout = 60
+
+    def do_GET(self):
+        daemon = self.server.inventory_daemon
+        path = urlsplit(self.path).path
+
+        if path == '/status':
+            return self.send_json(200, json.dumps(daemon.status).encode('utf-8'))
+
+        if not daemon.loaded.wait(self.load_timeout):
+            return self.send_json(503, b'{"error": "the inventory has not been fetched yet"}')
+
+        if path == '/devices':
+            self.send_json(200, daemon.get_response('devices', daemon.render_devices))
+        elif path == '/list':
+            self.send_json(200, daemon.get_response('list', daemon.render_list))
+        elif path.startswith('/host/'):
+            body = daemon.get_host(unquote(path[len('/host/'):]))
+            # a dynamic inventory script answers {} for an unknown host
+            self.send_json(200, body or b'{}')
+        else:
+            self.send_json(404, b'{"error": "not found"}')
+
+    def do_POST(self):
+        from ansible_collections.device42.d42.plugins.plugin_utils.d42_daemon import DOQL_PATH
+
+        if urlsplit(self.path).path != DOQL_PATH:
+            return self.send_json(404, b'{"error": "not found"}')
+
+        length = int(self.headers.get('Content-Length') or 0)
+        form = dict(parse_qsl(self.rfile.read(length).decode('utf-8'), keep_blank_values=True))
+        try:
+            status, content_type, body = self.server.inventory_daemon.run_doql(form)
+        except Exception as e:
+            log('DOQL query failed: %s' % e)
+            return self.send_json(502, json.dumps({'error': str(e)}).encode('utf-8'))
+
+        self.send_body(status, content_type, body)
+
+    def send_json(self, status, body):
+        self.send_body(status, 'application/json', body)
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up, e.g. an ansible run that timed out
+            pass
+
+    def address_string(self):
+        # the address of a Unix socket client is an empty string
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            log('%s %s' % (self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(args):
+    if args.socket:
+        if os.path.exists(args.socket):
+            # left behind by a daemon that did not shut down, refuse to take over a socket that still answers
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(args.socket)
+            except (IOError, OSError):
+                os.unlink(args.socket)
+            else:
+                sys.exit('%s is in use by another daemon' % args.socket)
+            finally:
+                probe.close()
+
+        # created with the mode already set, not briefly open to everyone
+        umask = os.umask(0o777 & ~int(args.socket_mode, 8))
+        try:
+            server = ThreadingUnixHTTPServer(args.socket, RequestHandler)
+        finally:
+            os.umask(umask)
+        return server, 'unix://' + os.path.abspath(args.socket)
+
+    host, _, port = args.listen.rpartition(':')
+    server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), RequestHandler)
+    return server, 'http://%s:%d' % server.server_address[:2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', required=True, help='the .d42.yml of the inventory source to keep warm')
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--socket', help='path of the Unix socket to listen on')
+    address.add_argument('--listen', help='[host:]port to listen on, the host defaults to 127.0.0.1')
+    parser.add_argument('--socket-mode', default='600', help='octal permissions of the socket')
+    parser.add_argument('--refresh-interval', type=int, default=300, help='seconds between refreshes')
+    parser.add_argument('--retry-interval', type=int, default=30, help='seconds before retrying a failed refresh')
+    parser.add_argument('--doql-cache-ttl', type=int, default=60, help='seconds DOQL query results are reused')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    daemon = InventoryDaemon(load_plugin(args.config), args.refresh_interval, args.retry_interval,
+                             args.doql_cache_ttl)
+    server, daemon_url = create_server(args)
+    server.inventory_daemon = daemon
+    server.verbose = args.verbose
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, lambda signum, frame: daemon.wakeup.set())
+
+    refresher = threading.Thread(target=daemon.run_refreshes, name='d42-inventory-refresh')
+    refresher.daemon = True
+    refresher.start()
+
+    # the address on stdout, for whoever started the daemon with an ephemeral port
+    print(daemon_url)
+    sys.stdout.flush()
+    log('Serving the Device42 inventory on %s' % daemon_url)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
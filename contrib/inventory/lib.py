@@ -2,21 +2,69 @@ from __future__ import (absolute_import, division, print_function)
 import requests
 import configparser
 import csv
+import hashlib
+import io
 import sys
 import os
+import time
+from collections import defaultdict
 from requests.auth import HTTPBasicAuth
+from plugins.plugin_utils.d42_client import get_session
+from plugins.plugin_utils.d42_daemon import DOQL_PATH, DaemonError, daemon_request
+from plugins.plugin_utils.d42_files import replace_file
+from plugins.plugin_utils.d42_snapshot import UnsafeSnapshotError, load_snapshot, save_snapshot
 try:
-    from StringIO import StringIO ## for Python 2
+    import json
 except ImportError:
-    from io import StringIO ## for Python 3
+    import simplejson as json
 
 try:
-    import json
+    import yaml
 except ImportError:
-    import simplejson as json
+    yaml = None
 
 __metaclass__ = type
 
+def iter_response_lines(response, chunk_size=65536):
+    """
+    The lines of a streamed response as they arrive, with their line endings. Response.iter_lines drops them, which
+    loses the line breaks of quoted CSV values spanning several lines.
+    """
+    if response.encoding is None:
+        response.encoding = 'utf-8'
+
+    pending = ''
+    for chunk in response.iter_content(chunk_size, decode_unicode=True):
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    if pending:
+        yield pending
+
+
+def save_inventory_cache(path, inventory, key=None):
+    # the host vars may be sensitive, the file is only readable by its owner
+    content = json.dumps({'timestamp': time.time(), 'key': key, 'inventory': inventory})
+    replace_file(path, content, 0o600, '.d42_inventory')
+
+
+def load_inventory_cache(path, max_age=None, key=None):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not isinstance(cache, dict) or cache.get('key') != key:
+        return None
+
+    if max_age is not None and time.time() - cache['timestamp'] > max_age:
+        return None
+
+    return cache['inventory']
+
 
 def get_conf():
 
@@ -34,14 +82,29 @@ def get_conf():
         if conf_file.get('DEFAULT', 'D42_SKIP_SSL_CHECK') == 'True':
             requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
+        # with the inventory daemon, only the daemon needs the Device42 credentials
+        daemon_url = conf_file.get('DEFAULT', 'D42_DAEMON_URL', fallback=None)
+        credentials = {'fallback': ''} if daemon_url else {}
+
         conf = {
-            'D42_URL': conf_file.get('DEFAULT', 'D42_URL'),
-            'D42_USER': conf_file.get('DEFAULT', 'D42_USER'),
-            'D42_PWD': conf_file.get('DEFAULT', 'D42_PWD'),
+            'D42_URL': conf_file.get('DEFAULT', 'D42_URL', **credentials),
+            'D42_USER': conf_file.get('DEFAULT', 'D42_USER', **credentials),
+            'D42_PWD': conf_file.get('DEFAULT', 'D42_PWD', **credentials),
+            'D42_DAEMON_URL': daemon_url,
             'GROUP_BY_QUERY': conf_file.get('DOQL', 'GROUP_BY_QUERY'),
             'GROUP_BY_FIELD': conf_file.get('DOQL', 'GROUP_BY_FIELD'),
             'GROUP_BY_REFERENCE_FIELD': conf_file.get('DOQL', 'GROUP_BY_REFERENCE_FIELD'),
-            'SPLIT_GROUP_BY_COMMA': conf_file.get('DOQL', 'SPLIT_GROUP_BY_COMMA')
+            'SPLIT_GROUP_BY_COMMA': conf_file.get('DOQL', 'SPLIT_GROUP_BY_COMMA'),
+            'GROUP_BY_NESTED': conf_file.get('DOQL', 'GROUP_BY_NESTED', fallback='False'),
+            'HOSTFILE_PATH': conf_file.get('DEFAULT', 'HOSTFILE_PATH', fallback='hosts'),
+            'HOSTFILE_FORMAT': conf_file.get('DEFAULT', 'HOSTFILE_FORMAT', fallback='ini'),
+            'HOSTFILE_GROUP_VARS': conf_file.get('DEFAULT', 'HOSTFILE_GROUP_VARS', fallback='False'),
+            'HOSTFILE_HOST_VARS': conf_file.get('DEFAULT', 'HOSTFILE_HOST_VARS', fallback='False'),
+            'SNAPSHOT_PATH': conf_file.get('DEFAULT', 'SNAPSHOT_PATH', fallback=None),
+            'SNAPSHOT_MAX_AGE': conf_file.get('DEFAULT', 'SNAPSHOT_MAX_AGE', fallback='300'),
+            'SNAPSHOT_COMPRESS': conf_file.get('DEFAULT', 'SNAPSHOT_COMPRESS', fallback='False'),
+            'INVENTORY_CACHE_PATH': conf_file.get('DEFAULT', 'INVENTORY_CACHE_PATH', fallback=None),
+            'INVENTORY_CACHE_MAX_AGE': conf_file.get('DEFAULT', 'INVENTORY_CACHE_MAX_AGE', fallback='300')
         }
 
     except Exception as e:
@@ -49,15 +112,17 @@ def get_conf():
         if 'D42_SKIP_SSL_CHECK' in os.environ and os.environ['D42_SKIP_SSL_CHECK'] == 'True':
             requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
-        if 'D42_URL' not in os.environ:
+        daemon_url = os.environ.get('D42_DAEMON_URL')
+
+        if 'D42_URL' not in os.environ and not daemon_url:
             print('Please set D42_URL environ.')
             sys.exit()
 
-        if 'D42_USER' not in os.environ:
+        if 'D42_USER' not in os.environ and not daemon_url:
             print('Please set D42_USER environ.')
             sys.exit()
 
-        if 'D42_PWD' not in os.environ:
+        if 'D42_PWD' not in os.environ and not daemon_url:
             print('Please set D42_PWD environ.')
             sys.exit()
 
@@ -74,13 +139,24 @@ def get_conf():
             sys.exit()
 
         conf = {
-            'D42_URL': os.environ['D42_URL'],
-            'D42_USER': os.environ['D42_USER'],
-            'D42_PWD': os.environ['D42_PWD'],
+            'D42_URL': os.environ.get('D42_URL', ''),
+            'D42_USER': os.environ.get('D42_USER', ''),
+            'D42_PWD': os.environ.get('D42_PWD', ''),
+            'D42_DAEMON_URL': daemon_url,
             'GROUP_BY_QUERY': os.environ['GROUP_BY_QUERY'],
             'GROUP_BY_FIELD': os.environ['GROUP_BY_FIELD'],
             'GROUP_BY_REFERENCE_FIELD': os.environ['GROUP_BY_REFERENCE_FIELD'],
-            'SPLIT_GROUP_BY_COMMA': os.environ['SPLIT_GROUP_BY_COMMA']
+            'SPLIT_GROUP_BY_COMMA': os.environ['SPLIT_GROUP_BY_COMMA'],
+            'GROUP_BY_NESTED': os.environ.get('GROUP_BY_NESTED', 'False'),
+            'HOSTFILE_PATH': os.environ.get('HOSTFILE_PATH', 'hosts'),
+            'HOSTFILE_FORMAT': os.environ.get('HOSTFILE_FORMAT', 'ini'),
+            'HOSTFILE_GROUP_VARS': os.environ.get('HOSTFILE_GROUP_VARS', 'False'),
+            'HOSTFILE_HOST_VARS': os.environ.get('HOSTFILE_HOST_VARS', 'False'),
+            'SNAPSHOT_PATH': os.environ.get('SNAPSHOT_PATH'),
+            'SNAPSHOT_MAX_AGE': os.environ.get('SNAPSHOT_MAX_AGE', '300'),
+            'SNAPSHOT_COMPRESS': os.environ.get('SNAPSHOT_COMPRESS', 'False'),
+            'INVENTORY_CACHE_PATH': os.environ.get('INVENTORY_CACHE_PATH'),
+            'INVENTORY_CACHE_MAX_AGE': os.environ.get('INVENTORY_CACHE_MAX_AGE', '300')
         }
     return conf
 
@@ -93,31 +169,68 @@ class Device42:
         self.username = self.conf['D42_USER']
         self.base_url = self.conf['D42_URL']
         self.query = self.conf['GROUP_BY_QUERY']
+        self.daemon_url = self.conf.get('D42_DAEMON_URL')
+        self.session = get_session()
 
     def fetcher(self, url, query):
+        if self.daemon_url:
+            # the daemon sends the query to Device42 and shares the result with every script asking for it
+            try:
+                response = daemon_request(self.daemon_url, DOQL_PATH, {'query': query, 'header': 'yes'})
+            except DaemonError as e:
+                sys.stderr.write('%s\n' % e)
+                sys.exit(1)
+            return self.get_rows_from_csv(io.TextIOWrapper(response, encoding='utf-8', newline=''))
+
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded'
         }
 
-        r = requests.post(url, data={
+        # streamed, the rows are parsed while the response arrives instead of holding all of it
+        r = self.session.post(url, data={
             'query': query,
             'header': 'yes'
-        }, headers=headers, verify=False, auth=HTTPBasicAuth(self.username, self.password))
-        return r.text
+        }, headers=headers, verify=False, auth=HTTPBasicAuth(self.username, self.password), stream=True)
+        return self.get_rows_from_csv(iter_response_lines(r))
 
     def doql(self):
-        url = self.base_url + '/services/data/v1.0/query/'
-        return self.get_list_from_csv(self.fetcher(url, self.query))
+        """
+        The columns of the query and an iterator over its rows, lists of values in the order of the columns.
+        The rows are read from the response as they are consumed, unless they are kept in a snapshot.
+        """
+        snapshot_path = self.conf.get('SNAPSHOT_PATH')
+        if not snapshot_path:
+            return self.fetcher(self.base_url + '/services/data/v1.0/query/', self.query)
+        snapshot_path = os.path.expanduser(snapshot_path)
+
+        # a snapshot of another instance or query is not served
+        snapshot_key = self.get_cache_key()
+        max_age = int(self.conf.get('SNAPSHOT_MAX_AGE') or 0)
+
+        try:
+            snapshot = load_snapshot(snapshot_path, max_age or None, snapshot_key)
+        except UnsafeSnapshotError as e:
+            sys.stderr.write('%s\n' % e)
+            snapshot = None
+        if snapshot is not None:
+            return snapshot['devices']
+
+        fields, rows = self.fetcher(self.base_url + '/services/data/v1.0/query/', self.query)
+        devices = (fields, list(rows))
+        try:
+            save_snapshot(snapshot_path, devices, snapshot_key, self.conf.get('SNAPSHOT_COMPRESS') == 'True')
+        except (IOError, OSError) as e:
+            sys.stderr.write('Failed to write the snapshot %s: %s\n' % (snapshot_path, e))
+
+        return devices
+
+    def get_cache_key(self):
+        return hashlib.sha256(((self.daemon_url or self.base_url) + '\n' + self.query).encode('utf-8')).hexdigest()
 
     @staticmethod
-    def get_list_from_csv(text):
-        f = StringIO(text)
-        list_ = []
-        dict_reader = csv.DictReader(f, quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL, skipinitialspace=True, dialect='excel')
-        for item in dict_reader:
-            list_.append(item)
-
-        return list_
+    def get_rows_from_csv(lines):
+        reader = csv.reader(lines, quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL, skipinitialspace=True, dialect='excel')
+        return next(reader, []), reader
 
 
 class Ansible:
@@ -125,36 +238,162 @@ class Ansible:
     def __init__(self, conf):
         self.conf = conf
 
-    def get_grouping(self, objects):
+    def get_grouping(self, fields, rows, hostvars=None, group_vars=None):
+        """
+        Group the hosts of the query rows in a single pass, returning {group: [hosts]} and {parent: [child groups]}.
+        GROUP_BY_FIELD may name several comma separated columns. Their groups are all top level, or with
+        GROUP_BY_NESTED each column is grouped within the groups of the previous one, e.g. production_acme in
+        production. When hostvars is a dict, it also receives the columns of each row as d42_ prefixed variables,
+        and group_vars the column and value each group was made from, e.g. {'production': {'d42_service_level': ...}}.
+        Rows without a host name or with a different number of columns than the header are skipped and counted.
+        """
+        group_fields = [field.strip() for field in self.conf['GROUP_BY_FIELD'].split(',') if field.strip()]
+        try:
+            reference_index = fields.index(self.conf['GROUP_BY_REFERENCE_FIELD'])
+            group_indexes = [fields.index(field) for field in group_fields]
+        except ValueError:
+            sys.stderr.write('GROUP_BY_FIELD and GROUP_BY_REFERENCE_FIELD must be columns of GROUP_BY_QUERY, '
+                             'it returned: %s\n' % ', '.join(fields))
+            sys.exit(1)
+
+        split = self.conf['SPLIT_GROUP_BY_COMMA']
+        nested = self.conf.get('GROUP_BY_NESTED') == 'True'
+        variables = [(index, 'd42_' + field) for index, field in enumerate(fields) if field]
+        group_variables = dict((index, 'd42_' + fields[index]) for index in group_indexes)
+        width = len(fields)
+
         groups = {}
-        for object_ in objects:
-            try:
-                if self.conf['SPLIT_GROUP_BY_COMMA']:
-                    for group in object_[self.conf['GROUP_BY_FIELD']].split(','):
-                        if group not in groups:
-                            groups[group] = []
-                        groups[group].append(object_[self.conf['GROUP_BY_REFERENCE_FIELD']])
+        children = defaultdict(set)
+        self.skipped_rows = 0
+
+        for row in rows:
+            if not row:
+                continue
+            if len(row) != width or not row[reference_index]:
+                self.skipped_rows += 1
+                continue
+
+            host = row[reference_index]
+            if hostvars is not None:
+                # a query returning several rows per host, e.g. one per tag, keeps the last value of each column
+                hostvars.setdefault(host, {}).update((name, row[index]) for index, name in variables)
+
+            if not nested:
+                for index in group_indexes:
+                    for group in (row[index].split(',') if split else [row[index]]):
+                        if group:
+                            groups.setdefault(group, []).append(host)
+                            if group_vars is not None and group not in group_vars:
+                                group_vars[group] = {group_variables[index]: group}
+                continue
+
+            parents = []
+            for index in group_indexes:
+                names = [name for name in (row[index].split(',') if split else [row[index]]) if name]
+                if not names:
+                    break
+                if not parents:
+                    level = [(name, name) for name in names]
                 else:
-                    if object_[self.conf['GROUP_BY_FIELD']] not in groups:
-                        groups[object_[self.conf['GROUP_BY_FIELD']]] = []
-                    groups[object_[self.conf['GROUP_BY_FIELD']]].append(object_[self.conf['GROUP_BY_REFERENCE_FIELD']])
-            except Exception as e:
-                print(object_)
-                sys.exit()
-        return groups
+                    level = []
+                    for parent in parents:
+                        for name in names:
+                            group = parent + '_' + name
+                            children[parent].add(group)
+                            level.append((group, name))
+                if group_vars is not None:
+                    for group, name in level:
+                        if group not in group_vars:
+                            group_vars[group] = {group_variables[index]: name}
+                parents = [group for group, name in level]
+
+            for group in parents:
+                groups.setdefault(group, []).append(host)
+
+        if self.skipped_rows:
+            sys.stderr.write('Skipped %d rows without %s or with a different number of columns than %s\n' % (
+                self.skipped_rows, self.conf['GROUP_BY_REFERENCE_FIELD'], ', '.join(fields)))
+
+        return groups, dict((parent, sorted(child_groups)) for parent, child_groups in children.items())
 
     @staticmethod
-    def write_inventory_file(groups):
+    def format_ini(groups, children=None, hostvars=None, group_vars=None):
+        """The groups as an INI inventory, the variables of a host are written on its first line only."""
+        def variables(vars_):
+            # quoted, the INI parser would otherwise turn values like 1 or yes into numbers and booleans
+            return ['%s=%s' % (key, json.dumps(value)) for key, value in sorted(vars_.items())]
+
+        lines = []
+        written = set()
+        for group in groups:
+            lines.append('[' + group + ']')
+            for host in groups[group]:
+                if hostvars and host not in written and host in hostvars:
+                    written.add(host)
+                    lines.append(' '.join([host] + variables(hostvars[host])))
+                else:
+                    lines.append(host)
+            lines.append('')
 
-        f = open("hosts", "w")
+        for parent in children or {}:
+            lines.append('[' + parent + ':children]')
+            lines.extend(children[parent])
+            lines.append('')
 
+        for group in group_vars or {}:
+            lines.append('[' + group + ':vars]')
+            lines.extend(variables(group_vars[group]))
+            lines.append('')
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def format_yaml(groups, children=None, hostvars=None, group_vars=None):
+        """The groups as a YAML inventory, or JSON, which the yaml inventory plugin also reads, without PyYAML."""
+        hostvars = hostvars or {}
+        inventory = {}
+        written = set()
         for group in groups:
-            f.write('[' + group + ']\n')
-            for device in groups[group]:
-                f.write(device + '\n')
-            f.write('\n')
+            hosts = inventory.setdefault(group, {}).setdefault('hosts', {})
+            for host in groups[group]:
+                if host not in written:
+                    written.add(host)
+                    hosts[host] = hostvars.get(host)
+                else:
+                    hosts.setdefault(host, None)
 
-        f.close()
+        for group in group_vars or {}:
+            inventory.setdefault(group, {})['vars'] = group_vars[group]
+
+        # every group listed in all.children would become a child of all, the nested ones are in their parent
+        nested = set()
+        for parent in children or {}:
+            inventory.setdefault(parent, {})['children'] = dict((group, inventory.setdefault(group, {}))
+                                                                for group in children[parent])
+            nested.update(children[parent])
+
+        data = {'all': {'children': dict((group, entry) for group, entry in inventory.items() if group not in nested)}}
+        if yaml is None:
+            return json.dumps(data, indent=2, sort_keys=True) + '\n'
+        return yaml.safe_dump(data, default_flow_style=False)
+
+    @staticmethod
+    def write_inventory_file(groups, children=None, path='hosts', hostvars=None, group_vars=None,
+                             output_format='ini'):
+        """
+        Write the inventory to path in the ini or yaml format, replacing the file at once so that concurrent
+        readers see either the previous or the new inventory. An unchanged inventory is not rewritten.
+        """
+        if output_format == 'yaml':
+            content = Ansible.format_yaml(groups, children, hostvars, group_vars)
+        else:
+            content = Ansible.format_ini(groups, children, hostvars, group_vars)
+
+        try:
+            replace_file(path, content, prefix='.d42_hosts')
+        except (IOError, OSError) as e:
+            sys.stderr.write('Failed to write %s: %s\n' % (path, e))
+            return False
 
         return True
 
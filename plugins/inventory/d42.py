@@ -1,9 +1,221 @@
 from __future__ import (absolute_import, division, print_function)
+from ansible.errors import AnsibleParserError
 from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable, to_safe_group_name
-import requests
+from ansible_collections.device42.d42.plugins.plugin_utils.d42_cache import make_key
+from ansible_collections.device42.d42.plugins.plugin_utils.d42_client import get_rate_limiter, get_session, single_flight
+from ansible_collections.device42.d42.plugins.plugin_utils.d42_daemon import DaemonError, get_daemon_json
+from ansible_collections.device42.d42.plugins.plugin_utils import d42_refresh
+from ansible_collections.device42.d42.plugins.plugin_utils.d42_metrics import format_report, new_query_metric, write_metrics
+from ansible_collections.device42.d42.plugins.plugin_utils.d42_snapshot import UnsafeSnapshotError, load_snapshot, save_snapshot
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from collections import OrderedDict
+import codecs
+import inspect
+import json
+import re
+import subprocess
+import sys
+import threading
+import time
+import types
 
 __metaclass__ = type
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# ansible 2.9 always re-reads the host vars when building groups, later versions can be handed them
+GROUPS_ACCEPT_HOSTVARS = 'fetch_hostvars' in inspect.signature(Constructable._add_host_to_keyed_groups).parameters
+
+
+def bool_to_yes_no(val):
+    if isinstance(val, bool) and val:
+        return 'yes'
+
+    return 'no'
+
+
+def split_names(val):
+    return str(val).split(',') if val is not None else []
+
+
+def empty_list(val):
+    return []
+
+
+def gigabytes(val):
+    return 'GB'
+
+
+def json_list(val):
+    # aggregated child collections arrive as JSON text or already decoded depending on the DOQL version
+    if isinstance(val, str):
+        val = json.loads(val)
+
+    return val or []
+
+
+def get_path(value, path):
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+
+    return value
+
+
+def compact_children(key, val):
+    # aggregated child collections arrive as dicts, stored as tuples like the joined ones
+    paths = CHILD_PATHS[key]
+    return [tuple([get_path(child, path) for path in paths]) for child in json_list(val)]
+
+
+def expand_child(paths, values):
+    child = {}
+    for path, value in zip(paths, values):
+        target = child
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
+
+    return child
+
+
+# device record fields in the order they are built: (record key, column of the device query, conversion)
+DEVICE_FIELDS = [
+    ('datastores', 'datastores', None),
+    ('last_updated', 'last_edited', None),
+    ('ip_addresses', None, empty_list),
+    ('serial_no', 'serial_no', None),
+    ('hw_depth', 'hw_depth', None),
+    ('nonauthoritativealiases', 'nonauthoritativealiases', split_names),
+    ('service_level', 'service_level', None),
+    ('is_it_blade_host', 'blade_chassis', bool_to_yes_no),
+    ('is_it_switch', 'network_device', bool_to_yes_no),
+    ('virtual_subtype_id', 'virtual_subtype_id', None),
+    ('hw_size', 'hw_size', None),
+    ('id', 'device_pk', None),
+    ('custom_fields', None, empty_list),
+    ('aliases', 'aliases', split_names),
+    ('category', 'category', None),
+    ('hdd_details', None, empty_list),
+    ('uuid', 'uuid', None),
+    ('virtual_subtype', 'virtual_subtype', None),
+    ('cpuspeed', 'cpuspeed', None),
+    ('hw_model', 'hw_model', None),
+    ('osverno', 'os_version_no', None),
+    ('type', 'type', None),
+    ('hddcount', 'hard_disk_count', None),
+    ('device_external_links', None, empty_list),
+    ('tags', 'tags', None),
+    ('hw_model_id', 'hw_model_id', None),
+    ('in_service', 'in_service', None),
+    ('hddsize', 'disk_size', None),
+    ('hddsize_type', None, gigabytes),
+    ('mac_addresses', None, empty_list),
+    ('hddraid', 'hw_sw_raid', None),
+    ('corethread', 'corethread', None),
+    ('cpucount', 'cpucount', None),
+    ('virtual_host_name', 'virtual_host_name', None),
+    ('is_it_virtual_host', 'virtual_host', bool_to_yes_no),
+    ('manufacturer', 'manufacturer', None),
+    ('customer', 'customer', None),
+    ('customer_id', 'customer_id', None),
+    ('ucs_manager', 'ucsmanager', None),
+    ('hddraid_type', 'raid_type', None),
+    ('name', 'name', None),
+    ('notes', 'notes', None),
+    ('ram', 'ram', None),
+    ('asset_no', 'asset_no', None),
+    ('osarch', 'os_arch', None),
+    ('osver', 'os_version_no', None),
+    ('device_purchase_line_items', None, empty_list),
+    ('cpucore', 'cpucore', None),
+    ('os', 'os_name', None),
+    ('device_id', 'device_pk', None),
+]
+
+ALL_DEVICE_FIELDS = frozenset(key for key, column, convert in DEVICE_FIELDS)
+
+# record fields filled from the child queries: record key -> (dataset, option that toggles the query)
+CHILD_FIELDS = {
+    'ip_addresses': ('ip_addresses', 'include_ip_addresses'),
+    'mac_addresses': ('mac_addresses', 'include_mac_addresses'),
+    'hdd_details': ('hdd_details', 'include_hdd_details'),
+    'device_external_links': ('external_links', 'include_external_links'),
+    'device_purchase_line_items': ('entitlements', 'include_entitlements'),
+    'custom_fields': ('custom_fields', 'include_custom_fields'),
+}
+
+# child records are stored as tuples of their values and only expanded into dicts when the host vars are set:
+# record key -> [(key path in the expanded record, column of the child query)], in the order of the expanded keys
+CHILD_LAYOUTS = {
+    'custom_fields': [
+        (('key',), 'custom_field_key'),
+        (('value',), 'custom_field_value'),
+    ],
+    'hdd_details': [
+        (('raid_group',), 'raid_group'),
+        (('serial_no',), 'hdd_serial_no'),
+        (('raid_type',), 'hdd_raid_type'),
+        (('hdd', 'description'), 'hdd_description'),
+        (('hdd', 'partno'), 'partno'),
+        (('hdd', 'rpm', 'id'), 'hdd_rpm_id'),
+        (('hdd', 'rpm', 'name'), 'hdd_rpm'),
+        (('hdd', 'notes'), 'hdd_notes'),
+        (('hdd', 'bytes'), 'hdd_bytes'),
+        (('hdd', 'location'), 'hdd_location'),
+        (('hdd', 'hd_id'), 'hdd_id'),
+        (('hdd', 'manufacturer_id'), 'manufactuerer_id'),
+        (('hdd', 'type', 'id'), 'hdd_type_id'),
+        (('hdd', 'type', 'name'), 'hdd_type_name'),
+        (('hdd', 'size'), 'size'),
+        (('part_id',), 'part_id'),
+        (('hddcount',), 'hddcount'),
+        (('description',), 'description'),
+    ],
+    'device_external_links': [
+        (('notes',), 'device_url_notes'),
+        (('link',), 'device_url'),
+    ],
+    'mac_addresses': [
+        (('mac',), 'mac'),
+        (('vlan',), 'vlan'),
+        (('port_name',), 'port_name'),
+        (('port',), 'port'),
+    ],
+    'device_purchase_line_items': [((column,), column) for column in [
+        'purchase_id', 'line_start_date', 'line_no', 'line_renew_date', 'line_notes', 'line_quantity', 'line_frequency',
+        'line_cost', 'line_cancel_policy', 'line_item_type', 'purchase_order_no', 'line_type', 'line_service_type',
+        'line_end_date', 'line_contract_type',
+    ]],
+    'ip_addresses': [
+        (('subnet_id',), 'subnet_id'),
+        (('ip',), 'ip'),
+        (('label',), 'label'),
+        (('type',), 'type'),
+        (('subnet',), 'subnet'),
+    ],
+}
+CHILD_PATHS = dict((key, [path for path, column in layout]) for key, layout in CHILD_LAYOUTS.items())
+# child keys also set under the misspelled name earlier releases used: record key -> [(old key, key)]
+CHILD_ALIASES = {'device_purchase_line_items': [('purhase_id', 'purchase_id')]}
+CHILD_COLUMNS = dict((key, [column for path, column in layout]) for key, layout in CHILD_LAYOUTS.items())
+
+# the order build_d42_inventory joins the child datasets in
+CHILD_JOINS = ['custom_fields', 'hdd_details', 'device_external_links', 'mac_addresses', 'device_purchase_line_items',
+               'ip_addresses']
+
+# the plugin itself needs these to name hosts and merge records
+REQUIRED_FIELDS = frozenset(['id', 'name'])
+
+# filter keys are used as view_device_v1 column names and cannot be quoted, only plain identifiers are accepted
+FILTER_COLUMN = re.compile(r'^[a-z_][a-z0-9_]*$')
+FILTER_OPERATORS = {'eq': '=', 'ne': '<>', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+
+# keyed_groups keys that are a bare variable name, unless Jinja reads them as a literal or keyword
+KEYED_GROUP_VARIABLE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+JINJA_NAMES = frozenset(['true', 'false', 'none', 'True', 'False', 'None', 'and', 'or', 'not', 'in', 'is', 'if',
+                         'else'])
+
 DOCUMENTATION = r'''
     module: d42
     plugin_type: inventory
@@ -16,30 +228,48 @@ DOCUMENTATION = r'''
         - Device42 Inventory plugin
     extends_documentation_fragment:
         - constructed
+        - inventory_cache
     options:
         plugin:
             description: The name of the Device42 Inventory Plugin, this should always be 'device42.d42.d42'.
             required: true
             choices: ['device42.d42.d42']
         url:
-            description: URI of Device42. The URI should be the fully-qualified domain name, e.g. 'your-instance.device42.net'.
+            description:
+                - URI of Device42. The URI should be the fully-qualified domain name, e.g. 'your-instance.device42.net'.
+                - Required unless I(source) is C(daemon).
             type: string
-            required: true
             env:
                 - name: D42_URL
         username:
-            description: The Device42 user account.
+            description: The Device42 user account, required unless I(source) is C(daemon).
             type: string
-            required: true
             env:
                 - name: D42_USER
         password:
-            description: The Device42 instance user password.
+            description: The Device42 instance user password, required unless I(source) is C(daemon).
             type: string
             secret: true
-            required: true
             env:
                 - name: D42_PWD
+        source:
+            description:
+                - C(device42) queries Device42, or builds the inventory from the cache or snapshot.
+                - C(daemon) reads the devices from C(contrib/inventory/d42_inventory_daemon.py) listening at
+                  I(daemon_url), which keeps the inventory in memory and refreshes it on its own schedule, so the
+                  source costs one local request instead of a sync.
+                - With C(daemon) the fields, filters and refreshes are those of the daemon's configuration, this source
+                  only builds the hosts and groups from them.
+            type: string
+            default: device42
+            choices: ['device42', 'daemon']
+            env:
+                - name: D42_SOURCE
+        daemon_url:
+            description: Address of the inventory daemon, C(unix:///path/to/socket) or C(http://127.0.0.1:port).
+            type: string
+            env:
+                - name: D42_DAEMON_URL
         ssl_check:
             description: SSL verification.
             type: boolean
@@ -58,6 +288,248 @@ DOCUMENTATION = r'''
             default: true
             env:
                 - name: D42_CLEAN_DEVICE_NAME
+        concurrent_fetch:
+            description:
+                - Run the device, IP, MAC, HDD, external link, entitlement and custom field queries concurrently
+                  instead of one after another.
+                - A failing query does not affect the others, its dataset is treated as empty.
+            type: boolean
+            default: false
+            env:
+                - name: D42_CONCURRENT_FETCH
+        fetch_workers:
+            description: Maximum number of queries run at the same time when I(concurrent_fetch) is enabled.
+            type: integer
+            default: 7
+            env:
+                - name: D42_FETCH_WORKERS
+        stream_results:
+            description:
+                - Parse DOQL responses incrementally while they are downloaded instead of loading each response body whole.
+                - Without I(concurrent_fetch) the rows are joined into the devices as they arrive, so memory stays bounded
+                  by the assembled inventory rather than by the raw payloads.
+            type: boolean
+            default: false
+            env:
+                - name: D42_STREAM_RESULTS
+        page_size:
+            description:
+                - Fetch devices in pages of this many devices, keyset paged on C(device_pk). 0 disables paging.
+                - The child queries of each page are limited to the page's device range, so no single request has to
+                  return the whole estate.
+                - With I(concurrent_fetch) the next page of devices is fetched while the child queries of the current page run.
+            type: integer
+            default: 0
+            env:
+                - name: D42_PAGE_SIZE
+        query_engine:
+            description:
+                - C(split) runs the device query and one query per child dataset (IPs, MACs, HDDs, external links,
+                  entitlements, custom fields) and joins their rows into the devices.
+                - C(aggregated) runs a single device query where each child dataset is a C(json_agg) subquery, so every
+                  device row arrives with its child collections already nested.
+            type: string
+            default: split
+            choices: ['split', 'aggregated']
+            env:
+                - name: D42_QUERY_ENGINE
+        timeout:
+            description: Timeout in seconds for each DOQL request.
+            type: integer
+            default: 30
+            env:
+                - name: D42_TIMEOUT
+        fields:
+            description:
+                - Only fetch these device fields and set them as C(d42_) hostvars, e.g. C(name), C(ip_addresses), C(os).
+                - The device query only selects and joins what the listed fields need, and the IP, MAC, HDD, external
+                  link, entitlement and custom field queries are skipped unless their field is listed.
+                - A listed field whose column the Device42 version does not have fails the device query, all fields
+                  select the columns of view_device_v1 whole.
+                - C(id) and C(name) are always included. All fields are fetched when empty.
+            type: list
+            elements: string
+            default: []
+            env:
+                - name: D42_FIELDS
+        exclude_fields:
+            description: Device fields not to fetch, applied after I(fields).
+            type: list
+            elements: string
+            default: []
+            env:
+                - name: D42_EXCLUDE_FIELDS
+        include_ip_addresses:
+            description: Fetch the C(ip_addresses) of each device, C(ansible_host) is set from the first one.
+            type: boolean
+            default: true
+        include_mac_addresses:
+            description: Fetch the C(mac_addresses) of each device.
+            type: boolean
+            default: true
+        include_hdd_details:
+            description: Fetch the C(hdd_details) of each device.
+            type: boolean
+            default: true
+        include_external_links:
+            description: Fetch the C(device_external_links) of each device.
+            type: boolean
+            default: true
+        include_entitlements:
+            description: Fetch the C(device_purchase_line_items) of each device.
+            type: boolean
+            default: true
+        include_custom_fields:
+            description: Fetch the C(custom_fields) of each device.
+            type: boolean
+            default: true
+        filters:
+            description:
+                - Only return devices matching all of these filters, they are added to the WHERE clause of the device
+                  query and of every child query so Device42 only sends the matching rows.
+                - Keys are C(view_device_v1) columns compared for equality, a list value matches any of its items and
+                  C(null) matches empty columns.
+                - A dict value compares with C(eq), C(ne), C(gt), C(gte), C(lt) and C(lte), e.g. a C(last_edited) range.
+                - C(customer) matches customer names, C(tags) matches devices with any of the given tags and
+                  C(custom_fields) is a dict of custom field keys to the value (or list of values) they must have.
+            type: dict
+            default: {}
+        pool_size:
+            description:
+                - Number of connections kept open to Device42 and reused between requests.
+                - Should be at least I(fetch_workers) when I(concurrent_fetch) is enabled.
+            type: integer
+            default: 10
+            env:
+                - name: D42_POOL_SIZE
+        retries:
+            description: Number of times a request is retried after a connection error or a 429/5xx response.
+            type: integer
+            default: 3
+            env:
+                - name: D42_RETRIES
+        retry_backoff:
+            description: Backoff factor in seconds for retries, the wait doubles after each attempt.
+            type: float
+            default: 0.5
+            env:
+                - name: D42_RETRY_BACKOFF
+        rate_limit:
+            description:
+                - Maximum average number of requests per second sent to Device42 by this process, C(0) for no limit.
+                - Shared by every inventory source and lookup in the process using the same I(url) and limits.
+            type: float
+            default: 0
+            env:
+                - name: D42_RATE_LIMIT
+        rate_burst:
+            description: Number of requests that may be sent at once before I(rate_limit) applies.
+            type: integer
+            default: 1
+            env:
+                - name: D42_RATE_BURST
+        max_in_flight:
+            description:
+                - Maximum number of requests to Device42 outstanding at once in this process, C(0) for no limit.
+                - Streamed queries hold their slot until the response headers arrive.
+            type: integer
+            default: 0
+            env:
+                - name: D42_MAX_IN_FLIGHT
+        incremental:
+            description:
+                - Only fetch devices edited since the previous run and merge them into the cached inventory.
+                - Requires I(cache) to be enabled, the cached inventory is used as the snapshot to merge into,
+                  so I(cache_timeout) should be longer than I(full_refresh_interval) (or 0 to never expire).
+                - Devices that no longer exist are removed on every run, changes to child records (IPs, MACs, HDDs,
+                  custom fields) that do not update the device are picked up by the next full refresh.
+            type: boolean
+            default: false
+            env:
+                - name: D42_INCREMENTAL
+        full_refresh_interval:
+            description: Seconds after which an incremental inventory is rebuilt from a full sync.
+            type: integer
+            default: 86400
+            env:
+                - name: D42_FULL_REFRESH_INTERVAL
+        snapshot_path:
+            description:
+                - File to keep a snapshot of the assembled devices in. While it is younger than I(snapshot_max_age) the
+                  inventory is built from it instead of querying Device42, afterwards it is refreshed.
+                - The snapshot is a pickle only readable by its owner. A snapshot owned by another user or writable by
+                  others is refused with a warning, keep it in a private directory such as C(~/.cache).
+                - It is ignored with C(--flush-cache), and when the url, I(fields) or I(filters) change.
+            type: path
+            env:
+                - name: D42_SNAPSHOT_PATH
+        snapshot_max_age:
+            description: Seconds a snapshot is served for, 0 to never expire it.
+            type: integer
+            default: 300
+            env:
+                - name: D42_SNAPSHOT_MAX_AGE
+        snapshot_compress:
+            description: Gzip the snapshot, it is then several times smaller but slower to load.
+            type: boolean
+            default: false
+            env:
+                - name: D42_SNAPSHOT_COMPRESS
+        snapshot_max_staleness:
+            description:
+                - Age in seconds up to which a snapshot older than I(snapshot_max_age) is still used, 0 disables it.
+                - If the device query fails or times out the inventory is built from such a snapshot instead of
+                  failing, and with I(snapshot_background_refresh) it is served right away while a new one is fetched.
+                - Without a usable snapshot a failing device query fails the inventory source.
+                - The source used is set as the C(d42_inventory_source) variable of the C(all) group, one of C(live),
+                  C(partial) (some child queries failed), C(cache), C(snapshot), C(stale_snapshot), C(fallback_snapshot)
+                  or C(daemon).
+            type: integer
+            default: 0
+            env:
+                - name: D42_SNAPSHOT_MAX_STALENESS
+        snapshot_background_refresh:
+            description:
+                - Serve a stale snapshot immediately and refresh it in a detached background process, the next run
+                  then uses the refreshed snapshot. The run does not wait for it, and only one refresh of a snapshot
+                  runs at a time.
+                - When disabled the inventory is fetched first and the stale snapshot is only used if that fails.
+            type: boolean
+            default: true
+            env:
+                - name: D42_SNAPSHOT_BACKGROUND_REFRESH
+        native_keyed_groups:
+            description:
+                - Build the I(keyed_groups) whose C(key) is a plain variable name holding a string or a list of strings
+                  without templating, which is much faster on large inventories.
+                - Other keys, values and a templated C(parent_group) still go through Jinja, as does everything when
+                  I(use_extra_vars) is enabled. The resulting groups are the same either way.
+            type: boolean
+            default: true
+            env:
+                - name: D42_NATIVE_KEYED_GROUPS
+        metrics_verbosity:
+            description:
+                - Verbosity (number of C(-v)) at which the time spent in each stage and, for each DOQL query, the
+                  request latency, server time, JSON decode time, bytes and rows received are displayed.
+                - The join time of each dataset and the host, compose, group and keyed group construction times are
+                  reported as stages.
+            type: integer
+            default: 3
+            env:
+                - name: D42_METRICS_VERBOSITY
+        metrics_path:
+            description: Also write the metrics of each run to this file, replacing it atomically.
+            type: path
+            env:
+                - name: D42_METRICS_PATH
+        metrics_format:
+            description: Format of I(metrics_path), C(prometheus) writes a node_exporter textfile collector file.
+            type: string
+            default: json
+            choices: ['json', 'prometheus']
+            env:
+                - name: D42_METRICS_FORMAT
 '''
 
 EXAMPLES = r'''
@@ -68,6 +540,12 @@ password: password
 ssl_check: False
 debug: False
 clean_device_name: True
+cache: True
+cache_plugin: jsonfile
+cache_connection: /tmp/d42_inventory
+cache_timeout: 3600
+concurrent_fetch: True
+fetch_workers: 7
 keyed_groups:
     - key: d42_service_level
       prefix: ''
@@ -75,9 +553,64 @@ keyed_groups:
 '''
 
 
+def received_bytes(response, default):
+    """Bytes of the response body read from the connection so far, before gzip or deflate decoding."""
+    tell = getattr(response.raw, 'tell', None)
+    return tell() if tell else default
+
+
+def iter_json_array(chunks):
+    """Incrementally decode a JSON array from an iterable of text chunks, yielding one element at a time."""
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or (started and buf[pos] == ',')):
+                pos += 1
+            if pos == len(buf):
+                break
+
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('DOQL response is not a JSON array')
+                started = True
+                pos += 1
+                continue
+
+            if buf[pos] == ']':
+                return
+
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the element is split across chunks, wait for more data
+                break
+            if not isinstance(item, (dict, list, str)):
+                # a number may be cut anywhere, e.g. 1500. or 1e, only trust it once a separator follows it
+                follow = end
+                while follow < len(buf) and buf[follow].isspace():
+                    follow += 1
+                if follow == len(buf) or buf[follow] not in ',]':
+                    break
+
+            pos = end
+            yield item
+
+    raise ValueError('DOQL response ended before the JSON array was closed')
+
+
 class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     NAME = 'device42.d42.d42'
 
+    # the metrics of the query being run by each thread, see run_timed_query
+    _metrics_local = threading.local()
+
     def verify_file(self, path):
         valid = False
 
@@ -95,6 +628,27 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         self._read_config_data(path)
 
         strict = self.get_option('strict')
+        use_daemon = self.get_option('source') == 'daemon'
+
+        if use_daemon and not self.get_option('daemon_url'):
+            raise AnsibleParserError('daemon_url is required with source: daemon')
+        if not use_daemon and not all(self.get_option(option) for option in ('url', 'username', 'password')):
+            raise AnsibleParserError('url, username and password are required to query Device42')
+
+        # compile the filters up front so a bad filter fails the source instead of being swallowed below
+        self.get_filter_conditions()
+
+        unknown_fields = set(self.get_option('fields') + self.get_option('exclude_fields')) - ALL_DEVICE_FIELDS
+        if unknown_fields:
+            self.display.warning('Ignoring unknown Device42 fields: %s' % ', '.join(sorted(unknown_fields)))
+
+        self.failed_queries = []
+        self.inventory_source = None
+        self.reset_metrics()
+        parse_start = time.perf_counter()
+        objects = []
+        added_hosts = []
+        device_count = 0
 
         try:
             try:
@@ -103,48 +657,426 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
                 print("clean_device_name has not been defined in *.d42.yml. defaulting to True")
                 clean_device_name = True
 
-            objects = []
-
-            json_response = self.get_d42_inventory()
+            start = time.perf_counter()
+            if use_daemon:
+                json_response = self.get_daemon_d42_inventory()
+            else:
+                json_response = self.get_cached_d42_inventory(path, cache)
+            self.add_stage_time('fetch', start)
 
             if 'Devices' in json_response:
                 objects = json_response['Devices']
+            fields = json_response.get('fields', [])
+            name_position = fields.index('name') if fields else None
+
+            compose = self.get_option('compose')
+            groups = self.get_option('groups')
+            keyed_groups = self.plan_keyed_groups(self.get_option('keyed_groups'))
+            group_kwargs = {'fetch_hostvars': False} if GROUPS_ACCEPT_HOSTVARS else {}
+
+            hosts_time = compose_time = groups_time = keyed_groups_time = 0.0
+            fetched = time.perf_counter()
 
             for object_ in objects:
-                if clean_device_name:
-                    host_name = self.inventory.add_host(to_safe_group_name(object_['name']))
+                start = time.perf_counter()
+                # a pipelined inventory assembles the devices while they are iterated
+                self.add_stage_time('fetch', fetched)
+                device_count += 1
+
+                host_name = to_safe_group_name(object_[name_position]) if clean_device_name else object_[name_position]
+                if host_name not in self.inventory.hosts:
+                    added_hosts.append(host_name)
+                self.inventory.add_host(host_name)
+
+                host_vars = self.get_host_variables(fields, object_)
+                host = self.set_host_variables(host_name, host_vars)
+
+                # build the templating vars once and share them between compose, groups and keyed_groups
+                host_vars = host.get_vars()
+                composed = time.perf_counter()
+                hosts_time += composed - start
+                if compose:
+                    self._set_composite_vars(compose, host_vars, host_name, strict)
+                    host_vars = host.get_vars()
+                    start = time.perf_counter()
+                    compose_time += start - composed
                 else:
-                    host_name = self.inventory.add_host(object_['name'])
+                    start = composed
+
+                self._add_host_to_composed_groups(groups, host_vars, host_name, strict, **group_kwargs)
+                grouped = time.perf_counter()
+                groups_time += grouped - start
+
+                self.add_host_to_keyed_groups(keyed_groups, host_vars, host_name, strict, group_kwargs)
+                fetched = time.perf_counter()
+                keyed_groups_time += fetched - grouped
+
+            self.add_stage_time('fetch', fetched)
+            self.stage_timings.update(hosts=hosts_time, compose=compose_time, groups=groups_time,
+                                      keyed_groups=keyed_groups_time)
+            self.inventory.set_variable('all', 'd42_inventory_source', self.inventory_source)
+        except Exception as e:
+            # ansible keeps what a failed source added, drop the hosts of the pages assembled before the failure
+            for host_name in added_hosts:
+                self.inventory.remove_host(self.inventory.get_host(host_name))
+            device_count = 0
+            if isinstance(e, AnsibleParserError):
+                raise
+            raise AnsibleParserError('Failed to build the Device42 inventory: %s' % e, orig_exc=e)
+        finally:
+            self.add_stage_time('total', parse_start)
+            self.report_metrics(device_count)
+
+    def plan_keyed_groups(self, keyed_groups):
+        """Pair each keyed_groups entry with the settings to build it natively, or None when it needs templating."""
+        try:
+            use_extra_vars = self.get_option('use_extra_vars')
+        except Exception:
+            # ansible < 2.11
+            use_extra_vars = False
+        try:
+            leading_separator = self.get_option('leading_separator')
+        except Exception:
+            leading_separator = True
+
+        self._group_names = {}
+        plan = []
+        for keyed in keyed_groups or []:
+            native = None
+            if self.get_option('native_keyed_groups') and not use_extra_vars and isinstance(keyed, dict):
+                key = keyed.get('key')
+                prefix = keyed.get('prefix', '')
+                separator = keyed.get('separator', '_')
+                default_value = keyed.get('default_value')
+                parent_group = keyed.get('parent_group')
+
+                if prefix == '' and leading_separator is False:
+                    separator = ''
+
+                # the same checks and conversions as Constructable._add_host_to_keyed_groups, anything else is left to it
+                if isinstance(key, str) and KEYED_GROUP_VARIABLE.match(key) and key not in JINJA_NAMES and \
+                        (default_value is None or keyed.get('trailing_separator') is None) and \
+                        (parent_group is None or isinstance(parent_group, str) and '{' not in parent_group):
+                    native = (key, '%s%s' % (prefix, separator), default_value,
+                              self._sanitize_group_name(parent_group) if parent_group else None)
+
+            plan.append((keyed, native))
+
+        return plan
+
+    def add_host_to_keyed_groups(self, keyed_groups, host_vars, host_name, strict, group_kwargs):
+        for keyed, native in keyed_groups:
+            if native is None or not self.add_host_to_native_keyed_group(native, host_vars, host_name, strict):
+                self._add_host_to_keyed_groups([keyed], host_vars, host_name, strict, **group_kwargs)
+
+    def add_host_to_native_keyed_group(self, native, host_vars, host_name, strict):
+        """
+        Add the host to the groups named after a string or list of strings variable. Return False, leaving it to the
+        templated path, when the variable is missing, holds something else, a string Jinja would template or, with
+        strict, nothing to group on.
+        """
+        key, group_prefix, default_value, parent_group = native
+        if key not in host_vars:
+            return False
+        value = host_vars[key]
+
+        if value is None or value == '':
+            if default_value is None:
+                return not strict
+            names = [default_value]
+        elif isinstance(value, str) and '{' not in value:
+            names = [value]
+        elif isinstance(value, list) and all(isinstance(name, str) and '{' not in name for name in value):
+            names = [default_value if name == '' and default_value is not None else name for name in value]
+        else:
+            return False
+
+        for name in names:
+            raw_name = '%s%s' % (group_prefix, name)
+            group_name = self._group_names.get(raw_name)
+            if group_name is None:
+                group_name = self._group_names[raw_name] = self._sanitize_group_name(raw_name)
+
+            group_name = self.inventory.add_group(group_name)
+            self.inventory.add_host(host_name, group_name)
+
+            if parent_group:
+                self.inventory.add_group(parent_group)
+                self.inventory.add_child(parent_group, group_name)
+
+        return True
+
+    def reset_metrics(self):
+        self.query_metrics = []
+        self.stage_timings = {}
+
+    def add_stage_time(self, stage, start):
+        now = time.perf_counter()
+        self.stage_timings[stage] = self.stage_timings.get(stage, 0.0) + now - start
+
+        return now
+
+    def get_query_metric(self):
+        # set by run_timed_query in the thread running the query, requests made outside of it are not recorded
+        return getattr(self._metrics_local, 'metric', None) or new_query_metric(None)
+
+    def report_metrics(self, hosts):
+        report = {
+            'timestamp': time.time(),
+            'source': self.inventory_source,
+            'hosts': hosts,
+            'groups': len(self.inventory.groups),
+            'stages': self.stage_timings,
+            'queries': self.query_metrics,
+        }
+
+        self.display.verbose(format_report(report), caplevel=self.get_option('metrics_verbosity') - 1)
+
+        metrics_path = self.get_option('metrics_path')
+        if metrics_path:
+            try:
+                write_metrics(metrics_path, report, self.get_option('metrics_format'))
+            except (IOError, OSError) as e:
+                self.display.warning('Failed to write the Device42 inventory metrics %s: %s' % (metrics_path, e))
+
+    @staticmethod
+    def get_host_variables(fields, device):
+        # records are only turned into dicts here, once per host instead of for the whole inventory at once
+        host_vars = {}
+        for key, value in zip(fields, device):
+            paths = CHILD_PATHS.get(key)
+            if paths:
+                value = [expand_child(paths, child) for child in value]
+                for alias, name in CHILD_ALIASES.get(key, ()):
+                    for child in value:
+                        child[alias] = child[name]
+            host_vars['d42_' + key] = value
+
+        if host_vars.get('d42_ip_addresses'):
+            host_vars['ansible_host'] = host_vars['d42_ip_addresses'][0]['ip']
+
+        return host_vars
+
+    def set_host_variables(self, host_name, host_vars):
+        for key, value in host_vars.items():
+            self.inventory.set_variable(host_name, key, value)
+
+        return self.inventory.get_host(host_name)
+
+    def get_daemon_d42_inventory(self):
+        daemon_url = self.get_option('daemon_url')
+        metric = new_query_metric('Daemon')
+        self.query_metrics.append(metric)
+
+        start = time.perf_counter()
+        try:
+            inventory = get_daemon_json(daemon_url, '/devices', self.get_option('timeout'))
+        except DaemonError as e:
+            metric['failed'] = 1
+            raise AnsibleParserError('Failed to fetch the Device42 inventory: %s' % e)
+        finally:
+            metric['latency_s'] = time.perf_counter() - start
+
+        metric['rows'] = len(inventory['Devices'])
+        self.inventory_source = 'daemon'
+        return inventory
+
+    def get_cached_d42_inventory(self, path, cache):
+        cache_key = self.get_cache_key(path)
+
+        # cache is False when the user runs with --flush-cache, then the cache is refreshed
+        user_cache_setting = self.get_option('cache')
+        attempt_to_read_cache = user_cache_setting and cache
+        cache_needs_update = user_cache_setting and not cache
+
+        if not user_cache_setting and not self.get_option('snapshot_path'):
+            # nothing keeps the devices, parse adds the hosts while they are being assembled
+            return {'fields': self.get_record_fields(), 'Devices': self.iter_live_d42_inventory()}
+
+        if user_cache_setting and self.get_option('incremental'):
+            previous = None
+            if attempt_to_read_cache:
+                try:
+                    previous = self._cache[cache_key]
+                except KeyError:
+                    pass
+
+            json_response = self.get_incremental_d42_inventory(previous)
+            if self.inventory_source == 'live':
+                self._cache[cache_key] = json_response
+            return json_response
+
+        if attempt_to_read_cache:
+            try:
+                json_response = self._cache[cache_key]
+                if not self.has_record_layout(json_response, self.get_record_fields()):
+                    raise KeyError(cache_key)
+                self.inventory_source = 'cache'
+                return json_response
+            except KeyError:
+                cache_needs_update = True
+
+        json_response = self.get_snapshot_d42_inventory(cache)
+
+        # only complete inventories fetched from Device42 are cached, a failed run must not replace a good one
+        if cache_needs_update and self.inventory_source == 'live':
+            self._cache[cache_key] = json_response
+
+        return json_response
 
-                for k in object_.keys():
-                    self.inventory.set_variable(host_name, 'd42_' + k, object_[k])
+    def get_snapshot_d42_inventory(self, use_snapshot):
+        snapshot_path = self.get_option('snapshot_path')
+        if not snapshot_path:
+            return self.get_live_d42_inventory()
 
-                if object_['ip_addresses']:
-                    self.inventory.set_variable(host_name, 'ansible_host', object_['ip_addresses'][0]['ip'])
+        # a snapshot taken with other settings holds other devices or fields
+        snapshot_key = make_key(self.get_option('url'), sorted(self.get_device_fields()), self.get_filter_conditions())
+        max_age = self.get_option('snapshot_max_age')
+        max_staleness = self.get_option('snapshot_max_staleness')
 
-                self._set_composite_vars(
-                    self.get_option('compose'),
-                    self.inventory.get_host(host_name).get_vars(), host_name,
-                    strict)
+        # with --flush-cache the snapshot is still loaded to fall back on if Device42 fails
+        try:
+            snapshot = load_snapshot(snapshot_path, None, snapshot_key)
+        except UnsafeSnapshotError as e:
+            self.display.warning(str(e))
+            snapshot = None
+        age = time.time() - snapshot['timestamp'] if snapshot is not None else None
+        fresh = snapshot is not None and (not max_age or age <= max_age)
+        stale = snapshot is not None and not fresh and max_staleness and age <= max_staleness
+
+        if fresh and use_snapshot:
+            self.display.vv('Using the Device42 snapshot taken %.0f seconds ago' % age)
+            self.inventory_source = 'snapshot'
+            return self.get_snapshot_inventory(snapshot)
+
+        if stale and use_snapshot and self.get_option('snapshot_background_refresh'):
+            self.display.warning('Using the Device42 snapshot taken %.0f seconds ago, refreshing it in the background' % age)
+            self.start_snapshot_refresh(snapshot_path, snapshot_key)
+            self.inventory_source = 'stale_snapshot'
+            return self.get_snapshot_inventory(snapshot)
+
+        fallback = self.get_snapshot_inventory(snapshot) if fresh or stale else None
+        inventory = self.get_live_d42_inventory(fallback, 'fallback_snapshot')
+        if self.inventory_source == 'live':
+            self.save_inventory_snapshot(snapshot_path, inventory['Devices'], snapshot_key)
+
+        return inventory
+
+    def get_live_d42_inventory(self, fallback=None, fallback_source=None):
+        self.failed_queries = []
+        inventory = self.get_d42_inventory()
+
+        if self.failed_queries and fallback is not None:
+            self.display.warning('Device42 queries failed (%s), using the last good inventory (%s)' % (
+                ', '.join(self.failed_queries), fallback_source))
+            self.inventory_source = fallback_source
+            return fallback
+
+        self.check_failed_queries()
+        return inventory
+
+    def iter_live_d42_inventory(self):
+        self.failed_queries = []
+        for device in self.iter_d42_inventory():
+            yield device
+
+        # only known once every query ran, parse removes the hosts already added if this raises
+        self.check_failed_queries()
+
+    def check_failed_queries(self):
+        if not self.failed_queries:
+            self.inventory_source = 'live'
+            return
+
+        failed = ', '.join(self.failed_queries)
+        if any(label.startswith('Devices') for label in self.failed_queries):
+            # an empty inventory would make plays silently run against no hosts
+            raise AnsibleParserError('Failed to fetch the Device42 inventory, the %s queries failed' % failed)
+
+        self.display.warning('Device42 queries failed (%s), their fields are missing from the inventory' % failed)
+        self.inventory_source = 'partial'
+
+    def get_snapshot_inventory(self, snapshot):
+        # the snapshot key covers the fields, so the records have the current layout
+        return {
+            'total_count': len(snapshot['devices']),
+            'fields': self.get_record_fields(),
+            'Devices': snapshot['devices'],
+        }
+
+    def start_snapshot_refresh(self, snapshot_path, snapshot_key):
+        # a detached process, the run neither waits for it on exit nor forks its workers while it holds locks
+        request = {
+            'options': dict((option, self.get_option(option)) for option in self._options),
+            'snapshot_path': snapshot_path,
+            'snapshot_key': snapshot_key,
+        }
+        try:
+            refresh = subprocess.Popen([sys.executable, d42_refresh.__file__], stdin=subprocess.PIPE,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=True,
+                                       start_new_session=True)
+            try:
+                refresh.stdin.write(json.dumps(request).encode('utf-8'))
+            finally:
+                refresh.stdin.close()
+        except (IOError, OSError, TypeError, ValueError) as e:
+            self.display.warning('Failed to start refreshing the Device42 snapshot %s: %s' % (snapshot_path, e))
 
-                self._add_host_to_composed_groups(self.get_option('groups'), dict(), host_name, strict)
-                self._add_host_to_keyed_groups(self.get_option('keyed_groups'), dict(), host_name, strict)
+    def refresh_snapshot(self, snapshot_path, snapshot_key):
+        debug = self.get_option('debug')
+
+        self.failed_queries = []
+        try:
+            inventory = self.get_d42_inventory()
         except Exception as e:
-            print(e)
+            self.failed_queries.append(str(e))
+
+        if self.failed_queries:
+            if debug:
+                print('Refreshing the snapshot failed: ' + ', '.join(self.failed_queries))
+            return
+
+        self.save_inventory_snapshot(snapshot_path, inventory['Devices'], snapshot_key)
+        if debug:
+            print('Refreshed the snapshot ' + snapshot_path)
+
+    def save_inventory_snapshot(self, snapshot_path, devices, snapshot_key):
+        try:
+            save_snapshot(snapshot_path, devices, snapshot_key, self.get_option('snapshot_compress'))
+        except (IOError, OSError) as e:
+            self.display.warning('Failed to write the Device42 snapshot %s: %s' % (snapshot_path, e))
+
+    def get_http_session(self):
+        return get_session(self.get_option('pool_size'), self.get_option('retries'), self.get_option('retry_backoff'))
+
+    def get_rate_limiter(self):
+        return get_rate_limiter(self.get_option('url'), self.get_option('rate_limit'), self.get_option('rate_burst'),
+                                self.get_option('max_in_flight'))
+
+    def post_doql(self, query, stream=False):
+        with self.get_rate_limiter().request():
+            return self.get_http_session().post(self.get_option('url') + "/services/data/v1.0/query/",
+                                                data={'output_type': 'json', 'query': query},
+                                                auth=(self.get_option('username'), self.get_option('password')),
+                                                verify=self.get_option('ssl_check'), timeout=self.get_option('timeout'),
+                                                stream=stream)
 
     def get_doql_json(self, query):
-        base_url = self.get_option('url')
-        username = self.get_option('username')
-        password = self.get_option('password')
-        ssl_check = self.get_option('ssl_check')
-        debug = self.get_option('debug')
+        # the same query running in another thread, e.g. for another inventory source, is sent only once
+        key = (self.get_option('url'), self.get_option('username'), query)
+        return single_flight(key, partial(self.fetch_doql_json, query))
 
-        data = {'output_type': 'json', 'query': query}
+    def fetch_doql_json(self, query):
+        debug = self.get_option('debug')
+        metric = self.get_query_metric()
 
         try:
             # while there should be no timeout, ansible seems to get stuck sending requests without timeouts
-            response = requests.post(base_url + "/services/data/v1.0/query/", data=data,
-                                    auth=(username, password), verify=ssl_check, timeout=30)
+            start = time.perf_counter()
+            response = self.post_doql(query)
+            metric['latency_s'] = time.perf_counter() - start
+            metric['server_s'] = response.elapsed.total_seconds()
+            metric['bytes'] = received_bytes(response, len(response.content))
 
             status_code = response.status_code
 
@@ -156,7 +1088,9 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
                 # csv response to json object
                 if debug:
                     print('Response Status: ' + str(status_code))
+                start = time.perf_counter()
                 unformatted_d42_inventory = response.json()
+                metric['decode_s'] = time.perf_counter() - start
 
         except Exception as e:
             if debug:
@@ -165,278 +1099,481 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
         return unformatted_d42_inventory
 
+    def iter_doql_json(self, query):
+        debug = self.get_option('debug')
+        metric = self.get_query_metric()
+
+        # the timeout applies between bytes received, not to the whole download
+        start = time.perf_counter()
+        response = self.post_doql(query, stream=True)
+        metric['latency_s'] = time.perf_counter() - start
+        metric['server_s'] = response.elapsed.total_seconds()
+
+        def read_chunks():
+            decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+            chunks = response.iter_content(STREAM_CHUNK_SIZE)
+            received = 0
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                metric['latency_s'] += time.perf_counter() - start
+                if chunk is None:
+                    return
+                total = received_bytes(response, received + len(chunk))
+                metric['bytes'] += total - received
+                received = total
+                yield decoder.decode(chunk)
+
+        try:
+            if debug:
+                print('Response Status: ' + str(response.status_code))
+            response.raise_for_status()
+
+            # reading and decoding are interleaved, decoding is the time spent in the decoder minus the reads
+            rows = iter_json_array(read_chunks())
+            busy = metric['latency_s']
+            while True:
+                start = time.perf_counter()
+                row = next(rows, None)
+                busy += time.perf_counter() - start
+                if row is None:
+                    break
+                yield row
+            metric['decode_s'] = busy - metric['latency_s']
+        finally:
+            response.close()
+
+    def run_doql_query(self, query, conditions=None, stream=False, limit=None):
+        # every query selects from view_device_v1, so the filters apply to the child queries as well
+        query += self.where_clause(self.get_filter_conditions() + list(conditions or []))
+
+        if limit:
+            query += ' order by view_device_v1.device_pk limit %d' % limit
+
+        if stream:
+            return self.iter_doql_json(query)
+
+        return self.get_doql_json(query)
+
+    @staticmethod
+    def sql_quote(value):
+        return "'" + str(value).replace("'", "''") + "'"
+
+    @classmethod
+    def sql_value(cls, value):
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, (int, float)):
+            return repr(value)
+
+        return cls.sql_quote(value)
+
+    @classmethod
+    def sql_match(cls, expression, value):
+        if value is None:
+            return expression + ' is null'
+        if isinstance(value, (list, tuple)):
+            if not value:
+                return 'false'
+            return '%s in (%s)' % (expression, ', '.join(cls.sql_value(item) for item in value))
+
+        return '%s = %s' % (expression, cls.sql_value(value))
+
+    def get_filter_conditions(self):
+        conditions = []
+
+        for key, value in sorted((self.get_option('filters') or {}).items()):
+            if key == 'tags':
+                tags = value if isinstance(value, (list, tuple)) else [value]
+                conditions.append("regexp_split_to_array(view_device_v1.tags, '\\s*,\\s*') && array[%s]::text[]" %
+                                  ', '.join(self.sql_quote(tag) for tag in tags))
+            elif key == 'customer':
+                conditions.append('view_device_v1.customer_fk in (select customer_pk from view_customer_v1 where %s)' %
+                                  self.sql_match('name', value))
+            elif key == 'custom_fields':
+                if not isinstance(value, dict):
+                    raise AnsibleParserError('filters.custom_fields must be a dict of custom field keys to values')
+                for field_key, field_value in sorted(value.items()):
+                    conditions.append('exists (select 1 from view_device_custom_fields_v1 custom_field_filter '
+                                      'where custom_field_filter.device_fk = view_device_v1.device_pk '
+                                      'and custom_field_filter.key = %s and %s)' %
+                                      (self.sql_quote(field_key), self.sql_match('custom_field_filter.value', field_value)))
+            elif not FILTER_COLUMN.match(key):
+                raise AnsibleParserError('Invalid Device42 filter column: %s' % key)
+            elif isinstance(value, dict):
+                for operator, operand in sorted(value.items()):
+                    if operator not in FILTER_OPERATORS:
+                        raise AnsibleParserError('Invalid operator %s for Device42 filter %s, expected one of %s' %
+                                                 (operator, key, ', '.join(sorted(FILTER_OPERATORS))))
+                    conditions.append('view_device_v1.%s %s %s' % (key, FILTER_OPERATORS[operator], self.sql_value(operand)))
+            else:
+                conditions.append(self.sql_match('view_device_v1.' + key, value))
+
+        return conditions
+
+    @staticmethod
+    def where_clause(conditions):
+        if not conditions:
+            return ''
+
+        return ' where ' + ' and '.join('(' + condition + ')' for condition in conditions)
+
     def bool_to_yes_no(self, val):
-        if isinstance(val, bool) and val:
-            return 'yes'
+        return bool_to_yes_no(val)
 
-        return 'no'
+    def get_device_fields(self):
+        fields = set(self.get_option('fields') or ALL_DEVICE_FIELDS)
+        fields.difference_update(self.get_option('exclude_fields') or [])
 
-    def get_d42_inventory(self):
+        for key, (dataset, option) in CHILD_FIELDS.items():
+            if not self.get_option(option):
+                fields.discard(key)
 
-        debug = self.get_option('debug')
+        fields.update(REQUIRED_FIELDS)
+        if self.get_option('incremental'):
+            # the high-water mark is taken from last_updated
+            fields.add('last_updated')
 
-        # the final inventory that will be returned
-        inventory = {
-            'total_count': None,
-            'Devices': [],
-        }
+        return frozenset(fields & ALL_DEVICE_FIELDS)
 
-        # the dictionary below is used to build the json object
-        d42_inventory = {}
+    def run_timed_query(self, label, fetcher):
+        debug = self.get_option('debug')
 
-        # get all the items from device42 that will be used to build the json object
-        if debug:
-            print('Getting Devices')
-        d42_devices = self.get_devices()
         if debug:
-            print('Getting IPs')
-        d42_device_ips = self.get_ip_addresses()
-        if debug:
-            print('Getting MAC Addresses')
-        d42_device_mac_addresses = self.get_mac_addresses()
-        if debug:
-            print('Getting HDD Details')
-        d42_device_hdd_details = self.get_hdd_details()
+            print('Getting ' + label)
+
+        metric = new_query_metric(label)
+        self._metrics_local.metric = metric
+
+        start = time.time()
+        try:
+            result = fetcher()
+        except Exception as e:
+            # keep a failing query from taking the other datasets down with it
+            if debug:
+                print(e)
+            result = {}
+        finally:
+            self._metrics_local.metric = None
+
+        if not isinstance(result, (list, types.GeneratorType)):
+            # get_doql_json returns {} on errors and timeouts
+            self.failed_queries.append(label)
+            metric['failed'] = 1
+
+        if isinstance(result, types.GeneratorType):
+            # streamed rows are only fetched while they are consumed, time them until exhausted
+            return self.iter_timed_rows(label, result, metric)
+
         if debug:
-            print('Getting Device External Links')
-        d42_device_external_links = self.get_external_links()
+            print('Getting %s took %.2fs' % (label, time.time() - start))
+
+        metric['rows'] = len(result)
+        self.query_metrics.append(metric)
+        return result
+
+    def iter_timed_rows(self, label, rows, metric):
+        debug = self.get_option('debug')
+        start = time.time()
+        count = 0
+
+        # the request is sent by the first next(), in whichever thread consumes the rows
+        self._metrics_local.metric = metric
+        try:
+            for row in rows:
+                if count == 0:
+                    self._metrics_local.metric = None
+                count += 1
+                yield row
+        except Exception as e:
+            # same isolation as run_timed_query, the rows seen so far are kept
+            if debug:
+                print(e)
+            self.failed_queries.append(label)
+            metric['failed'] = 1
+        finally:
+            self._metrics_local.metric = None
+
         if debug:
-            print('Getting Device Entitlements')
-        d42_device_entitlements = self.get_device_entitlements()
+            print('Getting %s took %.2fs (%d rows)' % (label, time.time() - start, count))
+
+        metric['rows'] = count
+        self.query_metrics.append(metric)
+
+    def fetch_rows(self, label, fetcher):
+        return list(self.run_timed_query(label, fetcher))
+
+    def fetch_datasets(self, conditions=None, stream=False, devices=None):
+        queries = [
+            ('ip_addresses', 'IPs', partial(self.get_ip_addresses, conditions, stream)),
+            ('mac_addresses', 'MAC Addresses', partial(self.get_mac_addresses, conditions, stream)),
+            ('hdd_details', 'HDD Details', partial(self.get_hdd_details, conditions, stream)),
+            ('external_links', 'Device External Links', partial(self.get_external_links, conditions, stream)),
+            ('entitlements', 'Device Entitlements', partial(self.get_device_entitlements, conditions, stream)),
+            ('custom_fields', 'Custom Fields', partial(self.get_custom_fields, conditions, stream)),
+        ]
+
+        fields = self.get_device_fields()
+        if self.get_option('query_engine') == 'aggregated':
+            # the child collections are nested into the device rows
+            queries = []
+        queries = [query for query in queries if query[0] in
+                   [dataset for key, (dataset, option) in CHILD_FIELDS.items() if key in fields]]
+
+        if devices is None:
+            queries.insert(0, ('devices', 'Devices', partial(self.get_devices, conditions, stream)))
+
+        if not self.get_option('concurrent_fetch'):
+            # streamed datasets are returned as generators and consumed one at a time by the join loops
+            datasets = dict((name, self.run_timed_query(label, fetcher)) for name, label, fetcher in queries)
+            return self.fill_skipped_datasets(datasets, devices)
+
+        # concurrent queries have to be drained by their worker, streaming then only avoids holding the raw body
+        run = self.fetch_rows if stream else self.run_timed_query
+        workers = max(1, self.get_option('fetch_workers'))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict((name, executor.submit(run, label, fetcher))
+                           for name, label, fetcher in queries)
+            datasets = dict((name, future.result()) for name, future in futures.items())
+            return self.fill_skipped_datasets(datasets, devices)
+
+    @staticmethod
+    def fill_skipped_datasets(datasets, devices):
+        datasets.setdefault('devices', devices)
+        for dataset, option in CHILD_FIELDS.values():
+            datasets.setdefault(dataset, [])
+
+        return datasets
+
+    def fetch_device_page(self, after, page_size):
+        conditions = ['view_device_v1.device_pk > %d' % after] if after is not None else None
+        if self.get_option('debug'):
+            print('Devices page after %s' % after)
+
+        # one label for all pages so their metrics add up
+        return self.run_timed_query('Devices page', partial(self.get_devices, conditions, False, page_size))
+
+    def iter_paged_d42_inventory(self, page_size):
+        debug = self.get_option('debug')
+        stream = self.get_option('stream_results')
+
+        # only used to fetch the next page of devices while the current page's child queries run
+        executor = ThreadPoolExecutor(max_workers=1) if self.get_option('concurrent_fetch') else None
+
+        try:
+            next_page = partial(self.fetch_device_page, None, page_size)
+            if executor:
+                next_page = executor.submit(next_page).result
+
+            while True:
+                devices = next_page()
+                if not isinstance(devices, list):
+                    if debug:
+                        print('Fetching a page of devices failed, stopping')
+                    break
+                if not devices:
+                    break
+
+                device_ids = [device['device_pk'] for device in devices]
+                last_page = len(devices) < page_size
+
+                if not last_page:
+                    next_page = partial(self.fetch_device_page, max(device_ids), page_size)
+                    if executor:
+                        next_page = executor.submit(next_page).result
+
+                page_conditions = ['view_device_v1.device_pk between %d and %d' % (min(device_ids), max(device_ids))]
+                datasets = self.fetch_datasets(page_conditions, stream, devices=devices)
+                del devices
+                yield self.build_d42_inventory(datasets)
+
+                if last_page:
+                    break
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    def iter_d42_inventory(self):
+        """
+        Yield the device records as they are assembled, a page at a time with page_size. Each record is dropped from
+        the plugin once yielded, so a caller that does not keep them never holds the whole inventory.
+        """
+        page_size = self.get_option('page_size')
+        if page_size:
+            pages = self.iter_paged_d42_inventory(page_size)
+        else:
+            pages = iter([self.build_d42_inventory(self.fetch_datasets(stream=self.get_option('stream_results')))])
+
+        for page in pages:
+            for device_id in list(page):
+                yield page.pop(device_id)
+
+    def get_d42_inventory(self):
+        devices = list(self.iter_d42_inventory())
+
+        return {
+            'total_count': len(devices),
+            'fields': self.get_record_fields(),
+            'Devices': devices,
+        }
+
+    def get_incremental_d42_inventory(self, previous):
+        debug = self.get_option('debug')
+        now = time.time()
+
+        fields = self.get_record_fields()
+        id_position = fields.index('id')
+
+        if not self.has_record_layout(previous, fields):
+            previous = None
+
+        if not previous or not previous.get('high_water_mark') or \
+                now - previous.get('last_full_sync', 0) > self.get_option('full_refresh_interval'):
+            if debug:
+                print('Running full inventory sync')
+            inventory = self.get_live_d42_inventory(previous, 'cache')
+            if inventory is previous:
+                return previous
+            inventory['last_full_sync'] = now
+            inventory['high_water_mark'] = self.get_high_water_mark(fields, inventory['Devices'])
+            return inventory
+
+        high_water_mark = previous['high_water_mark']
         if debug:
-            print('Getting Custom Fields')
-        d42_device_custom_fields = self.get_custom_fields()
-
-        for device in d42_devices:
-
-            device_record = {}
-
-            device_record['datastores'] = device.get('datastores')
-            device_record['last_updated'] = device.get('last_edited')
-            device_record['ip_addresses'] = []
-            device_record['serial_no'] = device.get('serial_no')
-            device_record['hw_depth'] = device.get('hw_depth')
-            device_record['nonauthoritativealiases'] = str(device.get('nonauthoritativealiases')).split(',') if device.get('nonauthoritativealiases') is not None else []
-
-            device_record['service_level'] = device.get('service_level')
-            device_record['is_it_blade_host'] = self.bool_to_yes_no(device.get('blade_chassis'))
-            device_record['is_it_switch'] = self.bool_to_yes_no(device.get('network_device'))
-            device_record['virtual_subtype_id'] = device.get('virtual_subtype_id')
-            device_record['hw_size'] = device.get('hw_size')
-            device_record['id'] = device.get('device_pk')
-
-            # custom field
-            device_record['custom_fields'] = []
-
-            device_record['aliases'] = str(device.get('aliases')).split(',') if device.get('aliases') is not None else []
-            device_record['category'] = device.get('category')
-
-            # hdd details
-            device_record['hdd_details'] = []
-
-            device_record['uuid'] = device.get('uuid')
-            device_record['virtual_subtype'] = device.get('virtual_subtype')
-            device_record['cpuspeed'] = device.get('cpuspeed')
-            device_record['hw_model'] = device.get('hw_model')
-            device_record['osverno'] = device.get('os_version_no')
-            device_record['type'] = device.get('type')
-            device_record['hddcount'] = device.get('hard_disk_count')
-
-            # external links
-            device_record['device_external_links'] = []
-
-            device_record['tags'] = device.get('tags')
-            device_record['hw_model_id'] = device.get('hw_model_id')
-            device_record['in_service'] = device.get('in_service')
-            device_record['hddsize'] = device.get('disk_size')
-            device_record['hddsize_type'] = 'GB'
-
-            # mac addresses
-            device_record['mac_addresses'] = []
-
-            device_record['hddraid'] = device.get('hw_sw_raid')
-            device_record['corethread'] = device.get('corethread')
-            device_record['cpucount'] = device.get('cpucount')
-            device_record["virtual_host_name"] = device.get('virtual_host_name')
-            device_record["is_it_virtual_host"] = self.bool_to_yes_no(device.get('virtual_host'))
-            device_record["manufacturer"] = device.get('manufacturer')
-            device_record["customer"] = device.get('customer')
-            device_record["customer_id"] = device.get('customer_id')
-            device_record["ucs_manager"] = device.get('ucsmanager')
-            device_record["hddraid_type"] = device.get('raid_type')
-            device_record["name"] = device.get('name')
-            device_record["notes"] = device.get('notes')
-            device_record["ram"] = device.get('ram')
-            device_record["asset_no"] = device.get('asset_no')
-            device_record["osarch"] = device.get('os_arch')
-            device_record["osver"] = device.get('os_version_no')
-
-            # line items
-            device_record["device_purchase_line_items"] = []
-
-            device_record["cpucore"] = device.get('cpucore')
-            device_record["os"] = device.get('os_name')
-            device_record["device_id"] = device.get('device_pk')
+            print('Fetching devices edited since ' + high_water_mark)
 
-            # store the device in a dict for updates
-            d42_inventory[device['device_pk']] = device_record
+        # >= rather than > so devices edited in the same instant as the mark are not missed, merging is idempotent
+        self.failed_queries = []
+        datasets = self.fetch_datasets(['view_device_v1.last_edited >= ' + self.sql_quote(high_water_mark)])
+        device_ids = self.run_timed_query('Device IDs', self.get_device_ids)
 
-        for custom_field_record in d42_device_custom_fields:
-            device_id = custom_field_record.get('device_pk')
+        if self.failed_queries:
+            # keep the previous snapshot rather than merging partial data
+            self.display.warning('Device42 queries failed (%s), using the last good inventory (cache)' %
+                                 ', '.join(self.failed_queries))
+            self.inventory_source = 'cache'
+            return previous
 
-            if device_id in d42_inventory:
-                d42_inventory[device_id]['custom_fields'].append(
-                    {
-                        'key': custom_field_record.get('custom_field_key'),
-                        'value': custom_field_record.get('custom_field_value')
-                    }
-                )
+        self.inventory_source = 'live'
 
-        for hdd_detail_record in d42_device_hdd_details:
-            device_id = hdd_detail_record.get('device_pk')
-
-            if device_id in d42_inventory:
-                d42_inventory[device_id]['hdd_details'].append({
-                    "raid_group": hdd_detail_record.get('raid_group'),
-                    "serial_no": hdd_detail_record.get('hdd_serial_no'),
-                    "raid_type": hdd_detail_record.get('hdd_raid_type'),
-                    "hdd": {
-                        "description": hdd_detail_record.get('hdd_description'),
-                        "partno": hdd_detail_record.get('partno'),
-                        "rpm": {
-                            "id": hdd_detail_record.get('hdd_rpm_id'),
-                            "name": hdd_detail_record.get('hdd_rpm')
-                        },
-                        "notes": hdd_detail_record.get('hdd_notes'),
-                        "bytes": hdd_detail_record.get('hdd_bytes'),
-                        "location": hdd_detail_record.get('hdd_location'),
-                        "hd_id": hdd_detail_record.get('hdd_id'),
-                        "manufacturer_id": hdd_detail_record.get('manufactuerer_id'),
-                        "type": {
-                            "id": hdd_detail_record.get('hdd_type_id'),
-                            "name": hdd_detail_record.get('hdd_type_name')
-                        },
-                        "size": hdd_detail_record.get('size')
-                    },
-                    "part_id": hdd_detail_record.get('part_id'),
-                    "hddcount": hdd_detail_record.get('hddcount'),
-                    "description": hdd_detail_record.get('description')
-                })
-
-        for device_external_link_record in d42_device_external_links:
-            device_id = device_external_link_record.get('device_pk')
-
-            if device_id in d42_inventory:
-                d42_inventory[device_id]['device_external_links'].append(
-                    {
-                        'notes': device_external_link_record.get('device_url_notes'),
-                        'link': device_external_link_record.get('device_url')
-                    }
-                )
+        d42_inventory = dict((device[id_position], device) for device in previous['Devices'])
+        changed = self.build_d42_inventory(datasets)
+        d42_inventory.update(changed)
 
-        for device_mac_address_record in d42_device_mac_addresses:
+        live_ids = set(row.get('device_pk') for row in device_ids)
+        devices = [device for device_id, device in d42_inventory.items() if device_id in live_ids]
 
-            device_id = device_mac_address_record.get('device_pk')
+        if debug:
+            print('Merged %d changed devices, removed %d deleted devices' % (
+                len(changed), len(d42_inventory) - len(devices)))
+
+        return {
+            'total_count': len(devices),
+            'fields': fields,
+            'Devices': devices,
+            'last_full_sync': previous['last_full_sync'],
+            'high_water_mark': self.get_high_water_mark(fields, devices) or high_water_mark,
+        }
 
-            if device_id in d42_inventory:
-                d42_inventory[device_id]['mac_addresses'].append(
-                    {
-                        "mac": device_mac_address_record.get('mac'),
-                        "vlan": device_mac_address_record.get('vlan'),
-                        "port_name": device_mac_address_record.get('port_name'),
-                        "port": device_mac_address_record.get('port')
-                    }
-                )
+    @staticmethod
+    def get_high_water_mark(fields, devices):
+        position = fields.index('last_updated')
+        last_updated = [device[position] for device in devices if device[position]]
 
-        for device_entitlement_record in d42_device_entitlements:
-
-            device_id = device_entitlement_record.get('device_pk')
-
-            if device_id in d42_inventory:
-                d42_inventory[device_id]['device_purchase_line_items'].append(
-                    {
-                        "purchase_id": device_entitlement_record.get('purchase_id'),
-                        "line_start_date": device_entitlement_record.get('line_start_date'),
-                        "line_no": device_entitlement_record.get('line_no'),
-                        "line_renew_date": device_entitlement_record.get('line_renew_date'),
-                        "line_notes": device_entitlement_record.get('line_notes'),
-                        "line_quantity": device_entitlement_record.get('line_quantity'),
-                        "line_frequency": device_entitlement_record.get('line_frequency'),
-                        "line_cost": device_entitlement_record.get('line_cost'),
-                        "line_cancel_policy": device_entitlement_record.get('line_cancel_policy'),
-                        "line_item_type": device_entitlement_record.get('line_item_type'),
-                        "purchase_order_no": device_entitlement_record.get('purchase_order_no'),
-                        "line_type": device_entitlement_record.get('line_type'),
-                        "line_service_type": device_entitlement_record.get('line_service_type'),
-                        "line_end_date": device_entitlement_record.get('line_end_date'),
-                        "line_contract_type": device_entitlement_record.get('line_contract_type')
-                    }
-                )
+        return max(last_updated) if last_updated else None
 
-        for device_ip_record in d42_device_ips:
-            device_id = device_ip_record.get('device_pk')
-
-            if device_id in d42_inventory:
-                d42_inventory[device_id]['ip_addresses'].append(
-                    {
-                        "subnet_id": device_ip_record.get('subnet_id'),
-                        "ip": device_ip_record.get('ip'),
-                        "label": device_ip_record.get('label'),
-                        "type": device_ip_record.get('type'),
-                        "subnet": device_ip_record.get('subnet')
-                    }
-                )
+    @staticmethod
+    def has_record_layout(inventory, fields):
+        # inventories cached with other fields, or by a version storing dicts, cannot be used with the current records
+        return isinstance(inventory, dict) and inventory.get('fields') == fields
 
-        # now that the dictionary has been constructed, remove device id keys and keep value
-        # add additional imformation like total_count
+    def get_record_fields(self):
+        """The record keys in the order of the values of every device record."""
+        fields = self.get_device_fields()
+        return [key for key, column, convert in DEVICE_FIELDS if key in fields]
 
-        total_count = 0
-        for key, value in d42_inventory.items():
-            inventory['Devices'].append(value)
-            total_count += 1
+    def build_d42_inventory(self, datasets):
 
-        # update with the final device count
-        inventory['total_count'] = total_count
+        # the dictionary below is used to build the json object
+        d42_inventory = {}
 
-        return inventory
+        fields = self.get_device_fields()
+        aggregated = self.get_option('query_engine') == 'aggregated'
+        device_fields = [(key, key + '_agg', partial(compact_children, key)) if aggregated and key in CHILD_FIELDS
+                         else (key, column, convert) for key, column, convert in DEVICE_FIELDS if key in fields]
+        positions = dict((key, position) for position, (key, column, convert) in enumerate(device_fields))
 
+        # with stream_results the join times include receiving the rows
+        # every dataset is popped before it is joined, so its rows are released as soon as they have been read
+        start = time.perf_counter()
+        for device in datasets.pop('devices'):
 
-    def get_devices(self):
+            # a tuple of the values in get_record_fields order instead of a dict repeating the keys for every device
+            device_record = []
 
-        device_query = """
-            select
-            view_device_v1.*,
-            view_device_v1.customer_fk as customer_id,
-            customer.name as customer,
-            t_cost.cost,
-            view_vendor_v1.name as manufacturer,
-            view_hardware_v1.name as hw_model,
-            view_hardware_v1.hardware_pk as hw_model_id,
-            vendor.name as manufacturer,
-            view_hardware_v1.is_it_switch,
-            view_hardware_v1.is_it_blade_host,
-            view_hardware_v1.depth as hw_depth,
-            view_hardware_v1.size as hw_size,
-            vhost.name as virtual_host_name,
-            nonauthoritativealias.alias_names as nonauthoritativealiases,
-            alias.alias_names as aliases,
-            obj_category.name as category,
-            case
+            for key, column, convert in device_fields:
+                value = device.get(column) if column else None
+                device_record.append(convert(value) if convert else value)
+
+            # store the device in a dict for updates
+            d42_inventory[device['device_pk']] = tuple(device_record)
+        start = self.add_stage_time('join.devices', start)
+
+        for key in CHILD_JOINS:
+            dataset = CHILD_FIELDS[key][0]
+            if key in positions:
+                position = positions[key]
+                columns = CHILD_COLUMNS[key]
+
+                for child_record in datasets.pop(dataset):
+                    device_record = d42_inventory.get(child_record.get('device_pk'))
+
+                    if device_record is not None:
+                        device_record[position].append(tuple([child_record.get(column) for column in columns]))
+            start = self.add_stage_time('join.' + dataset, start)
+
+        return d42_inventory
+
+    def get_devices(self, conditions=None, stream=False, limit=None):
+        fields = self.get_device_fields()
+        projected = fields != ALL_DEVICE_FIELDS
+
+        # columns selected on top of view_device_v1.*: (select expression, record fields using it, joins it needs)
+        # columns no record field uses are only selected when the fields are not projected
+        columns = [
+            ("view_device_v1.customer_fk as customer_id", ('customer_id',), ()),
+            ("customer.name as customer", ('customer',), ('customer',)),
+            ("t_cost.cost", (), ('t_cost',)),
+            ("view_vendor_v1.name as manufacturer", (), ('hardware', 'view_vendor_v1')),
+            ("view_hardware_v1.name as hw_model", ('hw_model',), ('hardware',)),
+            ("view_hardware_v1.hardware_pk as hw_model_id", ('hw_model_id',), ('hardware',)),
+            ("vendor.name as manufacturer", ('manufacturer',), ('hardware', 'vendor')),
+            ("view_hardware_v1.is_it_switch", (), ('hardware',)),
+            ("view_hardware_v1.is_it_blade_host", (), ('hardware',)),
+            ("view_hardware_v1.depth as hw_depth", ('hw_depth',), ('hardware',)),
+            ("view_hardware_v1.size as hw_size", ('hw_size',), ('hardware',)),
+            ("vhost.name as virtual_host_name", ('virtual_host_name',), ('vhost',)),
+            ("nonauthoritativealias.alias_names as nonauthoritativealiases", ('nonauthoritativealiases',),
+             ('nonauthoritativealias',)),
+            ("alias.alias_names as aliases", ('aliases',), ('alias',)),
+            ("obj_category.name as category", ('category',), ('obj_category',)),
+            ("""case
                 WHEN view_device_v1.hz = 'MHz' and view_device_v1.cpupower is not null
                     THEN view_device_v1.cpupower / 1000
                 ELSE
                     view_device_v1.cpupower
-                END as cpuspeed,
-            case
+                END as cpuspeed""", ('cpuspeed',), ()),
+            ("""case
                 WHEN view_device_v1.ram_size_type = 'MB' and view_device_v1.ram is not null
                     THEN view_device_v1.ram / 1024
                 WHEN view_device_v1.ram_size_type = 'TB' and view_device_v1.ram is not null
                     THEN view_device_v1.ram * 1024
                 ELSE
                     view_device_v1.ram
-                END as ramsize,
-            network_ip.ip_address, network_hw.hwaddress,
-            CEIL(COALESCE(p.total_part_disk_size,
+                END as ramsize""", (), ()),
+            ("network_ip.ip_address", (), ('network_ip',)),
+            ("network_hw.hwaddress", (), ('network_hw',)),
+            ("""CEIL(COALESCE(p.total_part_disk_size,
                             CASE
                                 WHEN view_device_v1.hard_disk_count IS NOT NULL AND
                                      view_device_v1.hard_disk_size IS NOT NULL AND
@@ -453,31 +1590,126 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
                                                 NULL
                                         END
                                 ELSE NULL
-                            END)) AS disk_size
-            from view_device_v1
-            left join view_hardware_v1
-                on view_device_v1.hardware_fk = view_hardware_v1.hardware_pk
-            left join  (select view_ipaddress_v1.device_fk,  string_agg(host(view_ipaddress_v1.ip_address)::character varying, ', ' order by view_ipaddress_v1.ip_address) as ip_address from view_ipaddress_v1 group by view_ipaddress_v1.device_fk) network_ip
-                on view_device_v1.device_pk=network_ip.device_fk
-            left join (select device_fk, string_agg(view_netport_v1.hwaddress :: macaddr::character varying, ', ' order by view_netport_v1.hwaddress) as hwaddress from view_netport_v1 where view_netport_v1.hwaddress is null or (view_netport_v1.hwaddress is not null and LENGTH(view_netport_v1.hwaddress)=12)  group by view_netport_v1.device_fk) network_hw
-                on view_device_v1.device_pk=network_hw.device_fk
-            left join (select device_fk, sum(cost) as cost from view_purchaselineitem_v1 left join view_purchaselineitems_to_devices_v1 on purchaselineitem_fk = purchaselineitem_pk group by device_fk) t_cost
-                on t_cost.device_fk=device_pk
-            left join view_vendor_v1
-                on vendor_pk=vendor_fk
-            left join (select device_fk, string_agg(view_devicenonauthoritativealias_v1.alias_name, ', ' order by view_devicenonauthoritativealias_v1.alias_name) as alias_names from view_devicenonauthoritativealias_v1 group by view_devicenonauthoritativealias_v1.device_fk) nonauthoritativealias
-                on view_device_v1.device_pk=nonauthoritativealias.device_fk
-            left join (select device_fk, string_agg(view_devicealias_v1.alias_name, ', ' order by view_devicealias_v1.alias_name) as alias_names from view_devicealias_v1 group by view_devicealias_v1.device_fk) alias
-                on view_device_v1.device_pk=alias.device_fk
-            left join (select device_pk, name from view_device_v1) vhost
-                on view_device_v1.virtual_host_device_fk=vhost.device_pk
-            left join (select objectcategory_pk, name from view_objectcategory_v1) obj_category
-                on view_device_v1.objectcategory_fk = obj_category.objectcategory_pk
-            left join (select vendor_pk, name from view_vendor_v1) vendor
-                on view_hardware_v1.vendor_fk = vendor.vendor_pk
-            left join (select customer_pk, name from view_customer_v1) customer
-                on view_device_v1.customer_fk = customer.customer_pk
-            LEFT OUTER JOIN (
+                            END)) AS disk_size""", ('hddsize',), ('p',)),
+        ]
+
+        if self.get_option('query_engine') == 'aggregated':
+            # one correlated subquery per child dataset, building the same records as build_d42_inventory
+            aggregates = [
+                ('ip_addresses', """select json_agg(json_build_object(
+                    'subnet_id', ip_address.subnet_fk,
+                    'ip', ip_address.ip_address,
+                    'label', ip_address.label,
+                    'type', ip_address.type,
+                    'subnet', subnet.name))
+                from view_ipaddress_v1 ip_address
+                inner join view_subnet_v1 subnet
+                on ip_address.subnet_fk = subnet.subnet_pk
+                where ip_address.device_fk = view_device_v1.device_pk"""),
+                ('mac_addresses', """select json_agg(json_build_object(
+                    'mac', CASE
+                        WHEN length(TRIM(netport.hwaddress)) = 12
+                            THEN CONCAT_WS(':',left(TRIM(netport.hwaddress),2), substring(TRIM(netport.hwaddress),3,2), substring(TRIM(netport.hwaddress),5,2), substring(TRIM(netport.hwaddress),7,2), substring(TRIM(netport.hwaddress),9,2), right(TRIM(netport.hwaddress),2))
+                            ELSE
+                                netport.hwaddress
+                            END,
+                    'vlan', vlan.name,
+                    'port_name', netport.name,
+                    'port', netport.port))
+                from view_netport_v1 netport
+                left join view_vlan_v1 vlan
+                on vlan.vlan_pk = netport.primary_vlan_fk
+                where netport.device_fk = view_device_v1.device_pk"""),
+                ('hdd_details', """select json_agg(json_build_object(
+                    'raid_group', part.raid_group,
+                    'serial_no', part.serial_no,
+                    'raid_type', part.raid_type_name,
+                    'hdd', json_build_object(
+                        'description', partmodel.description,
+                        'partno', partmodel.partno,
+                        'rpm', json_build_object('id', partmodel.hdrpm_id, 'name', partmodel.hdrpm_name),
+                        'notes', partmodel.notes,
+                        'bytes', partmodel.hdsize_unit,
+                        'location', partmodel.location,
+                        'hd_id', partmodel.partmodel_pk,
+                        'manufacturer_id', partmodel.vendor_fk,
+                        'type', json_build_object('id', partmodel.hddtype_id, 'name', partmodel.hddtype_name),
+                        'size', partmodel.hdsize),
+                    'part_id', part.part_pk,
+                    'hddcount', part.pcount,
+                    'description', part.description))
+                from view_part_v1 part
+                inner join view_partmodel_v1 partmodel
+                on part.partmodel_fk = partmodel.partmodel_pk
+                where part.device_fk = view_device_v1.device_pk"""),
+                ('device_external_links', """select json_agg(json_build_object(
+                    'notes', deviceurl.notes,
+                    'link', deviceurl.device_url))
+                from view_deviceurl_v1 deviceurl
+                where deviceurl.device_fk = view_device_v1.device_pk"""),
+                ('device_purchase_line_items', """select json_agg(json_build_object(
+                    'purchase_id', line_items.purchase_fk,
+                    'line_start_date', line_items.start_date,
+                    'line_no', line_items.line_no,
+                    'line_renew_date', line_items.renew_date,
+                    'line_notes', line_items.notes,
+                    'line_quantity', line_items.quantity,
+                    'line_frequency', line_items.frequency,
+                    'line_cost', line_items.cost,
+                    'line_cancel_policy', line_items.cancel_policy,
+                    'line_item_type', line_items.item_type,
+                    'purchase_order_no', purchase.order_no,
+                    'line_type', line_items.line_type,
+                    'line_service_type', line_items.service_type_name,
+                    'line_end_date', line_items.end_date,
+                    'line_contract_type', line_items.contract_type_name))
+                from view_purchaselineitems_to_devices_v1 purchase_lineitem
+                inner join view_purchaselineitem_v1 line_items
+                on line_items.purchaselineitem_pk = purchase_lineitem.purchaselineitem_fk
+                inner join view_purchase_v1 purchase
+                on purchase.purchase_pk = line_items.purchase_fk
+                where purchase_lineitem.device_fk = view_device_v1.device_pk"""),
+                ('custom_fields', """select json_agg(json_build_object(
+                    'key', custom_field.key,
+                    'value', (CASE
+                        WHEN custom_field.type = 'Related Field'
+                            THEN (CASE
+                                    WHEN custom_field.related_model_name = 'endusers'
+                                    THEN (SELECT name FROM view_enduser_v1 WHERE view_enduser_v1.enduser_pk = custom_field.value :: int)
+                                    ELSE 'not available'
+                                    END)
+                        ELSE custom_field.value
+                        END)))
+                from view_device_custom_fields_v1 custom_field
+                where custom_field.device_fk = view_device_v1.device_pk"""),
+            ]
+            columns.extend(('(%s) as %s_agg' % (aggregate, key), (key,), ()) for key, aggregate in aggregates)
+
+        # in dependency order, vendor joins on view_hardware_v1
+        joins = [
+            ('hardware', """left join view_hardware_v1
+                on view_device_v1.hardware_fk = view_hardware_v1.hardware_pk"""),
+            ('network_ip', """left join  (select view_ipaddress_v1.device_fk,  string_agg(host(view_ipaddress_v1.ip_address)::character varying, ', ' order by view_ipaddress_v1.ip_address) as ip_address from view_ipaddress_v1 group by view_ipaddress_v1.device_fk) network_ip
+                on view_device_v1.device_pk=network_ip.device_fk"""),
+            ('network_hw', """left join (select device_fk, string_agg(view_netport_v1.hwaddress :: macaddr::character varying, ', ' order by view_netport_v1.hwaddress) as hwaddress from view_netport_v1 where view_netport_v1.hwaddress is null or (view_netport_v1.hwaddress is not null and LENGTH(view_netport_v1.hwaddress)=12)  group by view_netport_v1.device_fk) network_hw
+                on view_device_v1.device_pk=network_hw.device_fk"""),
+            ('t_cost', """left join (select device_fk, sum(cost) as cost from view_purchaselineitem_v1 left join view_purchaselineitems_to_devices_v1 on purchaselineitem_fk = purchaselineitem_pk group by device_fk) t_cost
+                on t_cost.device_fk=device_pk"""),
+            ('view_vendor_v1', """left join view_vendor_v1
+                on vendor_pk=vendor_fk"""),
+            ('nonauthoritativealias', """left join (select device_fk, string_agg(view_devicenonauthoritativealias_v1.alias_name, ', ' order by view_devicenonauthoritativealias_v1.alias_name) as alias_names from view_devicenonauthoritativealias_v1 group by view_devicenonauthoritativealias_v1.device_fk) nonauthoritativealias
+                on view_device_v1.device_pk=nonauthoritativealias.device_fk"""),
+            ('alias', """left join (select device_fk, string_agg(view_devicealias_v1.alias_name, ', ' order by view_devicealias_v1.alias_name) as alias_names from view_devicealias_v1 group by view_devicealias_v1.device_fk) alias
+                on view_device_v1.device_pk=alias.device_fk"""),
+            ('vhost', """left join (select device_pk, name from view_device_v1) vhost
+                on view_device_v1.virtual_host_device_fk=vhost.device_pk"""),
+            ('obj_category', """left join (select objectcategory_pk, name from view_objectcategory_v1) obj_category
+                on view_device_v1.objectcategory_fk = obj_category.objectcategory_pk"""),
+            ('vendor', """left join (select vendor_pk, name from view_vendor_v1) vendor
+                on view_hardware_v1.vendor_fk = vendor.vendor_pk"""),
+            ('customer', """left join (select customer_pk, name from view_customer_v1) customer
+                on view_device_v1.customer_fk = customer.customer_pk"""),
+            ('p', """LEFT OUTER JOIN (
                SELECT p.device_fk,
                  SUM(p.pcount *
                      CASE
@@ -500,13 +1732,47 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
                  INNER JOIN view_partmodel_v1 pm ON p.partmodel_fk = pm.partmodel_pk
                  WHERE pm.type_id = 3 AND pm.hdsize IS NOT NULL AND p.pcount > 0 AND p.device_fk IS NOT NULL
                  GROUP BY p.device_fk
-             ) AS p ON view_device_v1.device_pk = p.device_fk
+             ) AS p ON view_device_v1.device_pk = p.device_fk"""),
+        ]
+
+        # which base view columns exist varies between Device42 versions, all fields select them whole and listed
+        # fields only their own columns, plus those the pipeline keys the records and pages on
+        select = ['view_device_v1.*']
+        if projected:
+            computed = set(column_field for column, column_fields, column_joins in columns
+                           for column_field in column_fields)
+            base_columns = ['device_pk', 'name', 'last_edited']
+            base_columns.extend(column for key, column, convert in DEVICE_FIELDS
+                                if key in fields and column and key not in computed)
+            select = ['view_device_v1.%s' % column for column in OrderedDict.fromkeys(base_columns)]
+
+        needed_joins = set()
+        for column, column_fields, column_joins in columns:
+            if fields.intersection(column_fields) if column_fields else not projected:
+                select.append(column)
+                needed_joins.update(column_joins)
+
+        device_query = """
+            select
+            %s
+            from view_device_v1
+            %s
+        """ % (',\n            '.join(select),
+               '\n            '.join(join for name, join in joins if name in needed_joins))
+
+        return self.run_doql_query(device_query, conditions, stream, limit)
+
+    def get_device_ids(self, conditions=None, stream=False):
+        device_ids_query = """
+            select
+            view_device_v1.device_pk
+            from view_device_v1
         """
 
-        return self.get_doql_json(device_query)
+        return self.run_doql_query(device_ids_query, conditions, stream)
 
 
-    def get_custom_fields(self):
+    def get_custom_fields(self, conditions=None, stream=False):
 
         custom_field_query = """
                 select
@@ -529,10 +1795,10 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
                 on view_device_v1.device_pk = custom_field.device_fk
             """
 
-        return self.get_doql_json(custom_field_query)
+        return self.run_doql_query(custom_field_query, conditions, stream)
 
 
-    def get_external_links(self):
+    def get_external_links(self, conditions=None, stream=False):
         external_links_query = """
                 select
                 view_device_v1.device_pk,
@@ -543,10 +1809,10 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
                 inner join (select device_fk, device_url, notes as device_url_notes from view_deviceurl_v1) external_links
                 on view_device_v1.device_pk=external_links.device_fk
             """
-        return self.get_doql_json(external_links_query)
+        return self.run_doql_query(external_links_query, conditions, stream)
 
 
-    def get_hdd_details(self):
+    def get_hdd_details(self, conditions=None, stream=False):
         hdd_details_query = """
         select
         view_device_v1.device_pk,
@@ -576,10 +1842,10 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         on hdd_details.partmodel_id = hdd.hdd_id
         """
 
-        return self.get_doql_json(hdd_details_query)
+        return self.run_doql_query(hdd_details_query, conditions, stream)
 
 
-    def get_ip_addresses(self):
+    def get_ip_addresses(self, conditions=None, stream=False):
         ip_address_query = """
             select
             view_device_v1.device_pk,
@@ -595,9 +1861,9 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
             inner join (select subnet_pk, name from view_subnet_v1) subnet
             on ip_address.subnet_fk = subnet.subnet_pk
         """
-        return self.get_doql_json(ip_address_query)
+        return self.run_doql_query(ip_address_query, conditions, stream)
 
-    def get_mac_addresses(self):
+    def get_mac_addresses(self, conditions=None, stream=False):
         mac_addresses_query = """
             select
             view_device_v1.device_pk,
@@ -621,16 +1887,16 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
             ON vlan.vlan_pk = mac_address.primary_vlan_fk
         """
 
-        return self.get_doql_json(mac_addresses_query)
+        return self.run_doql_query(mac_addresses_query, conditions, stream)
 
 
-    def get_device_entitlements(self):
+    def get_device_entitlements(self, conditions=None, stream=False):
         # todo change parse method so it doesnt fail on non valid mac addresses, did this for FS mapping query
         device_entitlements_query = """
             Select
             view_device_v1.device_pk,
             view_device_v1.name as device_name,
-            line_items.purchase_fk as purhase_id,
+            line_items.purchase_fk as purchase_id,
             line_items.start_date as line_start_date,
             line_items.line_no,
             line_items.renew_date as line_renew_date,
@@ -669,5 +1935,5 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
             on purchase.purchase_pk = line_items.purchase_fk
         """
 
-        return self.get_doql_json(device_entitlements_query)
+        return self.run_doql_query(device_entitlements_query, conditions, stream)
 
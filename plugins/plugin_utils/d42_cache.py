@@ -0,0 +1,151 @@
+from __future__ import (absolute_import, division, print_function)
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from .d42_files import write_file
+
+__metaclass__ = type
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def make_key(*parts):
+    """Build a string cache key from JSON serializable parts without keeping them readable in persisted caches."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def normalize_query(query):
+    """Collapse whitespace outside of string literals so formatting differences do not defeat the cache."""
+    parts = query.split("'")
+    parts[::2] = [' '.join(part.split()) for part in parts[::2]]
+    return "'".join(parts).strip()
+
+
+def get_cache(path=None, max_size=None):
+    """Return the cache shared by every caller in this process for the given file, or an in-memory cache without one."""
+    key = (path, max_size)
+
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = PersistentTTLCache(path, max_size) if path else TTLCache(max_size)
+            _caches[key] = cache
+
+    return cache
+
+
+class TTLCache(object):
+    """
+    Thread safe in-memory cache, entries expire after the time to live they were stored with and the least
+    recently used entries are evicted once max_size is reached.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._get(key, default)
+
+    def _get(self, key, default=None):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            return default
+
+        if expires is not None and expires < time.time():
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._set(key, value, expires)
+
+    def _set(self, key, value, expires):
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+
+        if self.max_size is not None:
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class PersistentTTLCache(TTLCache):
+    """
+    TTLCache mirrored to a JSON file so entries are shared with other processes and survive between runs.
+    Keys must be strings and values JSON serializable.
+    """
+
+    def __init__(self, path, max_size=None):
+        super(PersistentTTLCache, self).__init__(max_size)
+        self.path = path
+        self._mtime = None
+
+        with self._lock:
+            self._load()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._get(key, default)
+            if value is default and self._changed_on_disk():
+                # another process may have stored it since the file was read
+                self._load()
+                value = self._get(key, default)
+
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            if self._changed_on_disk():
+                self._load()
+            self._set(key, value, expires)
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._save()
+
+    def _changed_on_disk(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self._mtime
+        except OSError:
+            return False
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        self._mtime = mtime
+
+        now = time.time()
+        for key, (expires, value) in entries.items():
+            if (expires is None or expires >= now) and key not in self._data:
+                self._set(key, value, expires)
+
+    def _save(self):
+        entries = dict((key, [expires, value]) for key, (expires, value) in self._data.items())
+        write_file(self.path, json.dumps(entries).encode('utf-8'), prefix='.d42_cache')
+
+        self._mtime = os.stat(self.path).st_mtime_ns
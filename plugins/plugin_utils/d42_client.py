@@ -0,0 +1,145 @@
+from __future__ import (absolute_import, division, print_function)
+import os
+import threading
+import time
+import requests
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+__metaclass__ = type
+
+# throttling and transient server errors, DOQL and password requests are read only so POST is safe to retry
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRY_METHODS = frozenset(['GET', 'POST'])
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def build_retry(retries, backoff_factor):
+    kwargs = dict(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUS_CODES, raise_on_status=False, respect_retry_after_header=True)
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=RETRY_METHODS, **kwargs)
+
+
+def get_session(pool_size=10, retries=3, backoff_factor=0.5):
+    """
+    Return a requests session shared by every caller in this process with the same settings.
+    Connections are pooled and kept alive between requests, and requests failing with a connection
+    error or a 429/5xx status are retried with exponential backoff.
+    """
+    # ansible forks its workers, a session must never be shared with a child process or both would read the same sockets
+    key = (os.getpid(), pool_size, retries, backoff_factor)
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                  max_retries=build_retry(retries, backoff_factor))
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _sessions[key] = session
+
+    return session
+
+
+class RateLimiter(object):
+    """
+    Token bucket letting through rate requests per second on average and up to burst at once, with at most
+    max_in_flight requests outstanding. A rate or max_in_flight of 0 disables that limit.
+    """
+
+    def __init__(self, rate=0, burst=1, max_in_flight=0):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight > 0 else None
+
+    def take_token(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    @contextmanager
+    def request(self):
+        if self.slots is not None:
+            self.slots.acquire()
+        try:
+            self.take_token()
+            yield
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+
+def get_rate_limiter(url, rate=0, burst=1, max_in_flight=0):
+    """Return the rate limiter shared by every caller in this process sending requests to url with the same limits."""
+    key = (os.getpid(), url.rstrip('/'), rate, burst, max_in_flight)
+
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(rate, burst, max_in_flight)
+
+    return limiter
+
+
+def single_flight(key, fetch):
+    """
+    Return fetch(), unless a call for the same key is already running in another thread of this process, in which
+    case wait for it and return its result, or raise its exception. The result is shared and must not be modified.
+    """
+    # a call in flight when ansible forked never finishes in the child, so keys are per process
+    key = (os.getpid(), key)
+
+    with _in_flight_lock:
+        call = _in_flight.get(key)
+        leader = call is None
+        if leader:
+            call = _in_flight[key] = {'done': threading.Event()}
+
+    if not leader:
+        call['done'].wait()
+        if 'error' in call:
+            raise call['error']
+        return call['value']
+
+    try:
+        call['value'] = fetch()
+        return call['value']
+    except Exception as e:
+        call['error'] = e
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+        call['done'].set()
@@ -0,0 +1,147 @@
+from __future__ import (absolute_import, division, print_function)
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import stat
+import time
+from contextlib import contextmanager
+from .d42_files import write_file
+
+__metaclass__ = type
+
+# errors of a non-blocking flock on a file locked by someone else
+LOCKED_ERRNOS = (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK)
+
+# seconds a result is kept past its ttl, callers waiting on its lock read it as soon as it is released
+RESULT_GRACE = 60
+
+
+class UnsafeDirectoryError(Exception):
+    pass
+
+
+def ensure_directory(directory):
+    """
+    Create directory only accessible by the current user, or check that an existing one is. Results read back from it
+    are returned as lookup results, so a directory another user could write to is refused with UnsafeDirectoryError.
+    """
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as e:
+        # another fork created it first
+        if e.errno != errno.EEXIST:
+            raise
+
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        raise UnsafeDirectoryError('Refusing the coordination directory %s, it must be a directory owned by the current '
+                                   'user with mode 0700' % directory)
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """Hold an exclusive flock on path, yields False instead of waiting when not blocking and it is taken."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except (IOError, OSError) as e:
+            if blocking or e.errno not in LOCKED_ERRNOS:
+                raise
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def request_slot(directory, url, max_concurrent, poll_interval=0.05):
+    """
+    Wait for one of max_concurrent request slots to the Device42 instance at url, shared by every process and thread
+    using the same directory. Slots are lock files, the lock of a process that dies is released by the kernel.
+    Does nothing without a directory or a limit.
+    """
+    if not directory or not max_concurrent or max_concurrent <= 0:
+        yield
+        return
+
+    ensure_directory(directory)
+    prefix = os.path.join(directory, 'slot-%s-' % hashlib.sha256(url.encode('utf-8')).hexdigest()[:16])
+    delay = poll_interval
+
+    while True:
+        for slot in range(max_concurrent):
+            with file_lock('%s%d.lock' % (prefix, slot), blocking=False) as locked:
+                if locked:
+                    yield
+                    return
+
+        time.sleep(delay)
+        delay = min(delay * 2, 0.25)
+
+
+def read_result(path, requested_at, ttl):
+    try:
+        with open(path) as f:
+            result = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    # finished after this caller asked for it, so it was in flight at the same time, or still fresh enough to reuse
+    if result['finished_at'] >= requested_at or ttl > 0 and time.time() - result['finished_at'] <= ttl:
+        return result
+    return None
+
+
+def write_result(path, value):
+    write_file(path, json.dumps({'finished_at': time.time(), 'value': value}).encode('utf-8'), prefix='.d42_result')
+
+
+def remove_expired_results(directory, ttl):
+    expired = time.time() - max(ttl, RESULT_GRACE)
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+
+        try:
+            path = os.path.join(directory, name)
+            if os.lstat(path).st_mtime < expired:
+                os.unlink(path)
+        except OSError:
+            # removed by another fork meanwhile
+            pass
+
+
+def coalesce(directory, key, ttl, fetch):
+    """
+    Return fetch() for the string key, fetching it at most once at a time across all processes using directory.
+    Callers arriving while another process fetches the same key wait for it and reuse its result, which is then kept
+    for ttl seconds. The result must be JSON serializable, and is stored in directory only readable by its owner.
+    Each fetch also removes the results of the directory that expired.
+    """
+    ensure_directory(directory)
+    result_path = os.path.join(directory, key + '.json')
+    requested_at = time.time()
+
+    result = read_result(result_path, requested_at, ttl)
+    if result is not None:
+        return result['value']
+
+    with file_lock(os.path.join(directory, key + '.lock')):
+        # the process that held the lock may have fetched it meanwhile
+        result = read_result(result_path, requested_at, ttl)
+        if result is not None:
+            return result['value']
+
+        value = fetch()
+        write_result(result_path, value)
+
+    remove_expired_results(directory, ttl)
+    return value
@@ -0,0 +1,73 @@
+from __future__ import (absolute_import, division, print_function)
+import json
+import socket
+from http.client import HTTPConnection, HTTPException
+from urllib.parse import quote, urlencode, urlparse
+
+__metaclass__ = type
+
+# the daemon proxies DOQL queries on the same path as Device42, so clients only swap the address they post to
+DOQL_PATH = '/services/data/v1.0/query/'
+
+
+class DaemonError(Exception):
+    pass
+
+
+class UnixHTTPConnection(HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def daemon_request(daemon_url, path, data=None, timeout=30):
+    """
+    Send a request to the inventory daemon at daemon_url, http://host:port or unix:///path/to/socket, a POST of the
+    form encoded data when given, and return the response for the caller to read and close.
+    Raises DaemonError when the daemon cannot be reached or does not answer 200.
+    """
+    parsed = urlparse(daemon_url)
+    if parsed.scheme == 'unix':
+        connection = UnixHTTPConnection(parsed.path, timeout)
+    elif parsed.scheme == 'http':
+        connection = HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+    else:
+        raise DaemonError('Unsupported daemon url %s, expected http://host:port or unix:///path/to/socket' % daemon_url)
+
+    try:
+        if data is None:
+            connection.request('GET', path)
+        else:
+            connection.request('POST', path, urlencode(data), {'Content-Type': 'application/x-www-form-urlencoded'})
+        response = connection.getresponse()
+    except (IOError, OSError, HTTPException) as e:
+        connection.close()
+        raise DaemonError('Cannot reach the inventory daemon at %s: %s' % (daemon_url, e))
+
+    if response.status != 200:
+        response.close()
+        raise DaemonError('The inventory daemon at %s answered %d %s to %s' % (daemon_url, response.status,
+                                                                               response.reason, path))
+
+    return response
+
+
+def get_daemon_json(daemon_url, path, timeout=30):
+    response = daemon_request(daemon_url, path, timeout=timeout)
+    try:
+        return json.loads(response.read().decode('utf-8'))
+    except (IOError, OSError, HTTPException, ValueError) as e:
+        raise DaemonError('Failed to read %s from the inventory daemon at %s: %s' % (path, daemon_url, e))
+    finally:
+        response.close()
+
+
+def host_path(host_name):
+    return '/host/' + quote(host_name, safe='')
@@ -0,0 +1,53 @@
+from __future__ import (absolute_import, division, print_function)
+import hashlib
+import os
+import tempfile
+
+__metaclass__ = type
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    except (IOError, OSError):
+        return None
+
+    return digest.hexdigest()
+
+
+def write_file(path, data, mode=None, prefix='.d42'):
+    """
+    Write the bytes data to path through a temporary file in the same directory renamed over it, so readers never see
+    a partial file. The file is only readable by its owner unless a mode is given.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # mkstemp creates the file with mode 0600
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=prefix)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def replace_file(path, content, mode=0o644, prefix='.d42'):
+    """
+    Write the text content to path like write_file, returns False without touching the file when it already has this
+    content.
+    """
+    data = content.encode('utf-8')
+    if file_digest(path) == hashlib.sha256(data).hexdigest():
+        return False
+
+    write_file(path, data, mode, prefix)
+    return True
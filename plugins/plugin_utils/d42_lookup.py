@@ -0,0 +1,208 @@
+from __future__ import (absolute_import, division, print_function)
+from ansible.errors import AnsibleError
+from ansible.plugins.lookup import LookupBase
+from ansible.utils.display import Display
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from collections import OrderedDict
+import json
+import csv
+import io
+import os
+
+from .d42_cache import TTLCache, get_cache, make_key, normalize_query
+from .d42_client import get_rate_limiter, get_session, single_flight
+from .d42_coordination import UnsafeDirectoryError, coalesce, request_slot
+from .d42_daemon import DOQL_PATH, DaemonError, daemon_request
+
+__metaclass__ = type
+
+display = Display()
+
+# memory only, passwords are never written to disk. Each forked worker has its own, so it only helps repeated
+# lookups within a task, the bulk lookup with set_fact is how passwords are reused across hosts
+password_cache = TTLCache()
+
+
+def get_lookup_conf(url, user, password):
+    return {
+        'D42_URL': url,
+        'D42_USER': user,
+        'D42_PWD': password,
+        'D42_POOL_SIZE': int(os.environ.get('D42_POOL_SIZE', 10)),
+        'D42_RETRIES': int(os.environ.get('D42_RETRIES', 3)),
+        'D42_RETRY_BACKOFF': float(os.environ.get('D42_RETRY_BACKOFF', 0.5)),
+        'D42_PASSWORD_CACHE_TTL': int(os.environ.get('D42_PASSWORD_CACHE_TTL', 300)),
+        'D42_PASSWORD_WORKERS': int(os.environ.get('D42_PASSWORD_WORKERS', 10)),
+        'D42_DOQL_CACHE_TTL': int(os.environ.get('D42_DOQL_CACHE_TTL', 60)),
+        'D42_DOQL_CACHE_SIZE': int(os.environ.get('D42_DOQL_CACHE_SIZE', 128)),
+        'D42_DOQL_CACHE_PATH': os.environ.get('D42_DOQL_CACHE_PATH'),
+        'D42_COORDINATION_DIR': os.path.expanduser(os.environ.get('D42_COORDINATION_DIR', '')),
+        'D42_MAX_CONCURRENT_REQUESTS': int(os.environ.get('D42_MAX_CONCURRENT_REQUESTS', 0)),
+        'D42_RATE_LIMIT': float(os.environ.get('D42_RATE_LIMIT', 0)),
+        'D42_RATE_BURST': int(os.environ.get('D42_RATE_BURST', 1)),
+        'D42_MAX_IN_FLIGHT': int(os.environ.get('D42_MAX_IN_FLIGHT', 0)),
+        'D42_DAEMON_URL': os.environ.get('D42_DAEMON_URL')
+    }
+
+
+class D42LookupBase(LookupBase):
+
+    @staticmethod
+    def get_list_from_csv(text):
+        f = io.StringIO(text)
+        output_list = []
+        dict_reader = csv.DictReader(f, quotechar='"', delimiter=',', quoting=csv.QUOTE_ALL, skipinitialspace=True,
+                                     dialect='excel')
+        for item in dict_reader:
+            output_list.append(item)
+
+        if len(output_list) == 1:
+            output_list = [output_list, ]
+
+        return output_list
+
+    def run_lookup(self, conf, target, lookup_type, argument):
+        try:
+            if lookup_type == "password":
+                # only doql lookups go through the inventory daemon
+                if not (conf['D42_URL'] and conf['D42_USER'] and conf['D42_PWD']):
+                    raise AnsibleError("Password lookups need D42_URL, D42_USER and D42_PWD, "
+                                       "the inventory daemon only serves doql lookups")
+                if isinstance(target, (list, tuple)):
+                    return self.get_user_passes(conf, target, argument)
+                return self.get_user_pass(conf, target, argument)
+            elif lookup_type == "doql":
+                return self.run_doql(conf, target, argument)
+        except UnsafeDirectoryError as e:
+            raise AnsibleError(str(e))
+
+    @staticmethod
+    def get_http_session(conf):
+        return get_session(conf['D42_POOL_SIZE'], conf['D42_RETRIES'], conf['D42_RETRY_BACKOFF'])
+
+    @staticmethod
+    @contextmanager
+    def request_slot(conf):
+        # the limits of this process first, a slot shared with the other forks is only held while sending
+        limiter = get_rate_limiter(conf['D42_URL'], conf['D42_RATE_LIMIT'], conf['D42_RATE_BURST'],
+                                   conf['D42_MAX_IN_FLIGHT'])
+        with limiter.request():
+            with request_slot(conf['D42_COORDINATION_DIR'], conf['D42_URL'], conf['D42_MAX_CONCURRENT_REQUESTS']):
+                yield
+
+    def get_user_pass(self, conf, device, username):
+        password = self.fetch_password(conf, device, username)
+
+        if password is None:
+            raise AnsibleError("No password found for user: %s and device: %s" % (username, device))
+
+        return [password]
+
+    def get_user_passes(self, conf, devices, username):
+        devices = list(OrderedDict.fromkeys(devices))
+
+        with ThreadPoolExecutor(max_workers=max(1, conf['D42_PASSWORD_WORKERS'])) as executor:
+            passwords = list(executor.map(lambda device: self.fetch_password(conf, device, username), devices))
+
+        missing = [device for device, password in zip(devices, passwords) if password is None]
+        if missing:
+            display.warning("No password found for user: %s and devices: %s" % (username, ', '.join(missing)))
+
+        return [dict((device, password) for device, password in zip(devices, passwords) if password is not None)]
+
+    def fetch_password(self, conf, device, username):
+        cache_key = (conf['D42_URL'], conf['D42_USER'], device, username)
+        password = password_cache.get(cache_key)
+        if password is not None:
+            return password
+
+        url = conf['D42_URL'] + "/api/1.0/passwords/?plain_text=yes&device=" + device + "&username=" + username
+        with self.request_slot(conf):
+            resp = self.get_http_session(conf).request("GET",
+                                                        url,
+                                                        auth=(conf['D42_USER'], conf['D42_PWD']),
+                                                        verify=False)
+
+        if resp.status_code != 200:
+            raise AnsibleError("API Call failed with status code: " + str(resp.status_code))
+        if not resp.text:
+            raise AnsibleError("Something went wrong!")
+
+        req = json.loads(resp.text)
+        req = req["Passwords"]
+        if not req:
+            return None
+        if len(req) > 1:
+            raise AnsibleError("Multiple users found for device: %s" % device)
+
+        password = req[0]["password"]
+        if conf['D42_PASSWORD_CACHE_TTL'] > 0:
+            password_cache.set(cache_key, password, conf['D42_PASSWORD_CACHE_TTL'])
+
+        return password
+
+    def run_doql(self, conf, query, output_type):
+        query = query.replace("@", "'")
+        ttl = conf['D42_DOQL_CACHE_TTL']
+        cache_key = make_key(conf['D42_DAEMON_URL'] or conf['D42_URL'], conf['D42_USER'], normalize_query(query),
+                             output_type)
+
+        if ttl <= 0:
+            return list(self.coalesce_doql(conf, cache_key, query, output_type))
+
+        cache = get_cache(conf['D42_DOQL_CACHE_PATH'], conf['D42_DOQL_CACHE_SIZE'])
+
+        result = cache.get(cache_key)
+        if result is None:
+            result = self.coalesce_doql(conf, cache_key, query, output_type)
+            cache.set(cache_key, result, ttl)
+
+        return list(result)
+
+    def coalesce_doql(self, conf, cache_key, query, output_type):
+        # threads running the same query at the same time share a single request
+        fetch = partial(single_flight, cache_key, partial(self.fetch_doql, conf, query, output_type))
+        if not conf['D42_COORDINATION_DIR']:
+            return fetch()
+
+        # and so do forks
+        return coalesce(conf['D42_COORDINATION_DIR'], cache_key, conf['D42_DOQL_CACHE_TTL'], fetch)
+
+    def fetch_doql(self, conf, query, output_type):
+        post_data = {
+            "query": query,
+            "header": 'yes' if output_type == 'list_dicts' else 'no'
+        }
+
+        if conf['D42_DAEMON_URL']:
+            text = self.fetch_daemon_doql(conf, post_data)
+        else:
+            url = conf['D42_URL'] + DOQL_PATH
+            with self.request_slot(conf):
+                resp = self.get_http_session(conf).request("POST", url, auth=(conf['D42_USER'], conf['D42_PWD']), data=post_data,
+                                                            verify=False)
+
+            if resp.status_code != 200:
+                raise AnsibleError("API Call failed with status code: " + str(resp.status_code))
+            text = resp.text
+
+        if output_type == 'string':
+            return [text.replace('\n', ''), ]
+        elif output_type == 'list':
+            return text.split('\n')
+
+        return self.get_list_from_csv(text)
+
+    @staticmethod
+    def fetch_daemon_doql(conf, post_data):
+        # a local request, the daemon applies the rate limits and caches the result for every fork
+        try:
+            response = daemon_request(conf['D42_DAEMON_URL'], DOQL_PATH, post_data)
+            try:
+                return response.read().decode('utf-8')
+            finally:
+                response.close()
+        except (DaemonError, IOError, OSError) as e:
+            raise AnsibleError("DOQL query through the inventory daemon failed: %s" % e)
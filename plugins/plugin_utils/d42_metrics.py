@@ -0,0 +1,81 @@
+from __future__ import (absolute_import, division, print_function)
+import json
+from collections import OrderedDict
+from .d42_files import write_file
+
+__metaclass__ = type
+
+# per query measurement: (prometheus metric suffix, help text)
+QUERY_METRICS = OrderedDict([
+    ('latency_s', ('query_seconds', 'Time from sending a DOQL query until its response was read.')),
+    ('server_s', ('query_server_seconds', 'Time until the response headers arrived, as measured by requests.')),
+    ('decode_s', ('query_decode_seconds', 'Time spent decoding the JSON response.')),
+    ('bytes', ('query_bytes', 'Bytes of response body received, before decompression.')),
+    ('rows', ('query_rows', 'Rows returned by the query.')),
+    ('requests', ('query_requests', 'Number of requests sent for the query, more than one when paging.')),
+    ('failed', ('query_failures', 'Number of requests of the query that failed.')),
+])
+
+
+def new_query_metric(label):
+    return {'query': label, 'latency_s': 0.0, 'server_s': 0.0, 'decode_s': 0.0, 'bytes': 0, 'rows': 0,
+            'requests': 1, 'failed': 0}
+
+
+def summarize_queries(queries):
+    """Sum the measurements of requests sharing a label, e.g. the pages of a paged inventory."""
+    summary = OrderedDict()
+    for metric in queries:
+        total = summary.setdefault(metric['query'], dict((key, 0) for key in QUERY_METRICS))
+        for key in QUERY_METRICS:
+            total[key] += metric.get(key) or 0
+
+    return summary
+
+
+def format_report(report):
+    lines = ['Device42 inventory: %d hosts from %s' % (report['hosts'], report['source'])]
+    lines.extend('  %-26s %8.3fs' % (stage, seconds) for stage, seconds in report['stages'].items())
+    for label, metric in summarize_queries(report['queries']).items():
+        lines.append('  %-26s %8.3fs server %.3fs decode %.3fs %10d bytes %8d rows%s' % (
+            label, metric['latency_s'], metric['server_s'], metric['decode_s'], metric['bytes'], metric['rows'],
+            ' (%d failed)' % metric['failed'] if metric['failed'] else ''))
+
+    return '\n'.join(lines)
+
+
+def format_prometheus(report, prefix='d42_inventory_'):
+    """Render the report in the Prometheus text exposition format, for the node_exporter textfile collector."""
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    lines = []
+
+    def gauge(name, help_text, samples):
+        lines.append('# HELP %s%s %s' % (prefix, name, help_text))
+        lines.append('# TYPE %s%s gauge' % (prefix, name))
+        for labels, value in samples:
+            label_text = ','.join('%s="%s"' % (key, escape(val)) for key, val in labels)
+            lines.append('%s%s%s %s' % (prefix, name, '{%s}' % label_text if label_text else '', repr(float(value))))
+
+    gauge('last_run_timestamp_seconds', 'When the inventory was last built.', [((), report['timestamp'])])
+    gauge('hosts', 'Hosts added to the inventory.', [((('source', report['source']),), report['hosts'])])
+    gauge('groups', 'Groups in the inventory.', [((), report['groups'])])
+    gauge('stage_seconds', 'Time spent in each stage of building the inventory.',
+          [((('stage', stage),), seconds) for stage, seconds in report['stages'].items()])
+
+    summary = summarize_queries(report['queries'])
+    for key, (name, help_text) in QUERY_METRICS.items():
+        gauge(name, help_text, [((('query', label),), metric[key]) for label, metric in summary.items()])
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path, report, metrics_format='json'):
+    if metrics_format == 'prometheus':
+        content = format_prometheus(report)
+    else:
+        content = json.dumps(report, indent=2, sort_keys=True)
+
+    # collectors may read the file at any time
+    write_file(path, content.encode('utf-8'), 0o644, '.d42_metrics')
@@ -0,0 +1,63 @@
+"""
+Refresh the snapshot of a device42.d42.d42 inventory source in a process of its own. The inventory plugin starts it
+detached when it serves a stale snapshot, so the Ansible run neither waits for Device42 nor forks while requests are
+in flight. The plugin options, snapshot path and key are read from stdin as JSON, a refresh already running for the
+same snapshot makes it exit right away.
+"""
+from __future__ import (absolute_import, division, print_function)
+import fcntl
+import json
+import os
+import sys
+
+__metaclass__ = type
+
+# .../ansible_collections/device42/d42/plugins/plugin_utils/d42_refresh.py
+COLLECTIONS_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', '..'))
+
+
+def lock_refresh(snapshot_path):
+    """An exclusive lock on the lock file next to the snapshot, None when another refresh holds it."""
+    fd = os.open(snapshot_path + '.lock', os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def load_plugin(options):
+    from ansible.plugins import loader
+
+    if hasattr(loader, 'init_plugin_loader'):
+        loader.init_plugin_loader([COLLECTIONS_ROOT])
+    else:
+        # ansible-core < 2.15
+        loader._configure_collection_loader()
+
+    plugin = loader.inventory_loader.get('device42.d42.d42')
+    plugin.set_options(direct=options)
+    plugin.reset_metrics()
+    plugin.inventory_source = None
+
+    return plugin
+
+
+def main():
+    request = json.load(sys.stdin)
+    snapshot_path = request['snapshot_path']
+
+    lock = lock_refresh(snapshot_path)
+    if lock is None:
+        return
+
+    try:
+        load_plugin(request['options']).refresh_snapshot(snapshot_path, request['snapshot_key'])
+    finally:
+        os.close(lock)
+
+
+if __name__ == '__main__':
+    main()
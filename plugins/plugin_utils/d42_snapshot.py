@@ -0,0 +1,89 @@
+from __future__ import (absolute_import, division, print_function)
+import gc
+import gzip
+import os
+import pickle
+import stat
+import time
+from .d42_files import write_file
+
+__metaclass__ = type
+
+SNAPSHOT_SCHEMA_VERSION = 2
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class UnsafeSnapshotError(Exception):
+    pass
+
+
+def save_snapshot(path, devices, key=None, compress=False):
+    """
+    Atomically write the devices to path with the schema version, a timestamp and the key of the settings they were
+    fetched with. The file is only readable by its owner, snapshots are pickles and must never come from untrusted users.
+    """
+    data = pickle.dumps({
+        'schema_version': SNAPSHOT_SCHEMA_VERSION,
+        'timestamp': time.time(),
+        'key': key,
+        'devices': devices,
+    }, protocol=pickle.HIGHEST_PROTOCOL)
+
+    if compress:
+        # level 1, the snapshot is rewritten on every refresh and most of the gain is in the first level
+        data = gzip.compress(data, compresslevel=1)
+
+    write_file(path, data, prefix='.d42_snapshot')
+
+
+def load_snapshot(path, max_age=None, key=None):
+    """
+    Return the snapshot stored at path, or None when it is missing, unreadable, older than max_age seconds, written by
+    another schema version or for another key.
+    Raises UnsafeSnapshotError when the file is not owned by the current user or is writable by others, unpickling it
+    would run whatever code they put in it.
+    """
+    try:
+        # non blocking, a fifo planted at path would otherwise hang the open
+        f = os.fdopen(os.open(path, os.O_RDONLY | os.O_NONBLOCK), 'rb')
+    except (IOError, OSError):
+        return None
+
+    try:
+        # checked on the opened file, a file swapped in after the check is not the one read
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise UnsafeSnapshotError('Refusing the snapshot %s, it must be a file owned by the current user and '
+                                      'not writable by others' % path)
+
+        data = f.read()
+    except (IOError, OSError):
+        return None
+    finally:
+        f.close()
+
+    try:
+        if data[:2] == GZIP_MAGIC:
+            data = gzip.decompress(data)
+
+        # unpickling allocates millions of containers, the cyclic collector would otherwise run over and over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            snapshot = pickle.loads(data)
+        finally:
+            if gc_enabled:
+                gc.enable()
+    except Exception:
+        return None
+
+    if not isinstance(snapshot, dict) or snapshot.get('schema_version') != SNAPSHOT_SCHEMA_VERSION:
+        return None
+
+    if snapshot.get('key') != key:
+        return None
+
+    if max_age is not None and time.time() - snapshot['timestamp'] > max_age:
+        return None
+
+    return snapshot
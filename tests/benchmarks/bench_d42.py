@@ -0,0 +1,312 @@
+"""
+Benchmark the inventory plugin, the lookups and the contrib scripts against the local Device42 stand-in in
+d42_mock_server.py, reporting wall time, peak RSS and per stage timings.
+
+Every scenario runs in its own process, so peak RSS is that of the scenario alone, and a mock server is started per
+estate size. The collection has to be importable, either run it from a checkout located at
+.../ansible_collections/device42/d42 or point ANSIBLE_COLLECTIONS_PATH at the directory containing ansible_collections:
+
+    python tests/benchmarks/bench_d42.py --devices 1000 10000 100000 --latency 0.05
+    python tests/benchmarks/bench_d42.py --devices 10000 --scenarios inventory inventory-aggregated --json results.json
+
+The daemon scenarios read from contrib/inventory/d42_inventory_daemon.py, started once the mock server is up and
+measured after its first sync, as Ansible runs see it once it is warm.
+
+Compare a --json output with an earlier one to catch regressions.
+"""
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import inspect
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import urlopen
+
+__metaclass__ = type
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(BENCH_DIR, '..', '..'))
+COLLECTIONS_ROOT = os.path.abspath(os.path.join(REPO_ROOT, '..', '..', '..'))
+COLLECTIONS_PATH = os.environ.get('ANSIBLE_COLLECTIONS_PATH', COLLECTIONS_ROOT)
+
+# keyed_groups of the keyed groups scenarios, as commonly grouped on
+KEYED_GROUPS = [
+    {'key': 'd42_service_level', 'prefix': 'sl'},
+    {'key': 'd42_customer', 'prefix': 'customer'},
+    {'key': 'd42_os', 'prefix': 'os'},
+    {'key': 'd42_tags', 'prefix': 'tags'},
+    {'key': 'd42_category', 'prefix': 'category', 'default_value': 'none'},
+]
+
+# scenario name: plugin options on top of url and credentials
+INVENTORY_SCENARIOS = {
+    'inventory': {},
+    'inventory-concurrent': {'concurrent_fetch': True},
+    'inventory-stream': {'stream_results': True},
+    'inventory-paged': {'page_size': 5000, 'concurrent_fetch': True},
+    'inventory-aggregated': {'query_engine': 'aggregated'},
+    'inventory-fields': {'fields': ['name', 'ip_addresses', 'service_level', 'os', 'tags']},
+    'inventory-keyed-groups': {'keyed_groups': KEYED_GROUPS},
+    'inventory-keyed-groups-templated': {'keyed_groups': KEYED_GROUPS, 'native_keyed_groups': False},
+    'inventory-daemon': {'source': 'daemon'},
+}
+OTHER_SCENARIOS = ['contrib-dynamic', 'contrib-dynamic-daemon', 'contrib-hostfile', 'lookup-doql', 'lookup-password',
+                   'lookup-password-bulk']
+SCENARIOS = list(INVENTORY_SCENARIOS) + OTHER_SCENARIOS
+DAEMON_SCENARIOS = frozenset(['inventory-daemon', 'contrib-dynamic-daemon'])
+
+# password lookups are one request each, more than this many only measures the latency
+MAX_PASSWORD_LOOKUPS = 200
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+class Stages(object):
+    """Accumulates the time spent in wrapped methods, calls nested in an already timed stage are counted in both."""
+
+    def __init__(self):
+        self.timings = {}
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def wrap(self, owner, method, name=None):
+        original = getattr(owner, method)
+        stages = self
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                stages.add(name or method, time.perf_counter() - start)
+
+        if isinstance(inspect.getattr_static(owner, method), staticmethod):
+            timed = staticmethod(timed)
+        setattr(owner, method, timed)
+
+
+def init_collections():
+    os.environ['ANSIBLE_COLLECTIONS_PATH'] = COLLECTIONS_PATH
+    sys.path[:0] = COLLECTIONS_PATH.split(os.pathsep)
+
+    from ansible.plugins import loader
+    if hasattr(loader, 'init_plugin_loader'):
+        loader.init_plugin_loader(COLLECTIONS_PATH.split(os.pathsep))
+    else:
+        # ansible-core < 2.15
+        loader._configure_collection_loader()
+
+
+def run_inventory(url, devices, stages, options):
+    init_collections()
+    from ansible.inventory.manager import InventoryManager
+    from ansible.parsing.dataloader import DataLoader
+    from ansible_collections.device42.d42.plugins.inventory.d42 import InventoryModule
+
+    stages.wrap(InventoryModule, 'fetch_datasets', 'fetch')
+    stages.wrap(InventoryModule, 'build_d42_inventory', 'join')
+    stages.wrap(InventoryModule, 'parse')
+
+    report_metrics = InventoryModule.report_metrics
+
+    def report_stages(plugin, hosts):
+        # taken from the plugin, the devices can be assembled while parse adds the hosts
+        stages.add('fetch_and_build', plugin.stage_timings.get('fetch', 0.0))
+        stages.add('hosts_and_groups', sum(plugin.stage_timings.get(stage, 0.0)
+                                           for stage in ('hosts', 'compose', 'groups', 'keyed_groups')))
+        stages.add('keyed_groups', plugin.stage_timings.get('keyed_groups', 0.0))
+        return report_metrics(plugin, hosts)
+
+    InventoryModule.report_metrics = report_stages
+
+    config = dict(plugin='device42.d42.d42', url=url, username='admin', password='password', ssl_check=False,
+                  keyed_groups=[{'key': 'd42_service_level', 'prefix': 'sl'}])
+    config.update(options)
+    fd, path = tempfile.mkstemp(suffix='.d42.yml')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(config, f)
+
+    try:
+        inventory = InventoryManager(loader=DataLoader(), sources=[path])
+    finally:
+        os.unlink(path)
+
+    return len(inventory.hosts)
+
+
+def run_contrib(url, devices, stages, write_file, use_daemon=False):
+    sys.path.insert(0, REPO_ROOT)
+    from contrib.inventory.lib import Ansible, Device42
+
+    # the rows are parsed while grouping consumes them, fetch only covers the request until the headers
+    stages.wrap(Device42, 'fetcher', 'fetch')
+    stages.wrap(Ansible, 'get_grouping', 'parse_and_group')
+
+    conf = {
+        'D42_URL': url, 'D42_USER': 'admin', 'D42_PWD': 'password',
+        'GROUP_BY_QUERY': 'select name, service_level from view_device_v1',
+        'GROUP_BY_FIELD': 'service_level', 'GROUP_BY_REFERENCE_FIELD': 'name', 'SPLIT_GROUP_BY_COMMA': '',
+        'D42_DAEMON_URL': os.environ['D42_DAEMON_URL'] if use_daemon else None,
+    }
+    ansible = Ansible(conf)
+    fields, rows = Device42(conf).doql()
+    hostvars = {}
+    groups, children = ansible.get_grouping(fields, rows, None if write_file else hostvars)
+
+    if write_file:
+        # the hostfile script writes ./hosts
+        cwd = os.getcwd()
+        directory = tempfile.mkdtemp()
+        os.chdir(directory)
+        try:
+            start = time.perf_counter()
+            ansible.write_inventory_file(groups, children)
+            stages.add('write_file', time.perf_counter() - start)
+            os.unlink('hosts')
+        finally:
+            os.chdir(cwd)
+            os.rmdir(directory)
+    else:
+        start = time.perf_counter()
+        groups['_meta'] = {'hostvars': hostvars}
+        json.dumps(groups)
+        stages.add('dump_json', time.perf_counter() - start)
+
+    return sum(len(hosts) for name, hosts in groups.items() if name != '_meta')
+
+
+def run_lookup(url, devices, stages, mode):
+    os.environ.update({'D42_URL': url, 'D42_USER': 'admin', 'D42_PWD': 'password',
+                       # measure the requests, not the caches
+                       'D42_DOQL_CACHE_TTL': '0', 'D42_PASSWORD_CACHE_TTL': '0'})
+    init_collections()
+    from ansible_collections.device42.d42.plugins.lookup.d42 import LookupModule
+
+    lookup = LookupModule()
+    names = ['host-%06d.example.com' % n for n in range(1, min(devices, MAX_PASSWORD_LOOKUPS) + 1)]
+
+    if mode == 'doql':
+        stages.wrap(LookupModule, 'get_list_from_csv', 'parse_csv')
+        start = time.perf_counter()
+        rows = lookup.run(['select name, service_level, os_name from view_device_v1', 'doql', 'list_dicts'])
+        stages.add('lookup', time.perf_counter() - start)
+        return len(rows)
+
+    start = time.perf_counter()
+    if mode == 'password':
+        # one lookup per host, as a play evaluating the lookup in host vars does
+        passwords = [lookup.run([name, 'password', 'root'])[0] for name in names]
+    else:
+        passwords = list(lookup.run([names, 'password', 'root'])[0].values())
+    stages.add('lookup', time.perf_counter() - start)
+    return len(passwords)
+
+
+def run_scenario(scenario, url, devices):
+    stages = Stages()
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+
+    if scenario in INVENTORY_SCENARIOS:
+        items = run_inventory(url, devices, stages, INVENTORY_SCENARIOS[scenario])
+    elif scenario.startswith('contrib-'):
+        items = run_contrib(url, devices, stages, scenario == 'contrib-hostfile', scenario in DAEMON_SCENARIOS)
+    else:
+        items = run_lookup(url, devices, stages, {'lookup-doql': 'doql', 'lookup-password': 'password',
+                                                  'lookup-password-bulk': 'password-bulk'}[scenario])
+
+    return {
+        'scenario': scenario,
+        'devices': devices,
+        'items': items,
+        'wall_s': time.perf_counter() - start,
+        'peak_rss_mb': peak_rss_mb(),
+        'baseline_rss_mb': baseline,
+        'stages_s': stages.timings,
+    }
+
+
+def start_server(devices, latency):
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'd42_mock_server.py'), '--devices', str(devices),
+                               '--latency', str(latency)], stdout=subprocess.PIPE, universal_newlines=True)
+    return server, server.stdout.readline().strip()
+
+
+def start_daemon(url):
+    fd, path = tempfile.mkstemp(suffix='.d42.yml')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(dict(plugin='device42.d42.d42', url=url, username='admin', password='password', ssl_check=False), f)
+
+    env = dict(os.environ, ANSIBLE_COLLECTIONS_PATH=COLLECTIONS_PATH)
+    daemon = subprocess.Popen([sys.executable, '-m', 'contrib.inventory.d42_inventory_daemon', '--config', path,
+                               '--listen', '0'], cwd=REPO_ROOT, env=env, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True)
+    try:
+        # printed once the configuration was read
+        daemon_url = daemon.stdout.readline().strip()
+    finally:
+        os.unlink(path)
+    if not daemon_url:
+        sys.exit('The inventory daemon did not start, is the collection importable?')
+
+    while json.loads(urlopen(daemon_url + '/status').read().decode('utf-8'))['refreshed_at'] is None:
+        time.sleep(0.2)
+
+    return daemon, daemon_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the mock server adds to every request')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--run', nargs=3, metavar=('SCENARIO', 'URL', 'DEVICES'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # child process, the result is the last line of stdout
+        print(json.dumps(run_scenario(args.run[0], args.run[1], int(args.run[2]))))
+        return
+
+    results = []
+    print('%-22s %8s %8s %9s %9s  %s' % ('scenario', 'devices', 'items', 'wall s', 'peak MB', 'stages s'))
+    for devices in args.devices:
+        server, url = start_server(devices, args.latency)
+        daemon = None
+        try:
+            if DAEMON_SCENARIOS.intersection(args.scenarios):
+                daemon, os.environ['D42_DAEMON_URL'] = start_daemon(url)
+
+            for scenario in args.scenarios:
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run', scenario, url,
+                                                  str(devices)], universal_newlines=True)
+                result = json.loads(output.strip().splitlines()[-1])
+                results.append(result)
+                print('%-22s %8d %8d %9.2f %9.1f  %s' % (
+                    scenario, devices, result['items'], result['wall_s'], result['peak_rss_mb'],
+                    ' '.join('%s=%.2f' % item for item in sorted(result['stages_s'].items()))))
+                sys.stdout.flush()
+        finally:
+            if daemon:
+                daemon.terminate()
+                daemon.wait()
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'latency': args.latency, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
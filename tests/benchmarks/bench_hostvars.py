@@ -0,0 +1,98 @@
+"""
+Compare the per host cost of loading the d42_ hostvars with one set_variable call per key (the previous parse loop)
+against the bulk loader used by the inventory plugin.
+
+The collection has to be importable, either run it from a checkout located at .../ansible_collections/device42/d42
+or point ANSIBLE_COLLECTIONS_PATH at the directory containing ansible_collections:
+
+    python tests/benchmarks/bench_hostvars.py --hosts 40000
+"""
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import os
+import sys
+import time
+
+__metaclass__ = type
+
+COLLECTIONS_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', '..'))
+sys.path[:0] = os.environ.get('ANSIBLE_COLLECTIONS_PATH', COLLECTIONS_ROOT).split(os.pathsep)
+
+from ansible.inventory.data import InventoryData  # noqa: E402
+from ansible_collections.device42.d42.plugins.inventory.d42 import CHILD_PATHS, InventoryModule, compact_children  # noqa: E402
+
+
+def make_device(i):
+    # same shape as a record built by get_d42_inventory, ~60 keys with a few child lists
+    device = dict(('field_%02d' % n, 'value %d' % n) for n in range(50))
+    device.update({
+        'name': 'host-%d' % i,
+        'id': i,
+        'device_id': i,
+        'service_level': 'Production',
+        'ip_addresses': [{'ip': '10.0.%d.%d' % (i // 250 % 250, i % 250), 'subnet': 'lan', 'label': '', 'type': 1,
+                          'subnet_id': 1}],
+        'mac_addresses': [{'mac': 'aa:bb:cc:dd:ee:ff', 'port': 'eth0', 'port_name': 'eth0', 'vlan': None}],
+        'custom_fields': [{'key': 'owner', 'value': 'ops'}],
+        'hdd_details': [],
+        'device_external_links': [],
+        'device_purchase_line_items': [],
+    })
+    return device
+
+
+def make_record(device):
+    # the compact record get_d42_inventory keeps instead of the dict
+    return tuple(compact_children(key, value) if key in CHILD_PATHS else value for key, value in device.items())
+
+
+def per_key(inventory, devices):
+    for device in devices:
+        host_name = inventory.add_host(device['name'])
+        for k in device.keys():
+            inventory.set_variable(host_name, 'd42_' + k, device[k])
+        if device['ip_addresses']:
+            inventory.set_variable(host_name, 'ansible_host', device['ip_addresses'][0]['ip'])
+        # previously get_vars() ran once for compose and again inside each group helper
+        for dummy in range(3):
+            inventory.get_host(host_name).get_vars()
+
+
+def bulk(inventory, devices):
+    plugin = InventoryModule()
+    plugin.inventory = inventory
+    fields = list(devices[0])
+    records = [make_record(device) for device in devices]
+    name_position = fields.index('name')
+
+    start = time.time()
+    for record in records:
+        host_name = inventory.add_host(record[name_position])
+        host = plugin.set_host_variables(host_name, plugin.get_host_variables(fields, record))
+        host.get_vars()
+    return start
+
+
+def run(label, loader, devices):
+    inventory = InventoryData()
+    start = time.time()
+    # a loader preparing its input returns when it started loading
+    start = loader(inventory, devices) or start
+    elapsed = time.time() - start
+    print('%-8s %8.2fs total %8.1fus per host' % (label, elapsed, elapsed / len(devices) * 1e6))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=10000)
+    args = parser.parse_args()
+
+    devices = [make_device(i) for i in range(args.hosts)]
+    before = run('per key', per_key, devices)
+    after = run('bulk', bulk, devices)
+    print('speedup  %8.1fx' % (before / after))
+
+
+if __name__ == '__main__':
+    main()
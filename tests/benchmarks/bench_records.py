@@ -0,0 +1,95 @@
+"""
+Compare the memory held by the device records of get_d42_inventory, tuples of values in get_record_fields order with
+child records as tuples, against one dict per device and per child record (the previous layout).
+
+The values are created before measuring and shared by both layouts, so only the containers are compared. The
+collection has to be importable, either run it from a checkout located at .../ansible_collections/device42/d42 or
+point ANSIBLE_COLLECTIONS_PATH at the directory containing ansible_collections:
+
+    python tests/benchmarks/bench_records.py --devices 100000
+"""
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+__metaclass__ = type
+
+COLLECTIONS_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', '..'))
+sys.path[:0] = os.environ.get('ANSIBLE_COLLECTIONS_PATH', COLLECTIONS_ROOT).split(os.pathsep)
+
+from ansible_collections.device42.d42.plugins.inventory.d42 import (  # noqa: E402
+    CHILD_COLUMNS, CHILD_PATHS, DEVICE_FIELDS, expand_child)
+
+# child records per device
+CHILDREN = {
+    'ip_addresses': 2,
+    'mac_addresses': 2,
+    'hdd_details': 2,
+    'device_external_links': 1,
+    'device_purchase_line_items': 1,
+    'custom_fields': 3,
+}
+
+
+def make_rows(count):
+    """The values of every device and child record, as the join loops read them from the query rows."""
+    rows = []
+    for i in range(count):
+        device = [None if key in CHILD_PATHS else '%s %d' % (key, i) for key, column, convert in DEVICE_FIELDS]
+        children = dict((key, [['%s %d %d' % (column, i, n) for column in CHILD_COLUMNS[key]]
+                               for n in range(CHILDREN[key])]) for key in CHILD_PATHS)
+        rows.append((device, children))
+
+    return rows
+
+
+def build_records(rows):
+    records = []
+    for device, children in rows:
+        records.append(tuple([[tuple(child) for child in children[key]] if key in CHILD_PATHS else value
+                              for (key, column, convert), value in zip(DEVICE_FIELDS, device)]))
+
+    return records
+
+
+def build_dicts(rows):
+    devices = []
+    for device, children in rows:
+        devices.append(dict((key, [expand_child(CHILD_PATHS[key], child) for child in children[key]]
+                             if key in CHILD_PATHS else value)
+                            for (key, column, convert), value in zip(DEVICE_FIELDS, device)))
+
+    return devices
+
+
+def measure(label, build, rows):
+    gc.collect()
+    tracemalloc.start()
+    start = time.time()
+    result = build(rows)
+    elapsed = time.time() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+
+    print('%-8s %9.1f MB %8d bytes per device %7.2fs' % (label, size / 1048576.0, size // len(rows), elapsed))
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=10000)
+    args = parser.parse_args()
+
+    rows = make_rows(args.devices)
+    before = measure('dicts', build_dicts, rows)
+    after = measure('records', build_records, rows)
+    print('saving   %9.1f MB (%.1fx smaller)' % ((before - after) / 1048576.0, float(before) / after))
+
+
+if __name__ == '__main__':
+    main()
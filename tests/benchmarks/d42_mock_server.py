@@ -0,0 +1,365 @@
+"""
+Local stand-in for the Device42 DOQL (/services/data/v1.0/query/) and password (/api/1.0/passwords/) APIs, serving
+a synthetic estate so the inventory plugin, the lookups and the contrib scripts can be benchmarked offline.
+
+Rows are generated per device from its device_pk, so any slice of the estate is the same on every request and
+nothing is kept in memory. The query text is only inspected as much as the plugin needs: which dataset is asked for,
+the device_pk range and limit used by paging, last_edited for incremental runs and the json_agg columns of the
+aggregated engine. Other WHERE conditions are ignored.
+
+    python tests/benchmarks/d42_mock_server.py --devices 10000 --latency 0.05 --port 8942
+"""
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import csv
+import io
+import json
+import random
+import re
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+__metaclass__ = type
+
+SERVICE_LEVELS = ['Production', 'QA', 'Development', 'Staging']
+OPERATING_SYSTEMS = ['Ubuntu', 'CentOS', 'Windows Server', 'Debian']
+CUSTOMERS = ['Acme', 'Globex', 'Initech', 'Umbrella']
+
+
+def device_random(device_pk, salt=0):
+    return random.Random(device_pk * 7919 + salt)
+
+
+def make_device(device_pk):
+    rnd = device_random(device_pk)
+    return {
+        'device_pk': device_pk,
+        'name': 'host-%06d.example.com' % device_pk,
+        'serial_no': 'SN%08d' % device_pk,
+        'uuid': '00000000-0000-4000-8000-%012d' % device_pk,
+        'type': rnd.choice(['physical', 'virtual', 'cluster']),
+        'service_level': rnd.choice(SERVICE_LEVELS),
+        'os_name': rnd.choice(OPERATING_SYSTEMS),
+        'os_version': str(rnd.randint(6, 22)),
+        'os_version_no': '%d.%d' % (rnd.randint(1, 9), rnd.randint(0, 20)),
+        'tags': ','.join(rnd.sample(['web', 'db', 'cache', 'batch', 'edge', 'pci'], rnd.randint(0, 3))),
+        'in_service': rnd.random() > 0.05,
+        'last_edited': '2024-%02d-%02dT%02d:00:00' % (rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23)),
+        'customer': rnd.choice(CUSTOMERS),
+        'customer_id': rnd.randint(1, len(CUSTOMERS)),
+        'hw_model': 'Model %d' % rnd.randint(1, 40),
+        'hw_model_id': rnd.randint(1, 40),
+        'manufacturer': rnd.choice(['Dell', 'HPE', 'Lenovo', 'VMware']),
+        'hw_depth': rnd.randint(1, 3),
+        'hw_size': rnd.randint(1, 4),
+        'cpucount': rnd.choice([1, 2, 4]),
+        'cpucore': rnd.choice([4, 8, 16, 32]),
+        'corethread': rnd.choice([1, 2]),
+        'cpuspeed': rnd.choice([2000, 2400, 3100]),
+        'ram': rnd.choice([4096, 16384, 65536]),
+        'ramsize': rnd.choice([4, 16, 64]),
+        'hard_disk_count': rnd.randint(0, 8),
+        'disk_size': rnd.choice([None, 500, 1000, 4000]),
+        'hw_sw_raid': rnd.choice([None, 'Hardware', 'Software']),
+        'virtual_host': rnd.random() < 0.1,
+        'virtual_host_name': None,
+        'virtual_subtype': rnd.choice([None, 'VMware', 'KVM']),
+        'virtual_subtype_id': None,
+        'network_device': False,
+        'blade_chassis': False,
+        'category': rnd.choice([None, 'Compute', 'Storage']),
+        'aliases': None,
+        'nonauthoritativealiases': None,
+        'datastores': None,
+        'notes': 'synthetic device %d' % device_pk,
+        'asset_no': 'A%06d' % device_pk,
+        'cost': rnd.choice([None, 1200.0, 4500.0]),
+        'ip_address': None,
+        'hwaddress': None,
+    }
+
+
+def make_ips(device_pk):
+    rnd = device_random(device_pk, 1)
+    return [{
+        'device_pk': device_pk,
+        'name': 'host-%06d.example.com' % device_pk,
+        'subnet_id': n + 1,
+        'ip': '10.%d.%d.%d' % (n, device_pk // 256 % 256, device_pk % 256),
+        'label': 'eth%d' % n,
+        'type': 1,
+        'subnet': '10.%d.0.0/16' % n,
+    } for n in range(rnd.randint(1, 4))]
+
+
+def make_macs(device_pk):
+    rnd = device_random(device_pk, 2)
+    return [{
+        'device_pk': device_pk,
+        'device_name': 'host-%06d.example.com' % device_pk,
+        'mac': ':'.join('%02x' % b for b in (0x52, 0x54, n, device_pk >> 16 & 255, device_pk >> 8 & 255, device_pk & 255)),
+        'port_name': 'eth%d' % n,
+        'port': str(n),
+        'vlan': rnd.choice([None, 'vlan10', 'vlan20']),
+    } for n in range(rnd.randint(1, 4))]
+
+
+def make_hdds(device_pk):
+    rnd = device_random(device_pk, 3)
+    return [{
+        'device_pk': device_pk,
+        'device_name': 'host-%06d.example.com' % device_pk,
+        'raid_group': 'rg%d' % (n // 2),
+        'hdd_serial_no': 'HD%08d%02d' % (device_pk, n),
+        'hdd_raid_type': 'RAID1',
+        'hdd_description': 'SAS disk',
+        'partno': 'P-%d' % rnd.randint(100, 999),
+        'hdd_rpm': '10000',
+        'hdd_rpm_id': 2,
+        'hdd_notes': None,
+        'hdd_bytes': 'GB',
+        'hdd_location': None,
+        'hdd_id': rnd.randint(1, 50),
+        'manufactuerer_id': rnd.randint(1, 10),
+        'hdd_type_id': 1,
+        'hdd_type_name': 'SAS',
+        'size': rnd.choice([300, 600, 1200]),
+        'part_id': device_pk * 10 + n,
+        'hddcount': 1,
+        'description': None,
+    } for n in range(rnd.randint(0, 8))]
+
+
+def make_links(device_pk):
+    rnd = device_random(device_pk, 4)
+    if rnd.random() > 0.1:
+        return []
+    return [{
+        'device_pk': device_pk,
+        'device_name': 'host-%06d.example.com' % device_pk,
+        'device_url': 'https://monitoring.example.com/host/%d' % device_pk,
+        'device_url_notes': 'monitoring',
+    }]
+
+
+def make_entitlements(device_pk):
+    rnd = device_random(device_pk, 5)
+    if rnd.random() > 0.05:
+        return []
+    return [{
+        'device_pk': device_pk,
+        'device_name': 'host-%06d.example.com' % device_pk,
+        'purchase_id': rnd.randint(1, 100),
+        'line_start_date': '2023-01-01',
+        'line_no': 1,
+        'line_renew_date': None,
+        'line_notes': None,
+        'line_quantity': 1,
+        'line_frequency': 'yearly',
+        'line_cost': 250.0,
+        'line_cancel_policy': None,
+        'line_item_type': 'device',
+        'purchase_order_no': 'PO-%d' % rnd.randint(1000, 9999),
+        'line_type': 'contract',
+        'line_service_type': 'support',
+        'line_end_date': '2025-01-01',
+        'line_contract_type': 'warranty',
+    }]
+
+
+def make_custom_fields(device_pk):
+    rnd = device_random(device_pk, 6)
+    return [{
+        'device_pk': device_pk,
+        'name': 'host-%06d.example.com' % device_pk,
+        'custom_field_key': key,
+        'custom_field_value': '%s-%d' % (key, rnd.randint(1, 20)),
+    } for key in ['owner', 'environment', 'backup', 'patch_window', 'cost_center', 'rack'][:rnd.randint(3, 6)]]
+
+
+# nested records in the shape build_d42_inventory produces, for the json_agg columns of the aggregated engine
+AGGREGATES = {
+    'ip_addresses_agg': lambda pk: [dict((k, row[k]) for k in ('subnet_id', 'ip', 'label', 'type', 'subnet'))
+                                    for row in make_ips(pk)],
+    'mac_addresses_agg': lambda pk: [dict((k, row[k]) for k in ('mac', 'vlan', 'port_name', 'port'))
+                                     for row in make_macs(pk)],
+    'hdd_details_agg': lambda pk: [{
+        'raid_group': row['raid_group'], 'serial_no': row['hdd_serial_no'], 'raid_type': row['hdd_raid_type'],
+        'hdd': {'description': row['hdd_description'], 'partno': row['partno'],
+                'rpm': {'id': row['hdd_rpm_id'], 'name': row['hdd_rpm']}, 'notes': row['hdd_notes'],
+                'bytes': row['hdd_bytes'], 'location': row['hdd_location'], 'hd_id': row['hdd_id'],
+                'manufacturer_id': row['manufactuerer_id'],
+                'type': {'id': row['hdd_type_id'], 'name': row['hdd_type_name']}, 'size': row['size']},
+        'part_id': row['part_id'], 'hddcount': row['hddcount'], 'description': row['description'],
+    } for row in make_hdds(pk)],
+    'device_external_links_agg': lambda pk: [{'notes': row['device_url_notes'], 'link': row['device_url']}
+                                             for row in make_links(pk)],
+    'device_purchase_line_items_agg': lambda pk: [dict((k, v) for k, v in row.items()
+                                                       if k not in ('device_pk', 'device_name'))
+                                                  for row in make_entitlements(pk)],
+    'custom_fields_agg': lambda pk: [{'key': row['custom_field_key'], 'value': row['custom_field_value']}
+                                     for row in make_custom_fields(pk)],
+}
+
+# (marker in the query, rows of one device), checked in order
+DATASETS = [
+    ('custom_field_key', make_custom_fields),
+    ('device_url_notes', make_links),
+    ('hdd_details', make_hdds),
+    ('subnet.name as subnet', make_ips),
+    ('as mac', make_macs),
+    ('line_items', make_entitlements),
+]
+
+DEVICE_IDS_QUERY = re.compile(r'^\s*select\s+view_device_v1\.device_pk\s+from\s+view_device_v1\b', re.I)
+SIMPLE_SELECT = re.compile(r'^\s*select\s+([\w\s,.]+?)\s+from\s+view_device_v1\b', re.I)
+
+
+def device_range(query, devices):
+    first, last = 1, devices
+    match = re.search(r'device_pk > (\d+)', query)
+    if match:
+        first = max(first, int(match.group(1)) + 1)
+    match = re.search(r'device_pk between (\d+) and (\d+)', query)
+    if match:
+        first, last = max(first, int(match.group(1))), min(last, int(match.group(2)))
+
+    limit = re.search(r'\blimit (\d+)', query)
+    if limit:
+        last = min(last, first + int(limit.group(1)) - 1)
+
+    return range(first, last + 1)
+
+
+def iter_rows(query, devices):
+    edited_since = re.search(r"last_edited >= '([^']*)'", query)
+
+    def selected(device_pks):
+        for device_pk in device_pks:
+            if edited_since and make_device(device_pk)['last_edited'] < edited_since.group(1):
+                continue
+            yield device_pk
+
+    device_pks = device_range(query, devices)
+
+    if DEVICE_IDS_QUERY.match(query):
+        return ({'device_pk': device_pk} for device_pk in device_pks)
+
+    if 'json_agg' in query:
+        columns = [column for column in AGGREGATES if column in query]
+        return (dict(make_device(device_pk), **dict((column, AGGREGATES[column](device_pk)) for column in columns))
+                for device_pk in selected(device_pks))
+
+    for marker, make_rows in DATASETS:
+        if marker in query:
+            return (row for device_pk in selected(device_pks) for row in make_rows(device_pk))
+
+    if 'view_device_v1.*' in query:
+        return (make_device(device_pk) for device_pk in selected(device_pks))
+
+    # free form queries of the lookups and contrib scripts, only plain column lists are projected
+    match = SIMPLE_SELECT.match(query)
+    columns = [column.strip().split('.')[-1] for column in match.group(1).split(',')] if match else None
+    return (dict((column, device.get(column)) for column in columns) if columns else device
+            for device in (make_device(device_pk) for device_pk in selected(device_pks)))
+
+
+def iter_json(rows):
+    yield '['
+    for n, row in enumerate(rows):
+        yield (',' if n else '') + json.dumps(row)
+    yield ']'
+
+
+def iter_csv(rows, header):
+    buf = io.StringIO()
+    writer = None
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(buf, fieldnames=list(row.keys()), quoting=csv.QUOTE_ALL)
+            if header:
+                writer.writeheader()
+        writer.writerow(dict((k, '' if v is None else v) for k, v in row.items()))
+        if buf.tell() > 65536:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+class D42Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != '/services/data/v1.0/query':
+            return self.send_error(404)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        query = form.get('query', [''])[0]
+        time.sleep(self.server.latency)
+
+        rows = iter_rows(query, self.server.devices)
+        if form.get('output_type', [''])[0] == 'json':
+            body, content_type = iter_json(rows), 'application/json'
+        else:
+            body, content_type = iter_csv(rows, form.get('header', ['no'])[0] == 'yes'), 'text/csv'
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in body:
+            if chunk:
+                data = chunk.encode('utf-8')
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != '/api/1.0/passwords':
+            return self.send_error(404)
+
+        params = parse_qs(url.query)
+        device, username = params.get('device', [''])[0], params.get('username', [''])[0]
+        time.sleep(self.server.latency)
+
+        body = json.dumps({'Passwords': [{'device': device, 'username': username,
+                                          'password': 'pw-%s-%s' % (device, username)}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(devices, latency=0.0, host='127.0.0.1', port=0):
+    server = ThreadingHTTPServer((host, port), D42Handler)
+    server.daemon_threads = True
+    server.devices = devices
+    server.latency = latency
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='0 picks a free port')
+    args = parser.parse_args()
+
+    server = make_server(args.devices, args.latency, args.host, args.port)
+    # the benchmark runner reads the URL from the first line
+    print('http://%s:%d' % server.server_address[:2])
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""
+Make the collection importable when the tests are run with plain pytest, either from a checkout located at
+.../ansible_collections/device42/d42 or with ANSIBLE_COLLECTIONS_PATH pointing at the directory containing
+ansible_collections. The collection loader is installed like ansible-test units does, which sets this up itself, so
+the plugin loader finds the collection too. The contrib scripts run from the root of the checkout, which is added to
+sys.path.
+
+    python -m pytest tests/unit
+"""
+from __future__ import (absolute_import, division, print_function)
+import os
+import sys
+
+from ansible.utils.collection_loader import AnsibleCollectionConfig
+from ansible.utils.collection_loader._collection_finder import _AnsibleCollectionFinder
+
+__metaclass__ = type
+
+CHECKOUT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+COLLECTIONS_ROOT = os.path.abspath(os.path.join(CHECKOUT_ROOT, '..', '..', '..'))
+
+sys.path.append(CHECKOUT_ROOT)
+
+if AnsibleCollectionConfig.collection_finder is None:
+    paths = os.environ.get('ANSIBLE_COLLECTIONS_PATH', COLLECTIONS_ROOT).split(os.pathsep)
+    _AnsibleCollectionFinder(paths=paths)._install()
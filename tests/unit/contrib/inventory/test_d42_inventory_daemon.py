@@ -0,0 +1,79 @@
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import threading
+
+import pytest
+from ansible.inventory.data import InventoryData
+from ansible.parsing.dataloader import DataLoader
+
+from contrib.inventory.d42_inventory_daemon import InventoryDaemon, create_server, load_plugin
+from ansible_collections.device42.d42.plugins.plugin_utils.d42_daemon import get_daemon_json
+
+__metaclass__ = type
+
+# load_plugin sets up the collection loader like the daemon does, the tests already did
+pytestmark = pytest.mark.filterwarnings('ignore:AnsibleCollectionFinder has already been configured')
+
+ESTATE = {
+    'fields': ['device_pk', 'name', 'service_level', 'tags', 'ip_addresses'],
+    'Devices': [
+        [1, 'web-01.example.com', 'Production', ['web'], [[7, '10.0.0.1', 'eth0', 'static', '10.0.0.0/24']]],
+        [2, 'db 01', 'QA', [], []],
+    ],
+}
+
+
+@pytest.fixture
+def daemon_url(tmp_path, monkeypatch):
+    config = tmp_path / 'daemon.d42.yml'
+    config.write_text(u'plugin: device42.d42.d42\nurl: https://device42.example.com\nusername: admin\npassword: x\n')
+    plugin = load_plugin(str(config))
+
+    def get_live_d42_inventory(fallback=None, fallback_source=None):
+        plugin.inventory_source = 'live'
+        return ESTATE
+
+    monkeypatch.setattr(plugin, 'get_live_d42_inventory', get_live_d42_inventory)
+    daemon = InventoryDaemon(plugin)
+    assert daemon.refresh()
+
+    socket_path = str(tmp_path / 'inventory.sock')
+    server, url = create_server(argparse.Namespace(socket=socket_path, socket_mode='600', listen=None))
+    server.inventory_daemon = daemon
+    server.verbose = False
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield url
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_devices_round_trip(daemon_url, tmp_path):
+    assert get_daemon_json(daemon_url, '/devices') == dict(ESTATE, total_count=2)
+
+    source = tmp_path / 'client.d42.yml'
+    source.write_text(u'plugin: device42.d42.d42\nsource: daemon\ndaemon_url: %s\nkeyed_groups:\n'
+                      u'  - key: d42_service_level\n    prefix: sl\n' % daemon_url)
+    inventory = InventoryData()
+    plugin = load_plugin(str(source))
+    plugin.parse(inventory, DataLoader(), str(source))
+
+    assert sorted(inventory.hosts) == ['db_01', 'web_01_example_com']
+    web = inventory.get_host('web_01_example_com').get_vars()
+    assert web['d42_service_level'] == 'Production'
+    assert web['d42_tags'] == ['web']
+    assert web['ansible_host'] == '10.0.0.1'
+    assert [host.name for host in inventory.groups['sl_QA'].hosts] == ['db_01']
+    assert inventory.groups['all'].vars['d42_inventory_source'] == 'daemon'
+
+
+def test_list_is_ungrouped(daemon_url):
+    inventory = get_daemon_json(daemon_url, '/list')
+
+    assert sorted(inventory) == ['_meta', 'all']
+    assert sorted(inventory['all']['hosts']) == ['db_01', 'web_01_example_com']
+    assert inventory['_meta']['hostvars']['db_01']['d42_service_level'] == 'QA'
+    assert get_daemon_json(daemon_url, '/host/web_01_example_com')['d42_name'] == 'web-01.example.com'
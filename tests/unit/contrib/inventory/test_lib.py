@@ -0,0 +1,55 @@
+from __future__ import (absolute_import, division, print_function)
+import os
+import stat
+
+import pytest
+
+from contrib.inventory import lib
+
+__metaclass__ = type
+
+INVENTORY = {
+    'Production': {'hosts': ['web-01']},
+    '_meta': {'hostvars': {'web-01': {'d42_name': 'web-01', 'd42_service_level': 'Production'}}},
+}
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'inventory.json')
+
+
+def test_inventory_cache_round_trip(cache_path):
+    lib.save_inventory_cache(cache_path, INVENTORY, 'key')
+
+    assert stat.S_IMODE(os.stat(cache_path).st_mode) == 0o600
+    assert lib.load_inventory_cache(cache_path, 300, 'key') == INVENTORY
+    assert lib.load_inventory_cache(cache_path, None, 'key') == INVENTORY
+
+
+def test_inventory_cache_of_another_query(cache_path):
+    lib.save_inventory_cache(cache_path, INVENTORY, 'key')
+
+    assert lib.load_inventory_cache(cache_path, 300, 'other') is None
+
+
+def test_inventory_cache_expiry(cache_path, monkeypatch):
+    now = 1700000000.0
+    monkeypatch.setattr(lib.time, 'time', lambda: now)
+    lib.save_inventory_cache(cache_path, INVENTORY, 'key')
+
+    now += 300
+    assert lib.load_inventory_cache(cache_path, 300, 'key') == INVENTORY
+    now += 1
+    assert lib.load_inventory_cache(cache_path, 300, 'key') is None
+    # no max age never expires
+    assert lib.load_inventory_cache(cache_path, None, 'key') == INVENTORY
+
+
+@pytest.mark.parametrize('content', [None, '', '{"timestamp": ', '[]'])
+def test_inventory_cache_unreadable(cache_path, content):
+    if content is not None:
+        with open(cache_path, 'w') as f:
+            f.write(content)
+
+    assert lib.load_inventory_cache(cache_path, 300, None) is None
@@ -0,0 +1,466 @@
+from __future__ import (absolute_import, division, print_function)
+import gzip
+import json
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from ansible.errors import AnsibleParserError
+from ansible.inventory.data import InventoryData
+from ansible.parsing.dataloader import DataLoader
+from ansible.template import Templar
+
+from ansible_collections.device42.d42.plugins.inventory import d42
+from ansible_collections.device42.d42.plugins.inventory.d42 import (
+    CHILD_PATHS, GROUPS_ACCEPT_HOSTVARS, InventoryModule, iter_json_array)
+from ansible_collections.device42.d42.plugins.plugin_utils import d42_refresh
+from ansible_collections.device42.d42.plugins.plugin_utils.d42_metrics import new_query_metric
+from ansible_collections.device42.d42.plugins.plugin_utils.d42_snapshot import save_snapshot
+
+try:
+    from ansible.template import trust_as_template
+except ImportError:
+    # ansible < 2.19 templates any string
+    def trust_as_template(value):
+        return value
+
+__metaclass__ = type
+
+OPTIONS = {
+    'filters': {},
+    'native_keyed_groups': True,
+    'use_extra_vars': False,
+    'leading_separator': True,
+}
+
+
+@pytest.fixture
+def plugin(monkeypatch):
+    def make(**options):
+        plugin = InventoryModule()
+        plugin.inventory = InventoryData()
+        plugin.templar = Templar(loader=DataLoader())
+        plugin._options = dict(OPTIONS, **options)
+        monkeypatch.setattr(plugin, 'get_option', plugin._options.__getitem__)
+        return plugin
+
+    return make
+
+
+def test_filter_conditions(plugin):
+    filters = {
+        'service_level': 'Production',
+        'os_name': ['Ubuntu', "O'Brien"],
+        'os_version': [],
+        'asset_no': None,
+        'in_service': True,
+        'hw_depth': {'gt': 2},
+        'last_edited': {'lt': '2024-02-01', 'gte': '2024-01-01'},
+        'tags': ['web', "it's"],
+        'customer': "Acme's",
+        'custom_fields': {'env': ['prod', 'stage']},
+    }
+
+    assert plugin(filters=filters).get_filter_conditions() == [
+        'view_device_v1.asset_no is null',
+        "exists (select 1 from view_device_custom_fields_v1 custom_field_filter "
+        "where custom_field_filter.device_fk = view_device_v1.device_pk "
+        "and custom_field_filter.key = 'env' and custom_field_filter.value in ('prod', 'stage'))",
+        "view_device_v1.customer_fk in (select customer_pk from view_customer_v1 where name = 'Acme''s')",
+        'view_device_v1.hw_depth > 2',
+        'view_device_v1.in_service = true',
+        "view_device_v1.last_edited >= '2024-01-01'",
+        "view_device_v1.last_edited < '2024-02-01'",
+        "view_device_v1.os_name in ('Ubuntu', 'O''Brien')",
+        'false',
+        "view_device_v1.service_level = 'Production'",
+        "regexp_split_to_array(view_device_v1.tags, '\\s*,\\s*') && array['web', 'it''s']::text[]",
+    ]
+
+
+def test_filters_are_added_to_every_query(plugin, monkeypatch):
+    inventory = plugin(filters={'service_level': "Production'; drop table view_device_v1; --"})
+    monkeypatch.setattr(inventory, 'get_doql_json', lambda query: query)
+
+    assert inventory.run_doql_query('select device_pk from view_device_v1', ['view_device_v1.device_pk > 5'],
+                                    limit=100) == (
+        "select device_pk from view_device_v1 where "
+        "(view_device_v1.service_level = 'Production''; drop table view_device_v1; --') and "
+        "(view_device_v1.device_pk > 5) order by view_device_v1.device_pk limit 100")
+
+
+def test_no_filters(plugin):
+    inventory = plugin()
+
+    assert inventory.get_filter_conditions() == []
+    assert inventory.where_clause([]) == ''
+
+
+@pytest.mark.parametrize('filters', [
+    {'name; drop table view_device_v1': 'x'},
+    {'Name': 'x'},
+    {'1name': 'x'},
+    {'view_device_v1.name': 'x'},
+    {'name': {'like': 'x%'}},
+    {'custom_fields': ['env']},
+])
+def test_invalid_filters(plugin, filters):
+    with pytest.raises(AnsibleParserError):
+        plugin(filters=filters).get_filter_conditions()
+
+
+JSON_ARRAY = json.dumps([
+    {'name': 'web-01', 'notes': 'a "quoted", [bracketed] {braced} note\nover two lines', 'tags': ['a', 'b']},
+    {'name': 'db-01', 'nested': {'list': [[], {}], 'none': None}, 'unicode': u'caf\u00e9 \u2603'},
+    'a string, with a comma]',
+    12345,
+    -1.5e3,
+    True,
+    None,
+    [1, [2, [3]]],
+    67890,
+], indent=1)
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, len(JSON_ARRAY)])
+def test_iter_json_array_chunk_sizes(size):
+    chunks = [JSON_ARRAY[i:i + size] for i in range(0, len(JSON_ARRAY), size)]
+
+    assert list(iter_json_array(chunks)) == json.loads(JSON_ARRAY)
+
+
+def test_iter_json_array_split_anywhere():
+    expected = json.loads(JSON_ARRAY)
+    for split in range(len(JSON_ARRAY) + 1):
+        assert list(iter_json_array([JSON_ARRAY[:split], '', JSON_ARRAY[split:]])) == expected, split
+
+
+@pytest.mark.parametrize('chunks, expected', [
+    (['[]'], []),
+    ([' \n[ ', ' ]\n'], []),
+    (['[1', '2, 3', '4]'], [12, 34]),
+    (['["a', 'b", tr', 'ue, nu', 'll]'], ['ab', True, None]),
+])
+def test_iter_json_array_scalars(chunks, expected):
+    assert list(iter_json_array(chunks)) == expected
+
+
+@pytest.mark.parametrize('chunks', [
+    ['{"Devices": []}'],
+    ['[1, 2'],
+    ['[{"name": "web-01"}, {"name": '],
+    [''],
+])
+def test_iter_json_array_invalid(chunks):
+    with pytest.raises(ValueError):
+        list(iter_json_array(chunks))
+
+
+# trusted like the keyed_groups read from the inventory source, the host variables are not
+KEYED_GROUPS = [dict((option, trust_as_template(value) if option in ('key', 'parent_group') else value)
+                     for option, value in keyed.items()) for keyed in [
+    {'key': 'd42_service_level', 'prefix': 'service_level'},
+    {'key': 'd42_tags', 'prefix': 'tag', 'separator': '-'},
+    {'key': 'd42_customer', 'prefix': 'customer', 'default_value': 'unassigned'},
+    {'key': 'd42_os_name', 'parent_group': 'operating_systems'},
+    {'key': 'd42_name', 'prefix': ''},
+    {'key': 'd42_aliases', 'prefix': 'alias', 'default_value': 'none'},
+]]
+
+HOSTS = {
+    'web-01': {'d42_service_level': 'Production', 'd42_tags': ['web', 'frontend'], 'd42_customer': '',
+               'd42_os_name': 'Ubuntu 22.04', 'd42_name': 'web-01.example.com', 'd42_aliases': ['www', '']},
+    'db-01': {'d42_service_level': None, 'd42_tags': [], 'd42_customer': 'Acme Corp', 'd42_os_name': 'CentOS/7',
+              'd42_name': 'db-01.example.com', 'd42_aliases': []},
+    'qa-01': {'d42_service_level': 'QA & Test', 'd42_tags': ['db'], 'd42_customer': None, 'd42_os_name': '',
+              'd42_name': 'qa-01', 'd42_aliases': ['qa']},
+}
+
+
+def get_groups(inventory):
+    return dict((name, (sorted(host.name for host in group.hosts),
+                        sorted(child.name for child in group.child_groups)))
+                for name, group in inventory.groups.items())
+
+
+@pytest.mark.parametrize('leading_separator', [True, False])
+def test_native_keyed_groups_match_templated(plugin, leading_separator):
+    group_kwargs = {'fetch_hostvars': False} if GROUPS_ACCEPT_HOSTVARS else {}
+
+    native = plugin(leading_separator=leading_separator)
+    plan = native.plan_keyed_groups(KEYED_GROUPS)
+    assert all(settings is not None for keyed, settings in plan)
+
+    templated = plugin(leading_separator=leading_separator)
+
+    for host_name, host_vars in HOSTS.items():
+        for inventory in (native, templated):
+            inventory.inventory.add_host(host_name)
+
+        for keyed, settings in plan:
+            assert native.add_host_to_native_keyed_group(settings, host_vars, host_name, False)
+        templated._add_host_to_keyed_groups(KEYED_GROUPS, host_vars, host_name, False, **group_kwargs)
+
+    groups = get_groups(native.inventory)
+    assert groups == get_groups(templated.inventory)
+    assert groups['service_level_Production'] == (['web-01'], [])
+    assert groups['customer_unassigned'] == (['qa-01', 'web-01'], [])
+    assert len(groups['operating_systems'][1]) == 2
+
+
+def test_keyed_groups_left_to_templating(plugin):
+    inventory = plugin()
+    plan = inventory.plan_keyed_groups([
+        {'key': 'd42_name | upper'},
+        {'key': 'true'},
+        {'key': 'd42_name', 'parent_group': '{{ d42_customer }}'},
+        {'key': 'd42_name', 'default_value': 'x', 'trailing_separator': False},
+    ])
+
+    assert [settings for keyed, settings in plan] == [None, None, None, None]
+    assert plugin(native_keyed_groups=False).plan_keyed_groups([{'key': 'd42_name'}]) == [({'key': 'd42_name'}, None)]
+
+    # values the templated path would template or does not group on natively
+    settings = inventory.plan_keyed_groups([{'key': 'd42_notes'}])[0][1]
+    for value in ('{{ 7 * 7 }}', {'a': 'b'}, 5):
+        assert not inventory.add_host_to_native_keyed_group(settings, {'d42_notes': value}, 'web-01', False)
+    assert not inventory.add_host_to_native_keyed_group(settings, {}, 'web-01', False)
+
+
+DEVICE_QUERY_OPTIONS = dict(
+    exclude_fields=[], incremental=False, query_engine='split', include_ip_addresses=True, include_mac_addresses=True,
+    include_hdd_details=True, include_external_links=True, include_entitlements=True, include_custom_fields=True)
+
+
+def get_device_query(inventory, monkeypatch):
+    monkeypatch.setattr(inventory, 'run_doql_query', lambda query, conditions, stream, limit: ' '.join(query.split()))
+    return inventory.get_devices()
+
+
+def test_device_query_selects_listed_fields(plugin, monkeypatch):
+    inventory = plugin(fields=['service_level', 'os', 'customer', 'hddsize', 'ip_addresses'], **DEVICE_QUERY_OPTIONS)
+    select, joins = get_device_query(inventory, monkeypatch).split(' from view_device_v1 ')
+
+    assert select.startswith(
+        "select view_device_v1.device_pk, view_device_v1.name, view_device_v1.last_edited, "
+        "view_device_v1.service_level, view_device_v1.os_name, customer.name as customer, CEIL(")
+    assert select.endswith(' AS disk_size')
+    assert joins.startswith('left join (select customer_pk, name from view_customer_v1) customer ')
+    assert joins.endswith(') AS p ON view_device_v1.device_pk = p.device_fk')
+    assert 'view_hardware_v1' not in joins
+    assert 'view_device_v1.*' not in select
+
+
+def test_device_query_selects_all_fields_whole(plugin, monkeypatch):
+    query = get_device_query(plugin(fields=[], **DEVICE_QUERY_OPTIONS), monkeypatch)
+
+    assert query.startswith('select view_device_v1.*, view_device_v1.customer_fk as customer_id, ')
+
+
+class GzipDOQLHandler(BaseHTTPRequestHandler):
+    body = gzip.compress(json.dumps([{'device_pk': pk, 'name': 'host-%d' % pk} for pk in range(500)]).encode('utf-8'))
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def doql_url():
+    server = HTTPServer(('127.0.0.1', 0), GzipDOQLHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_query_bytes_are_counted_compressed(plugin, monkeypatch, doql_url, stream):
+    inventory = plugin(url=doql_url, username='admin', password='x', ssl_check=False, timeout=5, debug=False,
+                       pool_size=1, retries=0, retry_backoff=0, rate_limit=0, rate_burst=1, max_in_flight=0)
+    metric = new_query_metric('Devices')
+    monkeypatch.setattr(inventory, 'get_query_metric', lambda: metric)
+
+    if stream:
+        rows = list(inventory.iter_doql_json('select 1'))
+    else:
+        rows = inventory.fetch_doql_json('select 1')
+
+    assert len(rows) == 500
+    assert metric['bytes'] == len(GzipDOQLHandler.body)
+
+
+def test_entitlements_keep_the_old_purchase_key():
+    line_item = tuple(range(len(CHILD_PATHS['device_purchase_line_items'])))
+    host_vars = InventoryModule.get_host_variables(['name', 'device_purchase_line_items'], ('web-01', [line_item]))
+
+    entitlement = host_vars['d42_device_purchase_line_items'][0]
+    assert entitlement['purchase_id'] == entitlement['purhase_id'] == 0
+    assert entitlement['line_contract_type'] == len(line_item) - 1
+
+
+PARSE_OPTIONS = dict(
+    strict=False, source='live', url='https://device42.example.com', username='admin', password='x', fields=[],
+    exclude_fields=[], clean_device_name=True, compose={}, groups={}, keyed_groups=[], metrics_verbosity=3,
+    metrics_path=None)
+
+
+def test_failed_parse_removes_the_added_hosts(plugin, monkeypatch):
+    inventory = plugin(**PARSE_OPTIONS)
+    inventory.inventory.add_host('existing')
+    monkeypatch.setattr(inventory, '_read_config_data', lambda path: None)
+
+    def get_cached_d42_inventory(path, cache):
+        # a pipelined inventory that breaks off after the first device
+        def devices():
+            yield [1, 'web-01']
+            raise KeyError('device_pk')
+
+        return {'fields': ['id', 'name'], 'Devices': devices()}
+
+    monkeypatch.setattr(inventory, 'get_cached_d42_inventory', get_cached_d42_inventory)
+
+    with pytest.raises(AnsibleParserError, match='device_pk'):
+        inventory.parse(inventory.inventory, DataLoader(), 'test.d42.yml')
+
+    assert list(inventory.inventory.hosts) == ['existing']
+
+
+class Popen(object):
+    started = []
+
+    def __init__(self, args, stdin=None, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.stdin = types.SimpleNamespace(write=self.write, close=lambda: None)
+        self.started.append(self)
+
+    def write(self, data):
+        self.request = json.loads(data.decode('utf-8'))
+
+
+def test_stale_snapshot_is_refreshed_in_a_detached_process(plugin, monkeypatch, tmp_path):
+    snapshot_path = str(tmp_path / 'inventory.pkl')
+    inventory = plugin(url='https://device42.example.com', fields=['name'], snapshot_path=snapshot_path,
+                       snapshot_max_age=300, snapshot_max_staleness=3600, snapshot_background_refresh=True,
+                       **DEVICE_QUERY_OPTIONS)
+    snapshot_key = d42.make_key('https://device42.example.com', ['id', 'name'], [])
+    save_snapshot(snapshot_path, [(1, 'web-01')], snapshot_key)
+
+    now = time.time() + 600
+    monkeypatch.setattr(d42, 'time', types.SimpleNamespace(time=lambda: now, perf_counter=time.perf_counter))
+    monkeypatch.setattr(d42.subprocess, 'Popen', Popen)
+    monkeypatch.setattr(Popen, 'started', [])
+    monkeypatch.setattr(inventory, 'get_d42_inventory', lambda: pytest.fail('the run must not query Device42'))
+
+    assert inventory.get_snapshot_d42_inventory(True)['Devices'] == [(1, 'web-01')]
+    assert inventory.inventory_source == 'stale_snapshot'
+
+    refresh, = Popen.started
+    assert refresh.args[1] == d42_refresh.__file__
+    assert refresh.kwargs['start_new_session']
+    assert refresh.request == {'options': inventory._options, 'snapshot_path': snapshot_path,
+                               'snapshot_key': snapshot_key}
+
+
+# the same estate as the child collections of the aggregated device query, flattened for the split child queries
+ESTATE_CHILDREN = {
+    1: {
+        'ip_addresses': [{'subnet_id': 7, 'ip': '10.0.0.1', 'label': 'eth0', 'type': 'static', 'subnet': 'lan'},
+                         {'subnet_id': 8, 'ip': '10.1.0.1', 'label': None, 'type': 'dhcp', 'subnet': 'mgmt'}],
+        'mac_addresses': [{'mac': '00:11:22:33:44:55', 'vlan': 'prod', 'port_name': 'eth0', 'port': '1'}],
+        'hdd_details': [{'raid_group': 'rg1', 'serial_no': 'S1', 'raid_type': 'RAID1', 'part_id': 3, 'hddcount': 2,
+                         'description': 'disk', 'hdd': {
+                             'description': 'SSD', 'partno': 'P1', 'rpm': {'id': None, 'name': None}, 'notes': '',
+                             'bytes': 'GB', 'location': 'bay 1', 'hd_id': 4, 'manufacturer_id': 5,
+                             'type': {'id': 1, 'name': 'SSD'}, 'size': 960}}],
+        'device_external_links': [{'notes': 'wiki', 'link': 'https://wiki.example.com/web-01'}],
+        'device_purchase_line_items': [dict((path[0], '%s-1' % path[0])
+                                            for path in CHILD_PATHS['device_purchase_line_items'])],
+        'custom_fields': [{'key': 'env', 'value': 'prod'}, {'key': 'owner', 'value': None}],
+    },
+    2: {},
+    3: {'custom_fields': [{'key': 'env', 'value': 'qa'}], 'ip_addresses': [
+        {'subnet_id': 7, 'ip': '10.0.0.3', 'label': 'eth0', 'type': 'static', 'subnet': 'lan'}]},
+}
+
+CHILD_QUERIES = {
+    'ip_address.subnet_fk as subnet_id': 'ip_addresses',
+    'mac_address.hw_address as mac': 'mac_addresses',
+    'hdd_details.raid_group': 'hdd_details',
+    'external_links.device_url': 'device_external_links',
+    'line_items.purchase_fk as purchase_id': 'device_purchase_line_items',
+    'custom_field.key as custom_field_key': 'custom_fields',
+}
+
+
+def get_estate_json(query):
+    query = ' '.join(query.split())
+    columns = [column for key, column, convert in d42.DEVICE_FIELDS if column]
+    if query.startswith('select view_device_v1.*'):
+        devices = []
+        for device_pk, children in ESTATE_CHILDREN.items():
+            device = dict((column, '%s-%d' % (column, device_pk)) for column in columns)
+            device.update(device_pk=device_pk, name='host-%d' % device_pk, blade_chassis=device_pk == 1,
+                          aliases='a%d,b%d' % (device_pk, device_pk), nonauthoritativealiases=None)
+            for key in d42.CHILD_FIELDS:
+                if '%s_agg' % key in query:
+                    # DOQL returns json_agg columns decoded or as JSON text, and null without children
+                    agg = children.get(key)
+                    device['%s_agg' % key] = json.dumps(agg) if agg and key == 'custom_fields' else agg
+            devices.append(device)
+        return devices
+
+    key = [key for marker, key in CHILD_QUERIES.items() if marker in query][0]
+    rows = []
+    for device_pk, children in ESTATE_CHILDREN.items():
+        for child in children.get(key, []):
+            row = dict((column, d42.get_path(child, path)) for path, column in d42.CHILD_LAYOUTS[key])
+            row.update(device_pk=device_pk, name='host-%d' % device_pk)
+            rows.append(row)
+    return rows
+
+
+def get_estate_hostvars(plugin, monkeypatch, query_engine):
+    inventory = plugin(fields=[], debug=False, concurrent_fetch=False, stream_results=False, page_size=0,
+                       **dict(DEVICE_QUERY_OPTIONS, query_engine=query_engine))
+    monkeypatch.setattr(inventory, 'get_doql_json', get_estate_json)
+    inventory.reset_metrics()
+    inventory.failed_queries = []
+
+    estate = inventory.get_d42_inventory()
+    assert inventory.failed_queries == []
+
+    return dict((host_vars['d42_name'], host_vars) for host_vars in
+                (inventory.get_host_variables(estate['fields'], device) for device in estate['Devices']))
+
+
+def test_query_engines_build_the_same_hostvars(plugin, monkeypatch):
+    split = get_estate_hostvars(plugin, monkeypatch, 'split')
+    aggregated = get_estate_hostvars(plugin, monkeypatch, 'aggregated')
+
+    assert split == aggregated
+    assert sorted(split) == ['host-1', 'host-2', 'host-3']
+    web = split['host-1']
+    assert web['ansible_host'] == '10.0.0.1'
+    assert web['d42_hdd_details'][0]['hdd']['type'] == {'id': 1, 'name': 'SSD'}
+    assert web['d42_device_purchase_line_items'][0]['purhase_id'] == 'purchase_id-1'
+    assert web['d42_custom_fields'] == [{'key': 'env', 'value': 'prod'}, {'key': 'owner', 'value': None}]
+    assert web['d42_is_it_blade_host'] == 'yes'
+    assert web['d42_aliases'] == ['a1', 'b1']
+    assert split['host-2']['d42_ip_addresses'] == []
+    assert split['host-3']['d42_mac_addresses'] == []
@@ -0,0 +1,53 @@
+from __future__ import (absolute_import, division, print_function)
+import io
+import json
+import os
+
+from ansible_collections.device42.d42.plugins.plugin_utils import d42_refresh
+
+__metaclass__ = type
+
+
+class Plugin(object):
+    refreshed = []
+
+    def __init__(self, options):
+        self.options = options
+
+    def refresh_snapshot(self, snapshot_path, snapshot_key):
+        self.refreshed.append((self.options, snapshot_path, snapshot_key))
+
+
+def run_refresh(monkeypatch, request):
+    monkeypatch.setattr(d42_refresh.sys, 'stdin', io.StringIO(json.dumps(request)))
+    d42_refresh.main()
+
+
+def test_refresh(monkeypatch, tmp_path):
+    snapshot_path = str(tmp_path / 'inventory.pkl')
+    monkeypatch.setattr(d42_refresh, 'load_plugin', Plugin)
+    monkeypatch.setattr(Plugin, 'refreshed', [])
+
+    run_refresh(monkeypatch, {'options': {'url': 'https://device42.example.com'}, 'snapshot_path': snapshot_path,
+                              'snapshot_key': 'key'})
+
+    assert Plugin.refreshed == [({'url': 'https://device42.example.com'}, snapshot_path, 'key')]
+    assert oct(os.stat(snapshot_path + '.lock').st_mode & 0o777) == oct(0o600)
+
+
+def test_only_one_refresh_at_a_time(monkeypatch, tmp_path):
+    snapshot_path = str(tmp_path / 'inventory.pkl')
+    monkeypatch.setattr(d42_refresh, 'load_plugin', Plugin)
+    monkeypatch.setattr(Plugin, 'refreshed', [])
+
+    lock = d42_refresh.lock_refresh(snapshot_path)
+    try:
+        assert d42_refresh.lock_refresh(snapshot_path) is None
+        run_refresh(monkeypatch, {'options': {}, 'snapshot_path': snapshot_path, 'snapshot_key': 'key'})
+        assert Plugin.refreshed == []
+    finally:
+        os.close(lock)
+
+    lock = d42_refresh.lock_refresh(snapshot_path)
+    assert lock is not None
+    os.close(lock)